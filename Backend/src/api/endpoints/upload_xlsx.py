@@ -1,12 +1,11 @@
-from typing import Union, Optional
 from fastapi import Depends, HTTPException, File, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.responses import StreamingResponse
-import pandas as pd
-from io import BytesIO
 
 from ..router import router
 from ...core import BACKEND_ACCESS_TOKEN
+from ...services import XLSXToCSVStream, InvalidXLSXFileError
 
 bearer = HTTPBearer()
 
@@ -19,21 +18,20 @@ async def upload_xlsx(
     if token.credentials != BACKEND_ACCESS_TOKEN:
         raise HTTPException(status_code=403, detail="Invalid token")
 
-    # Read the XLSX file content
-    content = await file.read()
-    xlsx_file = BytesIO(content)
+    # Open the XLSX file in a worker thread, the rows are converted while the response is streamed
+    csv_stream = XLSXToCSVStream(file.file)
+    try:
+        await run_in_threadpool(csv_stream.open)
+    except InvalidXLSXFileError:
+        raise HTTPException(status_code=400, detail="Invalid XLSX file")
 
-    # Convert the XLSX file to CSV using pandas
-    df = pd.read_excel(xlsx_file, engine='openpyxl')
-    csv_data = df.to_csv(index=False)
-
-    # Create a streaming response with the CSV data
+    # Starlette iterates the synchronous generator in a worker thread too
     response = StreamingResponse(
-        BytesIO(csv_data.encode()),
+        iter(csv_stream),
         media_type="text/csv",
         headers={
             "Content-Disposition": f"attachment; filename={file.filename.split('.')[0]}.csv"
         }
     )
 
-    return response
\ No newline at end of file
+    return response
@@ -5,6 +5,7 @@ from .payment_purpose import PaymentPurpose
 from .quality import Quality, quality_aliases
 from .fluorescence import Fluorescence, fluorescence_aliases
 from .culet import Culet, culet_aliases
+from .upload_job_status import UploadJobStatus
 
 __all__ = [
     "Color",
@@ -19,5 +20,6 @@ __all__ = [
     "Fluorescence",
     "fluorescence_aliases",
     "Culet",
-    "culet_aliases"
+    "culet_aliases",
+    "UploadJobStatus"
 ]
@@ -0,0 +1,8 @@
+from enum import Enum
+
+
+class UploadJobStatus(Enum):
+    PENDING = "Pending"
+    RUNNING = "Running"
+    DONE = "Done"
+    FAILED = "Failed"
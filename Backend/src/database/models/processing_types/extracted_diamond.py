@@ -83,11 +83,11 @@ class ExtractedDiamond(NamedTuple):
         if isinstance(weight, dict):
             try:
                 from_weight = float(weight['from'])
-            except (ValueError, KeyError):
+            except (ValueError, TypeError, KeyError):
                 from_weight = None
             try:
                 to_weight = float(weight['to'])
-            except (ValueError, KeyError):
+            except (ValueError, TypeError, KeyError):
                 to_weight = None
             value_range = ValueRange(from_weight, to_weight)
             if not value_range.is_valid():
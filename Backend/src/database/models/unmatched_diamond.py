@@ -1,4 +1,4 @@
-from sqlalchemy import ForeignKey, BigInteger
+from sqlalchemy import ForeignKey, BigInteger, false
 from sqlalchemy.orm import Mapped, mapped_column
 
 from .base import Base
@@ -9,3 +9,5 @@ class UnmatchedDiamond(Base):
 
     extracted_diamond_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("extracted_diamonds.id"), primary_key=True)
     queried_user_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("users.id"), nullable=False)
+    # Requests from the B2B group share the client contacts for free, as in process_search_query
+    free_notification: Mapped[bool] = mapped_column(nullable=False, default=False, server_default=false())
@@ -3,7 +3,9 @@ from .bot_notifications import (notify_seller_about_successful_subscription_rene
                                 notify_client_about_successful_b2b_group_access_purchase,
                                 notify_seller_about_successful_contacts_purchase)
 from .make_token_payment import make_token_payment, TokenNotFoundError, UnknownTokenPurpose, TokenPaymentError
+from .xlsx_to_csv import XLSXToCSVStream, InvalidXLSXFileError
 
 __all__ = ["notify_seller_about_successful_subscription_renewal", "NotifySellerAboutSuccessfulSubscriptionRenewalError",
            "NotifyError", "make_token_payment", "TokenNotFoundError", "UnknownTokenPurpose", "TokenPaymentError",
-           "notify_client_about_successful_b2b_group_access_purchase", "notify_seller_about_successful_contacts_purchase"]
+           "notify_client_about_successful_b2b_group_access_purchase", "notify_seller_about_successful_contacts_purchase",
+           "XLSXToCSVStream", "InvalidXLSXFileError"]
@@ -0,0 +1,93 @@
+import csv
+import io
+import shutil
+import tempfile
+from datetime import date, datetime, time
+from typing import Any, BinaryIO, Iterator
+
+from openpyxl import load_workbook
+from openpyxl.workbook import Workbook
+
+# Uploads bigger than that are copied to a temporary file on the disk instead of the memory
+XLSX_SPOOL_MAX_SIZE = 1024 * 1024
+# Rows written to the response at once
+CSV_CHUNK_ROWS = 500
+
+
+class InvalidXLSXFileError(Exception):
+    pass
+
+
+def get_cell_text(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    # Integer numbers are stored as floats
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    return str(value)
+
+
+class XLSXToCSVStream:
+    """
+    CSV of the active worksheet of an uploaded XLSX file, produced chunk by chunk.
+
+    The workbook is read by openpyxl in the read-only mode, so only the current chunk of rows is in memory. FastAPI
+    closes the uploaded file before the response is streamed, so it is copied to a spooled temporary file first.
+    """
+
+    def __init__(self, upload: BinaryIO):
+        self.upload = upload
+        self.xlsx_file: tempfile.SpooledTemporaryFile | None = None
+        self.workbook: Workbook | None = None
+
+    def open(self) -> None:
+        """Copy the upload and open the workbook, blocking, so it is run in a worker thread."""
+        self.xlsx_file = tempfile.SpooledTemporaryFile(max_size=XLSX_SPOOL_MAX_SIZE)
+        self.upload.seek(0)
+        shutil.copyfileobj(self.upload, self.xlsx_file)
+        self.xlsx_file.seek(0)
+        try:
+            self.workbook = load_workbook(self.xlsx_file, read_only=True, data_only=True)
+        except Exception as e:
+            self.close()
+            raise InvalidXLSXFileError from e
+
+    def close(self) -> None:
+        if self.workbook is not None:
+            self.workbook.close()
+        if self.xlsx_file is not None:
+            self.xlsx_file.close()
+
+    def __iter__(self) -> Iterator[bytes]:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        try:
+            rows = self.workbook.active.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                return
+            # Formatted but empty cells after the header are read as None
+            fieldnames = [get_cell_text(value) for value in header]
+            while fieldnames and fieldnames[-1] == "":
+                fieldnames.pop()
+            writer.writerow(fieldnames)
+
+            buffered_rows_amount = 0
+            for values in rows:
+                if all(value is None for value in values):
+                    continue
+                texts = [get_cell_text(value) for value in values[:len(fieldnames)]]
+                writer.writerow(texts + [""] * (len(fieldnames) - len(texts)))
+                buffered_rows_amount += 1
+                if buffered_rows_amount >= CSV_CHUNK_ROWS:
+                    yield buffer.getvalue().encode()
+                    buffer.seek(0)
+                    buffer.truncate()
+                    buffered_rows_amount = 0
+            yield buffer.getvalue().encode()
+        finally:
+            self.close()
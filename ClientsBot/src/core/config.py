@@ -20,6 +20,10 @@ async_database_url = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{D
 
 OPENAI_API_KEY = getenv("openai_api_key")
 JSON_EXTRACTOR_ASSISTANT_ID = getenv("json_extractor_assistant_id")
+# "assistant" runs the JSON extractor assistant in a thread, "chat" makes a single structured outputs chat completion
+EXTRACTION_BACKEND = getenv("extraction_backend", "assistant")
+assert EXTRACTION_BACKEND in ["assistant", "chat"]
+JSON_EXTRACTOR_MODEL = getenv("json_extractor_model", "gpt-4o-mini")
 
 SELLERS_BOT_BACKEND_URL = getenv("sellers_bot_backend_url")
 
@@ -2,7 +2,11 @@ from .user import User
 from .admin import Admin
 from .diamond import Diamond, DiamondAddError
 from .diamond_owner import DiamondOwner
+from .diamond_pair import DiamondPair
 from .unmatched_diamond import UnmatchedDiamond
+from .upload_job import UploadJob
+from .extraction_cache_entry import ExtractionCacheEntry
+from .schema_migration import SchemaMigration
 from .activated_subscription import ActivatedSubscription
 from .subscription_types import SubscriptionType
 from .successful_token_payment import SuccessfulTokenPayment
@@ -27,7 +31,8 @@ from .extracted_diamond_value_range_shape import ExtractedDiamondValueRangeShape
 from .extracted_diamond_value_range_weight import ExtractedDiamondValueRangeWeight
 from .base import Base
 
-__all__ = ["Base", "User", "Admin", "Diamond", "DiamondOwner", "UnmatchedDiamond", "ActivatedSubscription",
+__all__ = ["Base", "User", "Admin", "Diamond", "DiamondOwner", "DiamondPair", "UnmatchedDiamond", "UploadJob",
+           "ExtractionCacheEntry", "SchemaMigration", "ActivatedSubscription",
            "ActivatedSubscription", "SubscriptionType",
            "SuccessfulTokenPayment", "GeneratedToken", "PaymentPurposePrice", "ReceivedPaymentRequests",
            "DiamondAddError", "ContactsPurchaseTokenInformation",
@@ -1,20 +1,21 @@
+from enum import Enum
 from typing import Any
+from uuid import UUID
 
+from asyncpg import PostgresError, InterfaceError
 from loguru import logger
 from sqlalchemy.exc import IntegrityError, DBAPIError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Mapped, mapped_column
-from sqlalchemy import Enum as SQLAlchemyEnum, UniqueConstraint, or_, union
+from sqlalchemy import Enum as SQLAlchemyEnum, Index, FetchedValue, Uuid, text
 from sqlalchemy.dialects.postgresql import insert
 
-from .color_properties import ColorProperties
-from .clarity_properties import ClarityProperties
 from .base import Base
 from sqlalchemy.future import select
-from sqlalchemy import BigInteger
+from sqlalchemy import BigInteger, SmallInteger
 
 from .enums import Shape, Color, Clarity, Quality, Fluorescence, Culet
-from .processing_types import ExtractedDiamond, ValueRange
+from .processing_types import ExtractedDiamond
 
 
 class DiamondSearchError(Exception):
@@ -25,6 +26,20 @@ class DiamondAddError(Exception):
     pass
 
 
+# Identify a diamond, their hash is stored in identity_hash by a trigger from database/migrations.py
+DIAMOND_UNIQUE_COLUMNS = ['stock', 'shape', 'weight', 'color', 'clarity', 'lab', 'certificate_number', 'length',
+                          'width', 'depth', 'ratio', 'cut', 'polish', 'symmetry', 'fluorescence', 'table',
+                          'depth_percentage', 'gridle', 'culet']
+DIAMOND_UPDATED_COLUMNS = ['certificate_comment', 'rapnet', 'price_per_carat', 'picture']
+
+
+def get_copy_value(value: Any) -> Any:
+    # Enums are stored by name
+    if isinstance(value, Enum):
+        return value.name
+    return value
+
+
 class Diamond(Base):
     __tablename__ = 'diamonds'
 
@@ -53,16 +68,43 @@ class Diamond(Base):
     price_per_carat: Mapped[int] = mapped_column(BigInteger, nullable=True)
     picture: Mapped[str] = mapped_column(nullable=True)
 
-    __table_args__ = (UniqueConstraint('stock', 'shape', 'weight', 'color', 'clarity', 'lab',
-                                       'certificate_number', 'length', 'width', 'depth', 'ratio', 'cut', 'polish',
-                                       'symmetry', 'fluorescence', 'table', 'depth_percentage', 'gridle', 'culet'),)
+    identity_hash: Mapped[UUID] = mapped_column(Uuid, nullable=False, server_default=FetchedValue())
+
+    # Denormalized from the properties tables by the triggers from database/migrations.py
+    color_index: Mapped[int] = mapped_column(SmallInteger, nullable=False, server_default=FetchedValue())
+    color_group: Mapped[int] = mapped_column(SmallInteger, nullable=False, server_default=FetchedValue())
+    clarity_index: Mapped[int] = mapped_column(SmallInteger, nullable=False, server_default=FetchedValue())
+    clarity_group: Mapped[int] = mapped_column(SmallInteger, nullable=False, server_default=FetchedValue())
+    cut_index: Mapped[int] = mapped_column(SmallInteger, nullable=False, server_default=FetchedValue())
+    polish_index: Mapped[int] = mapped_column(SmallInteger, nullable=False, server_default=FetchedValue())
+    symmetry_index: Mapped[int] = mapped_column(SmallInteger, nullable=False, server_default=FetchedValue())
+
+    __table_args__ = (Index('ix_diamonds_identity_hash', 'identity_hash', unique=True),
+                      Index('ix_diamonds_pairs_search', 'shape', 'fluorescence', 'color_group', 'clarity_group',
+                            'weight'),
+                      Index('ix_diamonds_pairs_candidates', 'shape', 'fluorescence', 'weight'),
+                      Index('ix_diamonds_similar_search', 'shape', 'color_group', 'color_index', 'clarity_group',
+                            'clarity_index', 'weight'))
 
     @staticmethod
-    async def add_diamonds(session: AsyncSession, diamonds: list[dict[str, Any]]) -> list[int]:
+    async def add_diamonds(session: AsyncSession, diamonds: list[dict[str, Any]], commit: bool = True) -> list[int]:
+        """Upsert the diamonds and return their ids in the same order, COPY is used with asyncpg."""
         if any(not isinstance(diamond, dict) for diamond in diamonds):
             raise ValueError(
                 "All elements of diamonds should be of type dict with keys matching the Diamond model fields.")
 
+        if session.bind.dialect.driver == "asyncpg":
+            inserted_ids = await Diamond.copy_diamonds(session, diamonds)
+        else:
+            inserted_ids = await Diamond.insert_diamonds_one_by_one(session, diamonds)
+
+        if commit:
+            await session.commit()
+
+        return inserted_ids
+
+    @staticmethod
+    async def insert_diamonds_one_by_one(session: AsyncSession, diamonds: list[dict[str, Any]]) -> list[int]:
         inserted_ids = []
 
         for diamond in diamonds:
@@ -71,17 +113,8 @@ class Diamond(Base):
                 .values(diamond)
             )
             stmt = stmt.on_conflict_do_update(
-                index_elements=[
-                    'stock', 'shape', 'weight', 'color', 'clarity', 'lab',
-                    'certificate_number', 'length', 'width', 'depth', 'ratio', 'cut', 'polish',
-                    'symmetry', 'fluorescence', 'table', 'depth_percentage', 'gridle', 'culet'
-                ],
-                set_={
-                    'certificate_comment': stmt.excluded.certificate_comment,
-                    'rapnet': stmt.excluded.rapnet,
-                    'price_per_carat': stmt.excluded.price_per_carat,
-                    'picture': stmt.excluded.picture
-                }
+                index_elements=['identity_hash'],
+                set_={column: getattr(stmt.excluded, column) for column in DIAMOND_UPDATED_COLUMNS}
             ).returning(Diamond.id)
 
             try:
@@ -93,10 +126,58 @@ class Diamond(Base):
                 # Skip this diamond if there's a conflict or any other IntegrityError
                 continue
 
-        await session.commit()
-
         return inserted_ids
 
+    @staticmethod
+    async def copy_diamonds(session: AsyncSession, diamonds: list[dict[str, Any]]) -> list[int]:
+        """
+        Bulk upsert of insert_diamonds_one_by_one with a single round trip for the rows.
+
+        The rows are copied into a temporary staging table with their position, then upserted with one statement.
+        A statement can not update the same row twice, so the last of the equal rows is upserted, like in the loop,
+        and the ids are joined back to all the staged rows.
+        """
+        if len(diamonds) == 0:
+            return []
+
+        # The columns computed by the database are not staged
+        columns = [column.name for column in Diamond.__table__.columns
+                   if column.name != "id" and column.server_default is None]
+        records = []
+        for staging_position, diamond in enumerate(diamonds):
+            records.append((staging_position, *(get_copy_value(diamond.get(column)) for column in columns)))
+
+        quoted_columns = ", ".join(f'"{column}"' for column in columns)
+        quoted_unique_columns = ", ".join(f'"{column}"' for column in DIAMOND_UNIQUE_COLUMNS)
+        updated_columns = ", ".join(f'"{column}" = excluded."{column}"' for column in DIAMOND_UPDATED_COLUMNS)
+
+        connection = await session.connection()
+        try:
+            await connection.execute(text("DROP TABLE IF EXISTS pg_temp.diamonds_staging"))
+            await connection.execute(text(
+                f"CREATE TEMPORARY TABLE diamonds_staging ON COMMIT DROP AS "
+                f"SELECT 0 AS staging_position, {quoted_columns} FROM diamonds WITH NO DATA"
+            ))
+            raw_connection = await connection.get_raw_connection()
+            await raw_connection.driver_connection.copy_records_to_table(
+                "diamonds_staging", records=records, columns=["staging_position", *columns]
+            )
+            result = await connection.execute(text(
+                f"WITH upserted AS ("
+                f"INSERT INTO diamonds ({quoted_columns}) "
+                f"SELECT DISTINCT ON ({quoted_unique_columns}) {quoted_columns} FROM diamonds_staging "
+                f"ORDER BY {quoted_unique_columns}, staging_position DESC "
+                f"ON CONFLICT (identity_hash) DO UPDATE SET {updated_columns} "
+                f"RETURNING id, {quoted_unique_columns}) "
+                f"SELECT upserted.id FROM diamonds_staging JOIN upserted USING ({quoted_unique_columns}) "
+                f"ORDER BY diamonds_staging.staging_position"
+            ))
+        # The COPY runs on the driver connection, so its errors are not wrapped in DBAPIError
+        except (DBAPIError, PostgresError, InterfaceError):
+            logger.exception("Failed to copy diamonds")
+            raise DiamondAddError("Failed to copy diamonds")
+        return list(result.scalars().all())
+
     def __repr__(self):
         return f"<Diamond(stock={repr(self.stock)}, shape={repr(self.shape)}, weight={repr(self.weight)}, color={repr(self.color)}, " \
                f"clarity={repr(self.clarity)}, lab={repr(self.lab)}, certificate_number={repr(self.certificate_number)}, " \
@@ -151,193 +232,45 @@ class Diamond(Base):
         if len(extracted_diamonds) == 0:
             return []
 
-        queries = []
-
-        for diamond in extracted_diamonds:
-            current_stmt = (select(Diamond.id)
-                            .join(ColorProperties, Diamond.color == ColorProperties.color)
-                            .join(ClarityProperties, Diamond.clarity == ClarityProperties.clarity))
-            logger.debug("Initial statement: {}", current_stmt)
-            match diamond.color:
-                case Color() as color:
-                    logger.debug("Matched literal: {}", color)
-                    color_subquery = select(ColorProperties.index, ColorProperties.group).where(
-                        ColorProperties.color == color).limit(1).subquery()
-                    current_stmt = current_stmt.filter(
-                        ColorProperties.index.between(color_subquery.c.index - 1, color_subquery.c.index + 1))
-                    current_stmt = current_stmt.filter(ColorProperties.group == color_subquery.c.group)
-                    logger.debug("Statement after filtering color: {}", current_stmt)
-                case list() as colors:
-                    logger.debug("Matched list: {}", colors)
-                    filter_units = []
-                    for color in colors:
-                        match color:
-                            case Color():
-                                logger.debug("Matched color: {}", color)
-                                color_subquery = select(ColorProperties.index, ColorProperties.group).where(
-                                    ColorProperties.color == color).limit(1).subquery()
-                                current_stmt = current_stmt.filter(
-                                    ColorProperties.index.between(color_subquery.c.index - 1,
-                                                                  color_subquery.c.index + 1))
-                                filter_units.append(ColorProperties.index.between(color_subquery.c.index - 1,
-                                                                                  color_subquery.c.index + 1))
-                                filter_units.append(ColorProperties.group == color_subquery.c.group)
-                            case ValueRange(from_value=Color() | None as from_value,
-                                            to_value=Color() | None as to_value):
-                                logger.debug("Matched range: {} to {}", from_value, to_value)
-                                from_subquery = select(ColorProperties.index, ColorProperties.group).where(
-                                    ColorProperties.color == from_value).limit(1).subquery()
-                                to_subquery = select(ColorProperties.index, ColorProperties.group).where(
-                                    ColorProperties.color == to_value).limit(1).subquery()
-                                filter_units.append(ColorProperties.index.between(from_subquery.c.index - 1,
-                                                                                    to_subquery.c.index + 1))
-                                filter_units.append(ColorProperties.group == from_subquery.c.group)
-                    current_stmt = current_stmt.filter(or_(*filter_units))
-                    logger.debug("Statement after filtering color: {}", current_stmt)
-                case ValueRange(from_value=Color() as from_color, to_value=Color() as to_color):
-                    logger.debug("Matched range: {} to {}", from_color, to_color)
-                    from_subquery = select(ColorProperties.index, ColorProperties.group).where(
-                        ColorProperties.color == from_color).limit(1).subquery()
-                    to_subquery = select(ColorProperties.index, ColorProperties.group).where(
-                        ColorProperties.color == to_color).limit(1).subquery()
-                    current_stmt = current_stmt.filter(ColorProperties.index.between(from_subquery.c.index,
-                                                                                        to_subquery.c.index))
-                    current_stmt = current_stmt.filter(ColorProperties.group == from_subquery.c.group)
-                    logger.debug("Statement after filtering color: {}", current_stmt)
-                case None:
-                    logger.debug("Matched color None")
-                case _:
-                    logger.error("Matched unknown color: {}", diamond.color)
-
-            match diamond.clarity:
-                case Clarity() as clarity:
-                    logger.debug("Matched enum: {}", clarity)
-                    clarity_subquery = select(ClarityProperties.index, ClarityProperties.group).where(
-                        ClarityProperties.clarity == clarity).limit(1).subquery()
-                    current_stmt = current_stmt.filter(
-                        ClarityProperties.index.between(clarity_subquery.c.index - 1, clarity_subquery.c.index + 1))
-                    current_stmt = current_stmt.filter(ClarityProperties.group == clarity_subquery.c.group)
-                    logger.debug("Statement after filtering clarity: {}", current_stmt)
-                case list() as clarities:
-                    logger.debug("Matched list: {}", clarities)
-                    filter_units = []
-                    for clarity in clarities:
-                        match clarity:
-                            case Clarity():
-                                logger.debug("Matched clarity: {}", clarity)
-                                clarity_subquery = select(ClarityProperties.index, ClarityProperties.group).where(
-                                    ClarityProperties.clarity == clarity).limit(1).subquery()
-                                current_stmt = current_stmt.filter(
-                                    ClarityProperties.index.between(clarity_subquery.c.index - 1,
-                                                                   clarity_subquery.c.index + 1))
-                                filter_units.append(ClarityProperties.index.between(clarity_subquery.c.index - 1,
-                                                                                   clarity_subquery.c.index + 1))
-                                filter_units.append(ClarityProperties.group == clarity_subquery.c.group)
-                                logger.debug("Statement after filtering clarity: {}", current_stmt)
-                            case ValueRange(from_value=Clarity() | None as from_value,
-                                            to_value=Clarity() | None as to_value):
-                                logger.debug("Matched range: {} to {}", from_value, to_value)
-                                from_subquery = select(ClarityProperties.index, ClarityProperties.group).where(
-                                    ClarityProperties.clarity == from_value).limit(1).subquery()
-                                to_subquery = select(ClarityProperties.index, ClarityProperties.group).where(
-                                    ClarityProperties.clarity == to_value).limit(1).subquery()
-                                filter_units.append(ClarityProperties.index.between(from_subquery.c.index,
-                                                                                      to_subquery.c.index))
-                                filter_units.append(ClarityProperties.group == from_subquery.c.group)
-                                logger.debug("Statement after filtering clarity: {}", current_stmt)
-                    current_stmt = current_stmt.filter(or_(*filter_units))
-                    logger.debug("Statement after filtering clarity: {}", current_stmt)
-                case ValueRange(from_value=Clarity() | None as from_clarity, to_value=Clarity() | None as to_clarity):
-                    logger.debug("Matched single range: {} to {}", from_clarity, to_clarity)
-                    from_subquery = select(ClarityProperties.index, ClarityProperties.group).where(
-                        ClarityProperties.clarity == from_clarity).limit(1).subquery()
-                    to_subquery = select(ClarityProperties.index, ClarityProperties.group).where(
-                        ClarityProperties.clarity == to_clarity).limit(1).subquery()
-                    current_stmt = current_stmt.filter(ClarityProperties.index.between(from_subquery.c.index,
-                                                                                        to_subquery.c.index))
-                    current_stmt = current_stmt.filter(ClarityProperties.group == from_subquery.c.group)
-                    logger.debug("Statement after filtering clarity: {}", current_stmt)
-                case None:
-                    logger.debug("Matched clarity None")
-                case _:
-                    logger.error("Matched unknown clarity: {}", diamond.clarity)
-
-            match diamond.carat:
-                case float() | int() as carat:
-                    logger.debug("Matched float: {}", carat)
-                    current_stmt = current_stmt.filter(Diamond.weight.between(carat - 0.15, carat + 0.15))
-                    logger.debug("Statement after filtering carats: {}", current_stmt)
-                case list() as carats:
-                    logger.debug("Matched list: {}", carats)
-                    filter_units = []
-                    for carat in carats:
-                        match carat:
-                            case float() | int():
-                                logger.debug("Matched carat: {}", carat)
-                                filter_units.append(Diamond.weight.between(carat - 0.15, carat + 0.15))
-                            case ValueRange(from_value=float() | int() | None as from_value,
-                                            to_value=float() | int() | None as to_value):
-                                logger.debug("Matched range: {} to {}", from_value, to_value)
-                                filter_units.append(Diamond.weight.between(from_value, to_value))
-                    current_stmt = current_stmt.filter(or_(*filter_units))
-                    logger.debug("Statement after filtering carats: {}", current_stmt)
-                case ValueRange(from_value=float() | int() as from_carat, to_value=float() | int() as to_carat):
-                    logger.debug("Matched range: {} to {}", from_carat, to_carat)
-                    current_stmt = current_stmt.filter(Diamond.weight.between(from_carat, to_carat))
-                    logger.debug("Statement after filtering carats: {}", current_stmt)
-                case None:
-                    logger.debug("Matched carat None")
-                case _:
-                    logger.error("Matched unknown carats: {}", diamond.carat)
-
-            match diamond.shape:
-                case Shape() as shape:
-                    logger.debug("Matched shape: {}", shape)
-                    current_stmt = current_stmt.filter(Diamond.shape == shape)
-                    logger.debug("Statement after filtering shape: {}", current_stmt)
-                case list() as shapes:
-                    logger.debug("Matched list: {}", shapes)
-                    filter_units = []
-                    for shape in shapes:
-                        match shape:
-                            case Shape():
-                                filter_units.append(Diamond.shape == shape)
-                            case ValueRange(from_value=Shape() | None as from_value, to_value=Shape() | None as to_value):
-                                possible_shapes = []
-                                if from_value is not None:
-                                    possible_shapes.append(from_value)
-                                if to_value is not None:
-                                    possible_shapes.append(to_value)
-                                filter_units.append(Diamond.shape.in_(possible_shapes))
-                    current_stmt = current_stmt.filter(or_(*filter_units))
-                    logger.debug("Statement after filtering shape: {}", current_stmt)
-                case ValueRange(from_value=Shape() | None as from_shape, to_value=Shape() | None as to_shape):
-                    logger.debug("Matched range: {} to {}", from_shape, to_shape)
-                    possible_shapes = []
-                    if from_shape is not None:
-                        possible_shapes.append(from_shape)
-                    if to_shape is not None:
-                        possible_shapes.append(to_shape)
-                    current_stmt = current_stmt.filter(Diamond.shape.in_(possible_shapes))
-                    logger.debug("Statement after filtering shape: {}", current_stmt)
-                case None:
-                    logger.debug("Matched shape None")
-                case _:
-                    logger.error("Matched unknown shape: {}", diamond.shape)
-
-            queries.append(current_stmt)
-
-        stmt = union(*queries)
+        from .search_criteria import compile_similar_diamonds_query
+
+        stmt, parameters = compile_similar_diamonds_query(extracted_diamonds)
 
         logger.debug("Final statement: {}", stmt)
 
         try:
-            result = await session.execute(stmt)
+            result = await session.execute(stmt, parameters)
         except DBAPIError:
             logger.exception("Error executing statement.")
             raise DiamondSearchError("Error executing statement.")
         return list(result.scalars().all())
 
+    @classmethod
+    async def find_similar_diamonds_by_stone(cls, session: AsyncSession,
+                                             extracted_diamonds: list[ExtractedDiamond]) -> list[tuple[int, int]]:
+        """
+        Set-based find_similar_diamonds_ids, the criteria of all the stones are joined against the diamonds at once.
+
+        Returns the pairs of the requested stone number and the id of the diamond that matches it.
+        """
+        if len(extracted_diamonds) == 0:
+            return []
+
+        from .search_criteria import get_criteria_rows, get_criteria_parameters, similar_diamonds_by_stone_query
+
+        rows = get_criteria_rows(extracted_diamonds)
+        logger.debug("Searching similar diamonds for {} stones with {} criteria rows", len(extracted_diamonds),
+                     len(rows))
+        if len(rows) == 0:
+            return []
+
+        try:
+            result = await session.execute(similar_diamonds_by_stone_query, get_criteria_parameters(rows))
+        except DBAPIError:
+            logger.exception("Error executing statement.")
+            raise DiamondSearchError("Error executing statement.")
+        return [(stone, diamond_id) for stone, diamond_id in result.all()]
+
     @classmethod
     async def find_pairs_for_list(cls, session: AsyncSession, diamonds_ids: list[int]) -> list["Diamond"]:
         # weight_similar_diamonds = select(Diamond)
@@ -0,0 +1,204 @@
+from typing import Any, Callable
+
+from sqlalchemy import ForeignKey, BigInteger, Float, select, delete, exists, and_, or_, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Mapped, mapped_column, aliased
+
+from .base import Base
+from .diamond import Diamond
+from .diamond_owner import DiamondOwner
+
+# Key of the advisory lock which serializes the computations of the pairs
+DIAMOND_PAIRS_LOCK_KEY = 2
+
+
+class DiamondPair(Base):
+    """
+    Directed pairs of owned diamonds: pair_diamond_id is a pair for diamond_id.
+
+    Rows only depend on the stones themselves, the "pair must belong to another seller" rule is applied on read,
+    because the owners of a stone change without the stone being changed.
+    """
+    __tablename__ = 'diamond_pairs'
+
+    diamond_id: Mapped[int] = mapped_column(BigInteger, ForeignKey('diamonds.id'), primary_key=True)
+    pair_diamond_id: Mapped[int] = mapped_column(BigInteger, ForeignKey('diamonds.id'), primary_key=True,
+                                                 index=True)
+    score: Mapped[float] = mapped_column(nullable=False)
+
+    @staticmethod
+    def get_score(initial_diamond: Any, pair_diamond: Any):
+        """
+        Dissimilarity of the pair, the lower the better. Every relative delta of weight, length, table and depth is
+        normalized by the 1.5% tolerance, so a delta on the edge of the tolerance costs as much as one grade step.
+        """
+        def relative_delta(initial_value, pair_value):
+            return func.coalesce(func.abs(pair_value - initial_value, type_=Float)
+                                 / func.nullif(initial_value, 0, type_=Float), 0)
+
+        return (
+            (relative_delta(initial_diamond.weight, pair_diamond.weight)
+             + relative_delta(initial_diamond.length, pair_diamond.length)
+             + relative_delta(initial_diamond.table, pair_diamond.table)
+             + relative_delta(initial_diamond.depth_percentage, pair_diamond.depth_percentage)) / 0.015
+            + func.abs(pair_diamond.color_index - initial_diamond.color_index)
+            + func.abs(pair_diamond.clarity_index - initial_diamond.clarity_index)
+            + func.abs(pair_diamond.cut_index - initial_diamond.cut_index)
+            + func.abs(pair_diamond.polish_index - initial_diamond.polish_index)
+            + func.abs(pair_diamond.symmetry_index - initial_diamond.symmetry_index)
+        )
+
+    @staticmethod
+    def select_pairs(initial_filter: Callable[[Any], Any] | None = None,
+                     pair_filter: Callable[[Any], Any] | None = None):
+        initial_diamond = aliased(Diamond)
+        pair_diamond = aliased(Diamond)
+
+        filters = []
+        if initial_filter is not None:
+            filters.append(initial_filter(initial_diamond))
+        if pair_filter is not None:
+            filters.append(pair_filter(pair_diamond))
+
+        return (
+            select(initial_diamond.id, pair_diamond.id, DiamondPair.get_score(initial_diamond, pair_diamond))
+            .select_from(initial_diamond)
+            .join(pair_diamond, pair_diamond.id != initial_diamond.id)
+            .where(
+                and_(
+                    *filters,
+                    exists().where(DiamondOwner.diamond_id == initial_diamond.id),
+                    exists().where(DiamondOwner.diamond_id == pair_diamond.id),
+                    initial_diamond.shape == pair_diamond.shape,
+                    pair_diamond.weight.between(initial_diamond.weight * 0.985, initial_diamond.weight * 1.015),
+                    initial_diamond.color_index.between(pair_diamond.color_index - 1, pair_diamond.color_index + 1),
+                    initial_diamond.color_group == pair_diamond.color_group,
+                    initial_diamond.clarity_index.between(pair_diamond.clarity_index - 1,
+                                                          pair_diamond.clarity_index + 1),
+                    initial_diamond.clarity_group == pair_diamond.clarity_group,
+                    initial_diamond.length.between(pair_diamond.length * 0.985, pair_diamond.length * 1.015),
+                    initial_diamond.weight.between(pair_diamond.weight * 0.985, pair_diamond.weight * 1.015),
+                    initial_diamond.depth_percentage.between(pair_diamond.depth_percentage * 0.985,
+                                                             pair_diamond.depth_percentage * 1.015),
+                    initial_diamond.cut_index.between(pair_diamond.cut_index - 1, pair_diamond.cut_index + 1),
+                    initial_diamond.polish_index.between(pair_diamond.polish_index - 1,
+                                                         pair_diamond.polish_index + 1),
+                    initial_diamond.symmetry_index.between(pair_diamond.symmetry_index - 1,
+                                                           pair_diamond.symmetry_index + 1),
+                    initial_diamond.fluorescence == pair_diamond.fluorescence,
+                    pair_diamond.table.between(initial_diamond.table * 0.985, initial_diamond.table * 1.015),
+                    pair_diamond.depth_percentage.between(initial_diamond.depth_percentage * 0.985,
+                                                          initial_diamond.depth_percentage * 1.015),
+                )
+            )
+        )
+
+    @staticmethod
+    async def lock(session: AsyncSession) -> None:
+        """
+        Wait for the other computations of the pairs to be committed, the lock is held until the end of the transaction.
+
+        The pairs are computed by a statement of the uploader transaction, which does not see the owners added by the
+        concurrent uploads. With the lock taken before the owners are added, the later upload sees the earlier one.
+        """
+        await session.execute(select(func.pg_advisory_xact_lock(DIAMOND_PAIRS_LOCK_KEY)))
+
+    @classmethod
+    async def add_for_diamonds(cls, session: AsyncSession, diamonds_ids: list[int]) -> None:
+        """Add the pairs of the given diamonds in both directions. The caller is responsible for the commit."""
+        if not diamonds_ids:
+            return
+        for pairs_query in (cls.select_pairs(initial_filter=lambda diamond: diamond.id.in_(diamonds_ids)),
+                            cls.select_pairs(pair_filter=lambda diamond: diamond.id.in_(diamonds_ids))):
+            await session.execute(
+                insert(cls)
+                .from_select(["diamond_id", "pair_diamond_id", "score"], pairs_query)
+                .on_conflict_do_nothing()
+            )
+
+    @classmethod
+    async def add_for_all_diamonds(cls, session: AsyncSession) -> None:
+        await session.execute(
+            insert(cls)
+            .from_select(["diamond_id", "pair_diamond_id", "score"], cls.select_pairs())
+            .on_conflict_do_nothing()
+        )
+
+    @classmethod
+    async def delete_for_unowned_diamonds(cls, session: AsyncSession, diamonds_ids: list[int]) -> None:
+        """
+        Remove the pairs of the given diamonds that have no owners anymore. The caller is responsible for the commit.
+        """
+        if not diamonds_ids:
+            return
+        unowned_diamonds_ids = (
+            select(Diamond.id)
+            .where(
+                and_(
+                    Diamond.id.in_(diamonds_ids),
+                    ~exists().where(DiamondOwner.diamond_id == Diamond.id)
+                )
+            )
+        )
+        await session.execute(
+            delete(cls)
+            .where(
+                or_(
+                    cls.diamond_id.in_(unowned_diamonds_ids),
+                    cls.pair_diamond_id.in_(unowned_diamonds_ids)
+                )
+            )
+        )
+
+    @classmethod
+    async def is_empty(cls, session: AsyncSession) -> bool:
+        result = await session.execute(select(cls.diamond_id).limit(1))
+        return result.scalar_one_or_none() is None
+
+    @classmethod
+    async def get_pairs(cls, session: AsyncSession, diamonds_ids: list[int],
+                        limit_per_diamond: int | None = None) -> list[Diamond]:
+        """
+        Pairs of the given diamonds that belong to other users, the best first. With limit_per_diamond only that many
+        best pairs of every given diamond are returned.
+        """
+        initial_diamond_owner = aliased(DiamondOwner)
+        pair_diamond_owner = aliased(DiamondOwner)
+
+        ranked_pairs = (
+            select(
+                cls.pair_diamond_id,
+                cls.score,
+                func.row_number().over(partition_by=cls.diamond_id, order_by=cls.score).label("rank")
+            )
+            .where(
+                and_(
+                    cls.diamond_id.in_(diamonds_ids),
+                    exists()
+                    .where(
+                        and_(
+                            initial_diamond_owner.diamond_id == cls.diamond_id,
+                            pair_diamond_owner.diamond_id == cls.pair_diamond_id,
+                            initial_diamond_owner.user_id != pair_diamond_owner.user_id
+                        )
+                    )
+                )
+            )
+            .subquery()
+        )
+
+        query = (
+            select(Diamond)
+            .join(ranked_pairs, ranked_pairs.c.pair_diamond_id == Diamond.id)
+            .group_by(Diamond.id)
+            .order_by(func.min(ranked_pairs.c.score))
+        )
+        if limit_per_diamond is not None:
+            query = query.where(ranked_pairs.c.rank <= limit_per_diamond)
+        result = await session.execute(query)
+        return list(result.scalars().all())
+
+    def __repr__(self):
+        return f"<DiamondPair(diamond_id={repr(self.diamond_id)}, pair_diamond_id={repr(self.pair_diamond_id)}, " \
+               f"score={repr(self.score)})>"
@@ -0,0 +1,429 @@
+"""
+Compiles ExtractedDiamond criteria into the similar diamonds query.
+
+Compilation has two steps. get_criteria_plan turns a criteria into a signature and a list of values. The signature
+only describes the structure of the criteria (which criteria are single values, lists of what items or ranges), the
+grade ranks and groups are resolved from the grade table into plain integers and go to the values. The statement of a
+signature is built once by build_similar_diamonds_query and cached, the values are bound to its parameters in the order
+the plan lists them, so a repeated criteria structure costs neither the statement construction nor a new prepared
+statement.
+
+The set-based search flattens all the criteria into rows of plain ranges instead (see get_criteria_rows). The rows are
+sent as parallel arrays, unnested by the server and joined once against the diamonds, so the statement is the same for
+any number of requested stones.
+"""
+from functools import lru_cache
+from itertools import count, product
+from math import inf
+from typing import Any, Iterator, NamedTuple
+
+from loguru import logger
+from sqlalchemy import select, union, or_, and_, false, bindparam, BindParameter, column, func
+from sqlalchemy import Integer, SmallInteger, Float
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..defaults.grades import Grade, color_grades, clarity_grades
+from .clarity_properties import ClarityProperties
+from .color_properties import ColorProperties
+from .diamond import Diamond
+from .enums import Shape, Color, Clarity
+from .processing_types import ExtractedDiamond, ValueRange
+
+CARAT_TOLERANCE = 0.15
+STATEMENTS_CACHE_SIZE = 512
+
+# Bounds of the SMALLINT grade columns, used for the grade criteria that are not limited
+MIN_GRADE_INDEX = -2 ** 15
+MAX_GRADE_INDEX = 2 ** 15 - 1
+
+type CriterionSignature = tuple[str, ...]
+type CriteriaSignature = tuple[CriterionSignature, CriterionSignature, CriterionSignature, CriterionSignature]
+
+
+class GradeTable:
+    """Color and clarity ranks and groups, loaded from the properties tables at startup."""
+
+    def __init__(self):
+        self.colors: dict[Color, Grade] = {}
+        self.clarities: dict[Clarity, Grade] = {}
+
+    @property
+    def is_loaded(self) -> bool:
+        return bool(self.colors) and bool(self.clarities)
+
+    async def load(self, session: AsyncSession) -> None:
+        colors = (await session.execute(
+            select(ColorProperties.color, ColorProperties.index, ColorProperties.group))).all()
+        clarities = (await session.execute(
+            select(ClarityProperties.clarity, ClarityProperties.index, ClarityProperties.group))).all()
+        self.colors = {color: Grade(index, group) for color, index, group in colors}
+        self.clarities = {clarity: Grade(index, group) for clarity, index, group in clarities}
+        logger.info("Grade table was loaded with {} colors and {} clarities", len(self.colors), len(self.clarities))
+
+    def ensure_loaded(self) -> None:
+        if not self.is_loaded:
+            logger.warning("Grade table was not loaded, using the defaults")
+            self.colors = dict(color_grades)
+            self.clarities = dict(clarity_grades)
+
+    def get_color(self, color: Color) -> Grade:
+        self.ensure_loaded()
+        return self.colors[color]
+
+    def get_clarity(self, clarity: Clarity) -> Grade:
+        self.ensure_loaded()
+        return self.clarities[clarity]
+
+
+grade_table = GradeTable()
+
+
+def get_grade_plan(value: Any, grade_type: type[Color] | type[Clarity], get_grade,
+                   list_range_tolerance: int, open_range_matches_nothing: bool) -> tuple[CriterionSignature, list[Any]]:
+    match value:
+        case grade_type():
+            grade = get_grade(value)
+            return ("single",), [grade.index - 1, grade.index + 1, grade.group]
+        case list() as values:
+            signature, values_list = ["list"], []
+            for item in values:
+                match item:
+                    case grade_type():
+                        grade = get_grade(item)
+                        signature.append("value")
+                        values_list += [grade.index - 1, grade.index + 1, grade.group]
+                    case ValueRange(from_value=grade_type() as from_value, to_value=grade_type() as to_value):
+                        from_grade, to_grade = get_grade(from_value), get_grade(to_value)
+                        signature.append("range")
+                        values_list += [from_grade.index - list_range_tolerance,
+                                        to_grade.index + list_range_tolerance, from_grade.group]
+                    case ValueRange(from_value=grade_type() | None, to_value=grade_type() | None):
+                        # An open range has no grade to compare with, so nothing matches it
+                        signature.append("open")
+            return tuple(signature), values_list
+        case ValueRange(from_value=grade_type() as from_value, to_value=grade_type() as to_value):
+            from_grade, to_grade = get_grade(from_value), get_grade(to_value)
+            return ("range",), [from_grade.index, to_grade.index, from_grade.group]
+        case ValueRange(from_value=grade_type() | None, to_value=grade_type() | None) if open_range_matches_nothing:
+            return ("nothing",), []
+        case None:
+            return ("any",), []
+        case _:
+            logger.error("Matched unknown {}: {}", grade_type.__name__, value)
+            return ("any",), []
+
+
+def get_carat_plan(carat: Any) -> tuple[CriterionSignature, list[Any]]:
+    match carat:
+        case float() | int():
+            return ("single",), [carat - CARAT_TOLERANCE, carat + CARAT_TOLERANCE]
+        case list() as carats:
+            signature, values = ["list"], []
+            for item in carats:
+                match item:
+                    case float() | int():
+                        signature.append("value")
+                        values += [item - CARAT_TOLERANCE, item + CARAT_TOLERANCE]
+                    case ValueRange(from_value=float() | int() | None as from_value,
+                                    to_value=float() | int() | None as to_value):
+                        # A NULL bound matches nothing, as BETWEEN with NULL is never true
+                        signature.append("range")
+                        values += [from_value, to_value]
+            return tuple(signature), values
+        case ValueRange(from_value=float() | int() as from_carat, to_value=float() | int() as to_carat):
+            return ("range",), [from_carat, to_carat]
+        case None:
+            return ("any",), []
+        case _:
+            logger.error("Matched unknown carats: {}", carat)
+            return ("any",), []
+
+
+def get_shape_plan(shape: Any) -> tuple[CriterionSignature, list[Any]]:
+    match shape:
+        case Shape():
+            return ("single",), [shape]
+        case list() as shapes:
+            signature, values = ["list"], []
+            for item in shapes:
+                match item:
+                    case Shape():
+                        signature.append("value")
+                        values.append(item)
+                    case ValueRange(from_value=Shape() | None as from_value, to_value=Shape() | None as to_value):
+                        possible_shapes = [value for value in (from_value, to_value) if value is not None]
+                        signature.append(f"in{len(possible_shapes)}")
+                        values += possible_shapes
+            return tuple(signature), values
+        case ValueRange(from_value=Shape() | None as from_shape, to_value=Shape() | None as to_shape):
+            possible_shapes = [value for value in (from_shape, to_shape) if value is not None]
+            return (f"in{len(possible_shapes)}",), possible_shapes
+        case None:
+            return ("any",), []
+        case _:
+            logger.error("Matched unknown shape: {}", shape)
+            return ("any",), []
+
+
+def get_criteria_plan(diamond: ExtractedDiamond) -> tuple[CriteriaSignature, list[Any]]:
+    """Signature of the criteria and the values of its parameters, in the order build_criteria_filters binds them."""
+    color_signature, color_values = get_grade_plan(diamond.color, Color, grade_table.get_color,
+                                                   list_range_tolerance=1, open_range_matches_nothing=False)
+    clarity_signature, clarity_values = get_grade_plan(diamond.clarity, Clarity, grade_table.get_clarity,
+                                                       list_range_tolerance=0, open_range_matches_nothing=True)
+    carat_signature, carat_values = get_carat_plan(diamond.carat)
+    shape_signature, shape_values = get_shape_plan(diamond.shape)
+    return ((color_signature, clarity_signature, carat_signature, shape_signature),
+            color_values + clarity_values + carat_values + shape_values)
+
+
+def build_grade_filters(signature: CriterionSignature, index_column, group_column,
+                        parameters: Iterator[BindParameter]) -> list:
+    filters = []
+    match signature:
+        case ("single",) | ("range",):
+            from_index, to_index, group = next(parameters), next(parameters), next(parameters)
+            filters.append(index_column.between(from_index, to_index))
+            filters.append(group_column == group)
+        case ("list", *items):
+            units = []
+            for item in items:
+                match item:
+                    case "value":
+                        from_index, to_index, group = next(parameters), next(parameters), next(parameters)
+                        filters.append(index_column.between(from_index, to_index))
+                        units.append(index_column.between(from_index, to_index))
+                        units.append(group_column == group)
+                    case "range":
+                        from_index, to_index, group = next(parameters), next(parameters), next(parameters)
+                        units.append(index_column.between(from_index, to_index))
+                        units.append(group_column == group)
+                    case "open":
+                        filters.append(false())
+            if units:
+                filters.append(or_(*units))
+        case ("nothing",):
+            filters.append(false())
+    return filters
+
+
+def build_carat_filters(signature: CriterionSignature, parameters: Iterator[BindParameter]) -> list:
+    match signature:
+        case ("single",) | ("range",):
+            return [Diamond.weight.between(next(parameters), next(parameters))]
+        case ("list", *items) if items:
+            return [or_(*(Diamond.weight.between(next(parameters), next(parameters)) for _ in items))]
+    return []
+
+
+def build_shape_filters(signature: CriterionSignature, parameters: Iterator[BindParameter]) -> list:
+    def build_unit(item: str):
+        if item == "value":
+            return Diamond.shape == next(parameters)
+        possible_shapes_amount = int(item.removeprefix("in"))
+        if possible_shapes_amount == 0:
+            return false()
+        return or_(*(Diamond.shape == next(parameters) for _ in range(possible_shapes_amount)))
+
+    match signature:
+        case ("single",):
+            return [Diamond.shape == next(parameters)]
+        case ("list", *items) if items:
+            return [or_(*(build_unit(item) for item in items))]
+        case (item,) if item.startswith("in"):
+            return [build_unit(item)]
+    return []
+
+
+def build_criteria_filters(signature: CriteriaSignature, parameters: Iterator[BindParameter]) -> list:
+    color_signature, clarity_signature, carat_signature, shape_signature = signature
+    return [
+        *build_grade_filters(color_signature, Diamond.color_index, Diamond.color_group, parameters),
+        *build_grade_filters(clarity_signature, Diamond.clarity_index, Diamond.clarity_group, parameters),
+        *build_carat_filters(carat_signature, parameters),
+        *build_shape_filters(shape_signature, parameters),
+    ]
+
+
+def get_parameter_name(diamond_number: int, parameter_number: int) -> str:
+    return f"d{diamond_number}_p{parameter_number}"
+
+
+@lru_cache(maxsize=STATEMENTS_CACHE_SIZE)
+def build_similar_diamonds_query(signatures: tuple[CriteriaSignature, ...]):
+    queries = []
+    for diamond_number, signature in enumerate(signatures):
+        parameters = (bindparam(get_parameter_name(diamond_number, parameter_number))
+                      for parameter_number in count())
+        queries.append(select(Diamond.id).where(and_(*build_criteria_filters(signature, parameters))))
+    logger.debug("Similar diamonds query was built for signatures {}", signatures)
+    return union(*queries)
+
+
+def compile_similar_diamonds_query(extracted_diamonds: list[ExtractedDiamond]):
+    """Cached statement for the criteria and the values of its parameters."""
+    signatures, parameters = [], {}
+    for diamond_number, diamond in enumerate(extracted_diamonds):
+        signature, values = get_criteria_plan(diamond)
+        signatures.append(signature)
+        parameters.update({get_parameter_name(diamond_number, parameter_number): value
+                           for parameter_number, value in enumerate(values)})
+    return build_similar_diamonds_query(tuple(signatures)), parameters
+
+
+class GradeTerm(NamedTuple):
+    min_index: int
+    max_index: int
+    group: int | None
+
+
+class CriteriaRow(NamedTuple):
+    stone: int
+    shape: Shape | None
+    min_carat: float
+    max_carat: float
+    min_color: int
+    max_color: int
+    color_group: int | None
+    min_clarity: int
+    max_clarity: int
+    clarity_group: int | None
+
+
+def get_grade_terms(value: Any, grade_type: type[Color] | type[Clarity], get_grade,
+                    list_range_tolerance: int, open_range_matches_nothing: bool) -> list[GradeTerm]:
+    """
+    Grade criteria as alternatives of plain ranges, the same as build_grade_filters.
+
+    The filter of a list is the neighbourhoods of its single grades ANDed with a flat OR of the neighbourhoods and
+    groups of all of its items, so every OR unit becomes a term limited to the intersection of the neighbourhoods.
+    An empty list of terms matches nothing.
+    """
+    unlimited = GradeTerm(MIN_GRADE_INDEX, MAX_GRADE_INDEX, None)
+    match value:
+        case grade_type():
+            grade = get_grade(value)
+            return [GradeTerm(grade.index - 1, grade.index + 1, grade.group)]
+        case list() as values:
+            min_index, max_index = MIN_GRADE_INDEX, MAX_GRADE_INDEX
+            units: list[tuple[int, int] | int] = []
+            for item in values:
+                match item:
+                    case grade_type():
+                        grade = get_grade(item)
+                        min_index, max_index = max(min_index, grade.index - 1), min(max_index, grade.index + 1)
+                        units += [(grade.index - 1, grade.index + 1), grade.group]
+                    case ValueRange(from_value=grade_type() as from_value, to_value=grade_type() as to_value):
+                        from_grade, to_grade = get_grade(from_value), get_grade(to_value)
+                        units += [(from_grade.index - list_range_tolerance, to_grade.index + list_range_tolerance),
+                                  from_grade.group]
+                    case ValueRange(from_value=grade_type() | None, to_value=grade_type() | None):
+                        return []
+            if not units:
+                return [GradeTerm(min_index, max_index, None)]
+            terms = []
+            for unit in units:
+                match unit:
+                    case (from_index, to_index):
+                        terms.append(GradeTerm(max(min_index, from_index), min(max_index, to_index), None))
+                    case group:
+                        terms.append(GradeTerm(min_index, max_index, group))
+            return [term for term in terms if term.min_index <= term.max_index]
+        case ValueRange(from_value=grade_type() as from_value, to_value=grade_type() as to_value):
+            from_grade, to_grade = get_grade(from_value), get_grade(to_value)
+            return [GradeTerm(from_grade.index, to_grade.index, from_grade.group)]
+        case ValueRange(from_value=grade_type() | None, to_value=grade_type() | None) if open_range_matches_nothing:
+            return []
+        case None:
+            return [unlimited]
+        case _:
+            logger.error("Matched unknown {}: {}", grade_type.__name__, value)
+            return [unlimited]
+
+
+def get_carat_terms(carat: Any) -> list[tuple[float, float]]:
+    match carat:
+        case float() | int():
+            return [(carat - CARAT_TOLERANCE, carat + CARAT_TOLERANCE)]
+        case list() as carats:
+            terms, has_units = [], False
+            for item in carats:
+                match item:
+                    case float() | int():
+                        has_units = True
+                        terms.append((item - CARAT_TOLERANCE, item + CARAT_TOLERANCE))
+                    case ValueRange(from_value=float() | int() | None as from_value,
+                                    to_value=float() | int() | None as to_value):
+                        # A range with a missing bound matches nothing, as BETWEEN with NULL
+                        has_units = True
+                        if from_value is not None and to_value is not None:
+                            terms.append((from_value, to_value))
+            return terms if has_units else [(-inf, inf)]
+        case ValueRange(from_value=float() | int() as from_carat, to_value=float() | int() as to_carat):
+            return [(from_carat, to_carat)]
+        case None:
+            return [(-inf, inf)]
+        case _:
+            logger.error("Matched unknown carats: {}", carat)
+            return [(-inf, inf)]
+
+
+def get_shape_terms(shape: Any) -> list[Shape | None]:
+    """Allowed shapes, None allows any shape."""
+    signature, shapes = get_shape_plan(shape)
+    if signature == ("any",) or signature == ("list",):
+        return [None]
+    return list(dict.fromkeys(shapes))
+
+
+def get_criteria_rows(extracted_diamonds: list[ExtractedDiamond]) -> list[CriteriaRow]:
+    """Alternatives of plain ranges of every requested stone, a diamond matches a stone if it satisfies any of them."""
+    rows = []
+    for stone, diamond in enumerate(extracted_diamonds):
+        color_terms = get_grade_terms(diamond.color, Color, grade_table.get_color,
+                                      list_range_tolerance=1, open_range_matches_nothing=False)
+        clarity_terms = get_grade_terms(diamond.clarity, Clarity, grade_table.get_clarity,
+                                        list_range_tolerance=0, open_range_matches_nothing=True)
+        carat_terms = get_carat_terms(diamond.carat)
+        shape_terms = get_shape_terms(diamond.shape)
+        for shape, (min_carat, max_carat), color, clarity in product(shape_terms, carat_terms, color_terms,
+                                                                      clarity_terms):
+            rows.append(CriteriaRow(stone, shape, min_carat, max_carat, *color, *clarity))
+    return rows
+
+
+criteria_columns = {
+    "stone": Integer,
+    "shape": Diamond.__table__.c.shape.type,
+    "min_carat": Float,
+    "max_carat": Float,
+    "min_color": SmallInteger,
+    "max_color": SmallInteger,
+    "color_group": SmallInteger,
+    "min_clarity": SmallInteger,
+    "max_clarity": SmallInteger,
+    "clarity_group": SmallInteger,
+}
+
+criteria = func.unnest(
+    *(bindparam(name, type_=ARRAY(column_type)) for name, column_type in criteria_columns.items())
+).table_valued(*(column(name, column_type) for name, column_type in criteria_columns.items()), name="criteria")
+
+similar_diamonds_by_stone_query = (
+    select(criteria.c.stone, Diamond.id)
+    .join_from(criteria, Diamond, and_(
+        or_(criteria.c.shape.is_(None), Diamond.shape == criteria.c.shape),
+        Diamond.weight.between(criteria.c.min_carat, criteria.c.max_carat),
+        Diamond.color_index.between(criteria.c.min_color, criteria.c.max_color),
+        or_(criteria.c.color_group.is_(None), Diamond.color_group == criteria.c.color_group),
+        Diamond.clarity_index.between(criteria.c.min_clarity, criteria.c.max_clarity),
+        or_(criteria.c.clarity_group.is_(None), Diamond.clarity_group == criteria.c.clarity_group),
+    ))
+    .distinct()
+)
+
+
+def get_criteria_parameters(rows: list[CriteriaRow]) -> dict[str, list[Any]]:
+    """Parallel arrays of the criteria rows for similar_diamonds_by_stone_query."""
+    return {name: [getattr(row, name) for row in rows] for name in criteria_columns}
@@ -0,0 +1,58 @@
+from datetime import datetime
+
+from sqlalchemy import ForeignKey, BigInteger, String, Enum as SQLAlchemyEnum, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Mapped, mapped_column
+
+from .base import Base
+from .enums import UploadJobStatus
+
+
+class UploadJob(Base):
+    """
+    Upload of a stock file processed in the background, kept until it is finished to be resumed after a restart.
+
+    The rows of a regular upload are committed chunk by chunk together with processed_rows, so a resumed job skips the
+    rows that were already added.
+    """
+    __tablename__ = 'upload_jobs'
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    user_id: Mapped[int] = mapped_column(BigInteger, ForeignKey('users.id'), nullable=False)
+    # Telegram file id, the file is downloaded again if the job is resumed on another machine
+    file_id: Mapped[str] = mapped_column(nullable=False)
+    file_type: Mapped[str] = mapped_column(String(8), nullable=False)
+    full_sync: Mapped[bool] = mapped_column(nullable=False)
+    progress_message_id: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
+    status: Mapped[UploadJobStatus] = mapped_column(SQLAlchemyEnum(UploadJobStatus), nullable=False)
+    total_rows: Mapped[int | None] = mapped_column(nullable=True)
+    processed_rows: Mapped[int] = mapped_column(nullable=False, default=0)
+    upload_date: Mapped[datetime] = mapped_column(nullable=False)
+
+    @classmethod
+    async def create(cls, session: AsyncSession, user_id: int, file_id: str, file_type: str, full_sync: bool,
+                     progress_message_id: int | None) -> "UploadJob":
+        upload_job = UploadJob(user_id=user_id, file_id=file_id, file_type=file_type, full_sync=full_sync,
+                               progress_message_id=progress_message_id, status=UploadJobStatus.PENDING,
+                               processed_rows=0, upload_date=datetime.now())
+        session.add(upload_job)
+        await session.commit()
+        return upload_job
+
+    @classmethod
+    async def get_unfinished_ids(cls, session: AsyncSession) -> list[int]:
+        query = (
+            select(cls.id)
+            .where(cls.status.in_([UploadJobStatus.PENDING, UploadJobStatus.RUNNING]))
+            .order_by(cls.id)
+        )
+        return list((await session.execute(query)).scalars().all())
+
+    @classmethod
+    async def update_progress(cls, session: AsyncSession, upload_job_id: int, **values) -> None:
+        """Update the job columns, the caller is responsible for the commit."""
+        await session.execute(update(cls).where(cls.id == upload_job_id).values(**values))
+
+    def __repr__(self):
+        return (f"<UploadJob(id={repr(self.id)}, user_id={repr(self.user_id)}, status={repr(self.status)}, "
+                f"processed_rows={repr(self.processed_rows)}, total_rows={repr(self.total_rows)})>")
@@ -0,0 +1,165 @@
+import asyncio
+import json
+from abc import ABC, abstractmethod
+from typing import Any, Optional
+
+from loguru import logger
+
+from ..core import openai_client
+from ..core.config import EXTRACTION_BACKEND, JSON_EXTRACTOR_ASSISTANT_ID, JSON_EXTRACTOR_MODEL
+from ..database.models.enums import Shape, color_aliases, clarity_aliases
+
+
+class ExtractionFailed(Exception):
+    pass
+
+
+class UnknownExtractionBackend(Exception):
+    pass
+
+
+class ExtractionBackend(ABC):
+    """Extracts the raw diamonds list, the "diamonds" of {"diamonds": [...]}, from a message."""
+
+    @abstractmethod
+    async def extract(self, message: str) -> Optional[list[dict[str, Any]]]:
+        """None if the message does not request diamonds, ExtractionFailed is raised if the answer is missing."""
+        ...
+
+
+class AssistantExtractionBackend(ExtractionBackend):
+    """Runs the JSON extractor assistant in a new thread, four requests and the polling of the run."""
+
+    def __init__(self, assistant_id: str):
+        self.assistant_id = assistant_id
+        # Keeps references to the deletions of the threads, otherwise the tasks may be garbage collected
+        self.deleting_threads: set[asyncio.Task] = set()
+
+    async def extract(self, message: str) -> Optional[list[dict[str, Any]]]:
+        logger.info("Creating a new thread for JSON extraction AI model")
+        thread = await openai_client.beta.threads.create()
+        try:
+            logger.info("Sending a message to the AI model")
+            await openai_client.beta.threads.messages.create(
+                thread_id=thread.id,
+                role="user",
+                content=message,
+            )
+
+            logger.info("Running the AI model")
+            run = await openai_client.beta.threads.runs.create_and_poll(
+                thread_id=thread.id,
+                assistant_id=self.assistant_id,
+            )
+
+            logger.info("Getting the messages from the AI model")
+            messages = await openai_client.beta.threads.messages.list(thread_id=thread.id, run_id=run.id)
+        finally:
+            self.delete_thread(thread.id)
+
+        try:
+            return json.loads(messages.data[0].content[0].text.value).get("diamonds")
+        except json.JSONDecodeError:
+            raise ExtractionFailed("The AI model answer is not a valid JSON")
+        except IndexError:
+            raise ExtractionFailed("The AI model did not answer")
+
+    def delete_thread(self, thread_id: str) -> None:
+        task = asyncio.create_task(openai_client.beta.threads.delete(thread_id))
+        self.deleting_threads.add(task)
+        task.add_done_callback(self.deleting_threads.discard)
+
+
+EXTRACTION_INSTRUCTIONS = """\
+You extract the diamonds requested in a message of diamonds traders.
+Answer with one item of "diamonds" per requested stone, or with null "diamonds" if the message does not request \
+diamonds.
+Every item has the shape, carat, color and clarity of the stone. Each of them is null if it is not mentioned, a single \
+value, a range with "from" and "to" (like "F-H" or "1-1.5ct", a missing end is null), or a list of values and ranges if \
+several of them are acceptable.
+The carat is a number, "RB" and "round" are the round brilliant shape."""
+
+
+def get_nullable_schema(schema: dict[str, Any]) -> dict[str, Any]:
+    return {"anyOf": [schema, {"type": "null"}]}
+
+
+def get_criterion_schema(value_schema: dict[str, Any]) -> dict[str, Any]:
+    """A value, a range or a list of them, like ExtractedDiamond.from_dict reads them."""
+    range_schema = {
+        "type": "object",
+        "properties": {"from": get_nullable_schema(value_schema), "to": get_nullable_schema(value_schema)},
+        "required": ["from", "to"],
+        "additionalProperties": False,
+    }
+    return {"anyOf": [
+        {"type": "null"},
+        value_schema,
+        range_schema,
+        {"type": "array", "items": {"anyOf": [value_schema, range_schema]}},
+    ]}
+
+
+DIAMONDS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "diamonds": get_nullable_schema({
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "shape": get_criterion_schema({"type": "string", "enum": [shape.value for shape in Shape]}),
+                    "carat": get_criterion_schema({"type": "number"}),
+                    "color": get_criterion_schema({"type": "string", "enum": list(color_aliases.keys())}),
+                    "clarity": get_criterion_schema({"type": "string", "enum": list(clarity_aliases.keys())}),
+                },
+                "required": ["shape", "carat", "color", "clarity"],
+                "additionalProperties": False,
+            },
+        }),
+    },
+    "required": ["diamonds"],
+    "additionalProperties": False,
+}
+
+
+class ChatCompletionExtractionBackend(ExtractionBackend):
+    """A single chat completion, its answer is constrained to DIAMONDS_SCHEMA by the structured outputs."""
+
+    def __init__(self, model: str):
+        self.model = model
+
+    async def extract(self, message: str) -> Optional[list[dict[str, Any]]]:
+        logger.info("Requesting the JSON extraction from the {} model", self.model)
+        response = await openai_client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": EXTRACTION_INSTRUCTIONS},
+                {"role": "user", "content": message},
+            ],
+            response_format={
+                "type": "json_schema",
+                "json_schema": {"name": "diamonds", "strict": True, "schema": DIAMONDS_SCHEMA},
+            },
+            temperature=0,
+        )
+
+        choice = response.choices[0]
+        # A refusal has no content, a truncated answer is not a valid JSON
+        if choice.message.content is None or choice.finish_reason != "stop":
+            raise ExtractionFailed(f"The AI model did not answer, finish reason: {choice.finish_reason}")
+        try:
+            return json.loads(choice.message.content).get("diamonds")
+        except json.JSONDecodeError:
+            raise ExtractionFailed("The AI model answer is not a valid JSON")
+
+
+def get_extraction_backend(name: str) -> ExtractionBackend:
+    if name == "assistant":
+        return AssistantExtractionBackend(JSON_EXTRACTOR_ASSISTANT_ID)
+    if name == "chat":
+        return ChatCompletionExtractionBackend(JSON_EXTRACTOR_MODEL)
+    raise UnknownExtractionBackend(f"Unknown extraction backend: {name}")
+
+
+extraction_backend = get_extraction_backend(EXTRACTION_BACKEND)
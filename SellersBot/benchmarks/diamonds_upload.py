@@ -0,0 +1,97 @@
+"""
+Compares the row by row and the COPY upserts of Diamond.add_diamonds.
+
+Uses the same "<db_name>_benchmark" database as benchmarks.pairs_search, every run is rolled back.
+Run from the SellersBot directory with the usual environment variables set:
+
+    python -m benchmarks.diamonds_upload --upload 3000
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from typing import Any, Awaitable, Callable
+
+from loguru import logger
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.database.loader import get_engine, get_sessionmaker
+from src.database.models import Diamond
+from .pairs_search import async_benchmark_url, generate_diamond, prepare_database
+
+type DiamondsUpsert = Callable[[AsyncSession, list[dict[str, Any]]], Awaitable[list[int]]]
+
+upserts: dict[str, DiamondsUpsert] = {
+    "loop": Diamond.insert_diamonds_one_by_one,
+    "copy": Diamond.copy_diamonds,
+}
+
+
+def generate_upload(upload_size: int, existing_diamonds: list[dict[str, Any]], rng: random.Random) \
+        -> list[dict[str, Any]]:
+    """New diamonds mixed with the already uploaded ones, which are updated by the upsert."""
+    existing_amount = min(len(existing_diamonds), upload_size // 2)
+    upload = [diamond | {'price_per_carat': rng.randint(1000, 20000)}
+              for diamond in rng.sample(existing_diamonds, existing_amount)]
+    upload += [generate_diamond(number, rng) | {'stock': f"UPLOAD-{number}"}
+               for number in range(upload_size - existing_amount)]
+    rng.shuffle(upload)
+    return upload
+
+
+async def run_benchmark(upload_size: int, repeat: int, rng: random.Random) -> None:
+    engine = get_engine(async_url=async_benchmark_url)
+    sessionmaker = get_sessionmaker(engine)
+
+    async with sessionmaker() as session:
+        existing_diamonds = [
+            {column.name: getattr(diamond, column.key) for column in Diamond.__table__.columns
+             if column.name not in ("id", "identity_hash")}
+            for diamond in (await session.execute(select(Diamond).limit(upload_size))).scalars()
+        ]
+    upload = generate_upload(upload_size, existing_diamonds, rng)
+    logger.info("Upserting {} diamonds", len(upload))
+
+    for name, upsert in upserts.items():
+        timings = []
+        for _ in range(repeat):
+            async with sessionmaker() as session:
+                started_at = time.perf_counter()
+                await upsert(session, upload)
+                timings.append(time.perf_counter() - started_at)
+                await session.rollback()
+        logger.info("{:>5}: min {:.3f}s, median {:.3f}s over {} runs", name, min(timings),
+                    statistics.median(timings), repeat)
+
+    # The second upsert of the same upload only updates, so it must return the ids of the first one
+    for first_name, second_name in (("copy", "loop"), ("loop", "copy")):
+        async with sessionmaker() as session:
+            first_ids = await upserts[first_name](session, upload)
+            second_ids = await upserts[second_name](session, upload)
+            await session.rollback()
+        if first_ids != second_ids:
+            logger.error("{} returned different ids than {}", second_name, first_name)
+        else:
+            logger.success("{} returned the same ids as {}", second_name, first_name)
+
+    await engine.dispose()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--diamonds", type=int, default=100_000, help="size of the synthetic inventory")
+    parser.add_argument("--users", type=int, default=200, help="number of sellers owning the inventory")
+    parser.add_argument("--upload", type=int, default=3000, help="number of upserted diamonds")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of every upsert")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    await prepare_database(args.diamonds, args.users, rng)
+    await run_benchmark(args.upload, args.repeat, rng)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
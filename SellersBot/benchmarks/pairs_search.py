@@ -0,0 +1,193 @@
+"""
+Compares the pair search queries on a synthetic inventory.
+
+The inventory is generated in a separate "<db_name>_benchmark" database, so the bot database is never touched.
+Run from the SellersBot directory with the usual environment variables set:
+
+    python -m benchmarks.pairs_search --diamonds 500000
+
+Besides the timings, the found pairs of the searches are compared, also on the diamonds with several owners, whose
+best pairs must not be cut off per owner.
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable
+
+from loguru import logger
+from sqlalchemy import select, func, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy_utils import database_exists, create_database
+
+from src.core.config import DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_NAME, PAIRS_TOP_K
+from src.database.defaults import add_all_defaults
+from src.database.loader import get_engine, get_sessionmaker, apply_migrations
+from src.database.models import Diamond, DiamondOwner, User, ColorProperties
+from src.database.models.enums import Shape, Color, Clarity, Quality, Fluorescence, Culet
+from src.services.find_pairs import find_pairs_for_diamonds_with_sql, find_pairs_for_diamonds_with_lateral
+
+BENCHMARK_DB_NAME = f"{DB_NAME}_benchmark"
+sync_benchmark_url = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{BENCHMARK_DB_NAME}"
+async_benchmark_url = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{BENCHMARK_DB_NAME}"
+
+INSERT_CHUNK_SIZE = 1000
+# Share of the seeded diamonds uploaded by a second seller too
+MULTIPLE_OWNERS_SHARE = 0.05
+
+type PairsSearch = Callable[[AsyncSession, list[int], int | None], Awaitable[list[Diamond]]]
+
+searches: dict[str, PairsSearch] = {
+    "sql": find_pairs_for_diamonds_with_sql,
+    "lateral": find_pairs_for_diamonds_with_lateral,
+}
+
+
+def generate_diamond(number: int, rng: random.Random) -> dict[str, Any]:
+    weight = round(rng.lognormvariate(0, 0.5), 2)
+    length = round(6.4 * weight ** (1 / 3) * rng.uniform(0.98, 1.02), 2)
+    width = round(length * rng.uniform(0.98, 1.0), 2)
+    depth = round(length * rng.uniform(0.6, 0.63), 2)
+    return {
+        'stock': f"BENCH-{number}",
+        'shape': rng.choice(list(Shape)),
+        'weight': weight,
+        'color': rng.choice(list(Color)),
+        'clarity': rng.choice(list(Clarity)),
+        'lab': "GIA",
+        'certificate_number': number,
+        'length': length,
+        'width': width,
+        'depth': depth,
+        'ratio': round(length / width, 2),
+        'cut': rng.choice(list(Quality)),
+        'polish': rng.choice(list(Quality)),
+        'symmetry': rng.choice(list(Quality)),
+        'fluorescence': rng.choice(list(Fluorescence)),
+        'table': round(rng.uniform(53, 62), 1),
+        'depth_percentage': round(rng.uniform(58, 66), 1),
+        'gridle': "MED",
+        'culet': rng.choice(list(Culet)),
+        'certificate_comment': None,
+        'rapnet': None,
+        'price_per_carat': None,
+        'picture': None,
+    }
+
+
+async def prepare_database(diamonds_count: int, users_count: int, rng: random.Random) -> None:
+    if not database_exists(sync_benchmark_url):
+        logger.info("Creating benchmark database {}", BENCHMARK_DB_NAME)
+        create_database(sync_benchmark_url)
+
+    engine = get_engine(async_url=async_benchmark_url)
+    async with engine.begin() as conn:
+        await apply_migrations(conn)
+
+    sessionmaker = get_sessionmaker(engine)
+    async with sessionmaker() as session:
+        existing_diamonds_count = (await session.execute(select(func.count(Diamond.id)))).scalar_one()
+        if existing_diamonds_count >= diamonds_count:
+            logger.info("Benchmark database already has {} diamonds", existing_diamonds_count)
+            await engine.dispose()
+            return
+
+        logger.info("Seeding {} diamonds owned by {} users", diamonds_count - existing_diamonds_count, users_count)
+        if (await session.execute(select(func.count(ColorProperties.color)))).scalar_one() == 0:
+            await add_all_defaults(session)
+        await session.execute(
+            insert(User)
+            .values([{"id": user_id, "language_code": "en"} for user_id in range(1, users_count + 1)])
+            .on_conflict_do_nothing()
+        )
+
+        upload_date = datetime.now()
+        for chunk_start in range(existing_diamonds_count, diamonds_count, INSERT_CHUNK_SIZE):
+            chunk_stop = min(chunk_start + INSERT_CHUNK_SIZE, diamonds_count)
+            diamonds = [generate_diamond(number, rng) for number in range(chunk_start, chunk_stop)]
+            result = await session.execute(insert(Diamond).values(diamonds).returning(Diamond.id))
+            owners = []
+            for diamond_id in result.scalars().all():
+                user_id = rng.randint(1, users_count)
+                owners.append({"user_id": user_id, "diamond_id": diamond_id, "upload_date": upload_date})
+                if users_count > 1 and rng.random() < MULTIPLE_OWNERS_SHARE:
+                    owners.append({"user_id": user_id % users_count + 1, "diamond_id": diamond_id,
+                                   "upload_date": upload_date})
+            await session.execute(insert(DiamondOwner).values(owners))
+            await session.commit()
+            logger.debug("Seeded {} diamonds", chunk_stop)
+
+    async with engine.begin() as conn:
+        await conn.execute(text("ANALYZE"))
+    await engine.dispose()
+
+
+async def compare_searches(session: AsyncSession, diamonds_ids: list[int], limit_per_diamond: int | None,
+                           repeat: int) -> None:
+    found_ids: dict[str, set[int]] = {}
+    for name, search in searches.items():
+        timings = []
+        for _ in range(repeat):
+            started_at = time.perf_counter()
+            pairs = await search(session, diamonds_ids, limit_per_diamond)
+            timings.append(time.perf_counter() - started_at)
+        found_ids[name] = {pair.id for pair in pairs}
+        logger.info("{:>8}: {} pairs, min {:.3f}s, median {:.3f}s over {} runs", name, len(found_ids[name]),
+                    min(timings), statistics.median(timings), repeat)
+
+    if len({frozenset(ids) for ids in found_ids.values()}) > 1:
+        logger.error("The searches found different pairs")
+    else:
+        logger.success("All searches found the same pairs")
+
+
+async def run_benchmark(upload_size: int, limit_per_diamond: int | None, repeat: int, rng: random.Random) -> None:
+    engine = get_engine(async_url=async_benchmark_url)
+    sessionmaker = get_sessionmaker(engine)
+
+    async with sessionmaker() as session:
+        user_id = (await session.execute(select(DiamondOwner.user_id).limit(1))).scalar_one()
+        user_diamonds_ids = list((await session.execute(
+            select(DiamondOwner.diamond_id).where(DiamondOwner.user_id == user_id)
+        )).scalars().all())
+        uploaded_diamonds_ids = rng.sample(user_diamonds_ids, min(upload_size, len(user_diamonds_ids)))
+        logger.info("Searching the best {} pairs for {} diamonds of user {}", limit_per_diamond,
+                    len(uploaded_diamonds_ids), user_id)
+        await compare_searches(session, uploaded_diamonds_ids, limit_per_diamond, repeat)
+
+        multiple_owners_diamonds_ids = list((await session.execute(
+            select(DiamondOwner.diamond_id)
+            .group_by(DiamondOwner.diamond_id)
+            .having(func.count(DiamondOwner.user_id) > 1)
+            .limit(upload_size)
+        )).scalars().all())
+        if multiple_owners_diamonds_ids:
+            logger.info("Searching the best {} pairs for {} diamonds with several owners", limit_per_diamond,
+                        len(multiple_owners_diamonds_ids))
+            await compare_searches(session, multiple_owners_diamonds_ids, limit_per_diamond, repeat)
+        else:
+            logger.warning("No diamonds with several owners, seed a new benchmark database to compare them")
+
+    await engine.dispose()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--diamonds", type=int, default=500_000, help="size of the synthetic inventory")
+    parser.add_argument("--users", type=int, default=200, help="number of sellers owning the inventory")
+    parser.add_argument("--upload", type=int, default=1000, help="number of diamonds to search pairs for")
+    parser.add_argument("--top-k", type=int, default=PAIRS_TOP_K, help="best pairs of every diamond, 0 for all")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of every search")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    await prepare_database(args.diamonds, args.users, rng)
+    await run_benchmark(args.upload, args.top_k or None, args.repeat, rng)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,77 @@
+"""
+Measures the coverage of the local diamonds query parser and its agreement with the labelled corpus.
+
+The corpus lists the messages with the diamonds the AI model is expected to extract, in its JSON format. With --ai the
+messages are also sent to the extraction backend, so the parser is compared with the actual AI model answers.
+Run from the SellersBot directory with the usual environment variables set:
+
+    python -m benchmarks.query_parser --ai
+"""
+import argparse
+import asyncio
+import json
+from pathlib import Path
+from typing import Any, Optional
+
+from loguru import logger
+
+from src.database.models.processing_types import ExtractedDiamond
+from src.services.query_parser import parse_diamonds_query
+
+CORPUS_PATH = Path(__file__).parent / "queries_corpus.json"
+
+
+def get_expected_diamonds(raw_diamonds_list: Optional[list[dict[str, Any]]]) -> Optional[list[ExtractedDiamond]]:
+    if raw_diamonds_list is None:
+        return None
+    return list(map(ExtractedDiamond.from_dict, raw_diamonds_list))
+
+
+def get_agreement(parsed: dict[str, list[ExtractedDiamond]], reference: dict[str, Optional[list[ExtractedDiamond]]]) \
+        -> tuple[int, list[str]]:
+    """Number of the parsed messages with the same diamonds as the reference, and the other parsed messages."""
+    disagreements = [message for message, diamonds in parsed.items() if diamonds != reference[message]]
+    return len(parsed) - len(disagreements), disagreements
+
+
+async def get_ai_diamonds(messages: list[str]) -> dict[str, Optional[list[ExtractedDiamond]]]:
+    # The extraction cache is bypassed, the actual answers of the AI model are compared
+    from src.services.extraction_backends import extraction_backend
+
+    ai_diamonds = {}
+    for message in messages:
+        ai_diamonds[message] = get_expected_diamonds(await extraction_backend.extract(message))
+    return ai_diamonds
+
+
+def report_agreement(name: str, parsed: dict[str, list[ExtractedDiamond]],
+                     reference: dict[str, Optional[list[ExtractedDiamond]]]) -> None:
+    agreed_amount, disagreements = get_agreement(parsed, reference)
+    logger.info("Agreement with {}: {}/{} parsed messages", name, agreed_amount, len(parsed))
+    for message in disagreements:
+        logger.warning("{!r}: parsed {}, {} {}", message, parsed[message], name, reference[message])
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", type=Path, default=CORPUS_PATH, help="JSON list of messages and their diamonds")
+    parser.add_argument("--ai", action="store_true", help="compare with the answers of the extraction backend")
+    args = parser.parse_args()
+
+    corpus = json.loads(args.corpus.read_text())
+    labels = {item["message"]: get_expected_diamonds(item["diamonds"]) for item in corpus}
+    parsed = {message: diamonds for message in labels
+              if (diamonds := parse_diamonds_query(message)) is not None}
+
+    logger.info("Coverage: {}/{} messages were parsed ({:.0%})", len(parsed), len(labels), len(parsed) / len(labels))
+    report_agreement("labels", parsed, labels)
+
+    if args.ai:
+        ai_diamonds = await get_ai_diamonds(list(labels))
+        report_agreement("AI model", parsed, ai_diamonds)
+        agreed_amount = sum(ai_diamonds[message] == diamonds for message, diamonds in labels.items())
+        logger.info("Agreement of the AI model with labels: {}/{} messages", agreed_amount, len(labels))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
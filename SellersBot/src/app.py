@@ -10,6 +10,16 @@ from .handlers import dp
 import asyncio
 from loguru import logger
 from .core import bot
+from .core.config import SIMILAR_DIAMONDS_SEARCH_ENGINE, PAIRS_SEARCH_ENGINE
+from .database.loader import sessionmaker
+from .database.models.search_criteria import grade_table
+from .services.inventory_index import inventory_index_holder
+from .services.pairs_index import pairs_index_holder
+from .services.ai_json_extraction import extract_diamonds_from_message_with_ai
+from .services.extraction_cache import extraction_cache
+from .services.extraction_gateway import extraction_gateway
+from .services.search_cache import search_results_cache
+from .services.upload_jobs import upload_jobs_runner, resume_upload_jobs
 
 
 async def on_startup() -> None:
@@ -26,9 +36,33 @@ async def on_startup() -> None:
 
     asyncio.create_task(server.serve())
 
+    logger.info("Loading the grade table...")
+    async with sessionmaker() as session:
+        await grade_table.load(session)
+
+    logger.info("Deleting the expired extractions...")
+    await extraction_cache.delete_expired()
+
+    if SIMILAR_DIAMONDS_SEARCH_ENGINE == "memory" or search_results_cache.is_enabled:
+        logger.info("Starting the inventory index...")
+        inventory_index_holder.start()
+
+    if PAIRS_SEARCH_ENGINE == "memory":
+        logger.info("Starting the pairs index...")
+        pairs_index_holder.start()
+
+    logger.info("Starting the upload jobs workers...")
+    upload_jobs_runner.start()
+    await resume_upload_jobs()
+
 
 async def on_shutdown() -> None:
     logger.info("On shutdown event was triggered")
+    await inventory_index_holder.stop()
+    await pairs_index_holder.stop()
+    await upload_jobs_runner.stop()
+    logger.info("Extractions cache stats: {}", extract_diamonds_from_message_with_ai.cache.stats)
+    logger.info("Extraction gateway stats: {}", extraction_gateway.stats)
     await bot.close()
 
 
@@ -7,6 +7,7 @@ BOT_TOKEN = getenv("bot_token")
 B2B_GROUP_ID = int(getenv("b2b_group_id"))
 
 LOCALES_DIR = localedir = Path(__file__).parent.parent.parent.absolute() / 'locale'
+INSTRUCTIONS_FILE_PATH = Path(__file__).parent.parent.parent.absolute() / 'resources' / 'instructions.pdf'
 I18N_DOMAIN = "messages"
 DEFAULT_LOCALE = "en"
 
@@ -24,6 +25,42 @@ async_database_url = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{D
 
 OPENAI_API_KEY = getenv("openai_api_key")
 JSON_EXTRACTOR_ASSISTANT_ID = getenv("json_extractor_assistant_id")
+# "assistant" runs the JSON extractor assistant in a thread, "chat" makes a single structured outputs chat completion
+EXTRACTION_BACKEND = getenv("extraction_backend", "assistant")
+assert EXTRACTION_BACKEND in ["assistant", "chat"]
+JSON_EXTRACTOR_MODEL = getenv("json_extractor_model", "gpt-4o-mini")
+# Extractions are shared by the messages with the same normalized text for that long, 0 disables the cache
+EXTRACTION_CACHE_TTL_HOURS = int(getenv("extraction_cache_ttl_hours", 168))
+assert EXTRACTION_CACHE_TTL_HOURS >= 0
+# Extractions kept in the memory of the process in front of the shared cache, 0 size disables it. Messages without
+# requested diamonds are kept for EXTRACTION_NEGATIVE_CACHE_TTL seconds.
+EXTRACTION_MEMORY_CACHE_SIZE = int(getenv("extraction_memory_cache_size", 1024))
+assert EXTRACTION_MEMORY_CACHE_SIZE >= 0
+EXTRACTION_MEMORY_CACHE_TTL = float(getenv("extraction_memory_cache_ttl", 3600))
+EXTRACTION_NEGATIVE_CACHE_TTL = float(getenv("extraction_negative_cache_ttl", 300))
+assert EXTRACTION_MEMORY_CACHE_TTL >= 0 and EXTRACTION_NEGATIVE_CACHE_TTL >= 0
+# Concurrent requests to the AI model, the limit grows by one per limit of successful requests up to the maximum and
+# is halved when the requests are rate limited
+EXTRACTION_MIN_CONCURRENCY = int(getenv("extraction_min_concurrency", 2))
+EXTRACTION_MAX_CONCURRENCY = int(getenv("extraction_max_concurrency", 16))
+assert 0 < EXTRACTION_MIN_CONCURRENCY <= EXTRACTION_MAX_CONCURRENCY
+EXTRACTION_ATTEMPTS = int(getenv("extraction_attempts", 3))
+assert EXTRACTION_ATTEMPTS > 0
+# Seconds before the first retry, doubled by every next one up to the maximum and jittered
+EXTRACTION_BACKOFF_BASE = float(getenv("extraction_backoff_base", 0.5))
+EXTRACTION_BACKOFF_MAX = float(getenv("extraction_backoff_max", 20))
+assert 0 <= EXTRACTION_BACKOFF_BASE <= EXTRACTION_BACKOFF_MAX
+# Consecutive failed requests which open the circuit, and seconds before a trial request is let through.
+# While the circuit is open, "fail" reports the failed search, "local" searches the diamonds found by the parser.
+EXTRACTION_CIRCUIT_FAILURES = int(getenv("extraction_circuit_failures", 5))
+assert EXTRACTION_CIRCUIT_FAILURES > 0
+EXTRACTION_CIRCUIT_RESET_TIMEOUT = float(getenv("extraction_circuit_reset_timeout", 30))
+assert EXTRACTION_CIRCUIT_RESET_TIMEOUT >= 0
+EXTRACTION_CIRCUIT_FALLBACK = getenv("extraction_circuit_fallback", "local")
+assert EXTRACTION_CIRCUIT_FALLBACK in ["fail", "local"]
+# "local" parses the messages in the common trade formats without the AI model, "ai" sends every message to it
+DIAMONDS_QUERY_PARSER = getenv("diamonds_query_parser", "local")
+assert DIAMONDS_QUERY_PARSER in ["local", "ai"]
 
 PAYMENT_PROVIDER_TERMINAL = int(getenv("payment_provider_terminal"))
 PAYMENT_PROVIDER_USERNAME = getenv("payment_provider_api_name")
@@ -32,3 +69,41 @@ STRING_LOG_LEVEL = getenv("log_level", "DEBUG")
 LOG_LEVEL = logging.getLevelName(STRING_LOG_LEVEL)
 
 BACKEND_URL = getenv("backend_url")
+
+PAIRS_SEARCH_ENGINE = getenv("pairs_search_engine", "stored")
+assert PAIRS_SEARCH_ENGINE in ["stored", "memory", "sql", "lateral"]
+PAIRS_SEARCH_CONCURRENCY = int(getenv("pairs_search_concurrency", 2))
+PAIRS_TOP_K = int(getenv("pairs_top_k", 10))
+assert PAIRS_TOP_K > 0
+
+SIMILAR_DIAMONDS_SEARCH_ENGINE = getenv("similar_diamonds_search_engine", "memory")
+assert SIMILAR_DIAMONDS_SEARCH_ENGINE in ["memory", "sql", "unnest", "batched"]
+# Number of requested stones and seconds after which the batched searches are sent to the database
+SIMILAR_DIAMONDS_BATCH_MAX_SIZE = int(getenv("similar_diamonds_batch_max_size", 200))
+assert SIMILAR_DIAMONDS_BATCH_MAX_SIZE > 0
+SIMILAR_DIAMONDS_BATCH_MAX_WAIT = float(getenv("similar_diamonds_batch_max_wait", 0.005))
+assert SIMILAR_DIAMONDS_BATCH_MAX_WAIT >= 0
+
+# Number of cached search results, 0 disables the cache
+SEARCH_CACHE_SIZE = int(getenv("search_cache_size", 1024))
+assert SEARCH_CACHE_SIZE >= 0
+
+# Unmatched requests older than that are not matched against the uploaded diamonds anymore
+UNMATCHED_REQUESTS_MAX_AGE_DAYS = int(getenv("unmatched_requests_max_age_days", 30))
+assert UNMATCHED_REQUESTS_MAX_AGE_DAYS > 0
+
+# Errors of an uploaded CSV file reported to the seller at once
+CSV_MAX_ERRORS = int(getenv("csv_max_errors", 20))
+assert CSV_MAX_ERRORS > 0
+
+# Files up to INLINE_UPLOAD_MAX_FILE_SIZE bytes are processed right away, the bigger ones by the upload jobs.
+# The Bot API does not let bots download files bigger than 20 MB.
+INLINE_UPLOAD_MAX_FILE_SIZE = int(getenv("inline_upload_max_file_size", 1024 * 1024))
+MAX_UPLOAD_FILE_SIZE = int(getenv("max_upload_file_size", 20 * 1024 * 1024))
+assert 0 <= INLINE_UPLOAD_MAX_FILE_SIZE <= MAX_UPLOAD_FILE_SIZE
+UPLOAD_JOBS_DIR = Path(getenv("upload_jobs_dir", Path(__file__).parent.parent.parent.absolute() / 'uploads'))
+UPLOAD_JOBS_WORKERS = int(getenv("upload_jobs_workers", 2))
+assert UPLOAD_JOBS_WORKERS > 0
+# Seconds between the edits of the upload progress message
+UPLOAD_PROGRESS_UPDATE_INTERVAL = float(getenv("upload_progress_update_interval", 3))
+assert UPLOAD_PROGRESS_UPDATE_INTERVAL >= 0
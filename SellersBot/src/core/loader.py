@@ -12,6 +12,7 @@ bot = Bot(BOT_TOKEN)
 dp = Dispatcher(storage=MemoryStorage())
 
 i18n: I18n = I18n(path=LOCALES_DIR.absolute(), default_locale=DEFAULT_LOCALE, domain=I18N_DOMAIN)
-openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+# The extraction gateway retries the requests with its own backoff and concurrency limit
+openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
 
 fastapi_instance = FastAPI()
@@ -1,10 +1,16 @@
 import csv
 import io
+import re
 from abc import ABC
 from typing import Union, Callable
 from urllib.parse import urlparse
 
 type ErrorMessage = str
+type ValuePredicate = Callable[[str], bool]
+
+# Unsigned decimal numbers only, the diamonds are created by splitting the measurements by "-" and "x"
+NUMBER_PATTERN = r"\s*(?:\d+\.?\d*|\.\d+)\s*"
+MEASUREMENTS_PATTERN = re.compile(f"{NUMBER_PATTERN} - {NUMBER_PATTERN} x {NUMBER_PATTERN}")
 
 
 class ValidatedValue:
@@ -81,6 +87,10 @@ class ValueValidator(ABC):
     def validate(self, value: str) -> ValidatedValue:
         ...
 
+    def compile(self) -> ValuePredicate:
+        """Whether a value is valid, without building the ValidatedValue."""
+        return lambda value: self.validate(value).is_valid
+
 
 class NumericValidator(ValueValidator):
     def validate(self, value: str) -> ValidatedValue:
@@ -91,6 +101,15 @@ class NumericValidator(ValueValidator):
         else:
             return ValidatedNumeric(value, True)
 
+    def compile(self) -> ValuePredicate:
+        def is_numeric(value: str) -> bool:
+            try:
+                float(value)
+            except ValueError:
+                return False
+            return True
+        return is_numeric
+
 
 class IntegerValidator(ValueValidator):
     def validate(self, value: str) -> ValidatedValue:
@@ -101,6 +120,15 @@ class IntegerValidator(ValueValidator):
         else:
             return ValidatedInteger(value, True)
 
+    def compile(self) -> ValuePredicate:
+        def is_integer(value: str) -> bool:
+            try:
+                int(value)
+            except ValueError:
+                return False
+            return True
+        return is_integer
+
 
 class NotEmptyTextValidator(ValueValidator):
     def validate(self, value: str) -> ValidatedValue:
@@ -110,22 +138,16 @@ class NotEmptyTextValidator(ValueValidator):
             return ValidatedText(value, False)
         return ValidatedText(value, True)
 
+    def compile(self) -> ValuePredicate:
+        return bool
+
 
 class MeasurementsValidator(ValueValidator):
     def validate(self, value: str) -> ValidatedValue:
-        try:
-            measurement1, other = value.split(" - ")
-            measurement2, measurement3 = other.split(" x ")
-        except ValueError:
-            return ValidatedMeasurements(value, False)
+        return ValidatedMeasurements(value, MEASUREMENTS_PATTERN.fullmatch(value) is not None)
 
-        try:
-            float(measurement1)
-            float(measurement2)
-            float(measurement3)
-        except ValueError:
-            return ValidatedMeasurements(value, False)
-        return ValidatedMeasurements(value, True)
+    def compile(self) -> ValuePredicate:
+        return lambda value: MEASUREMENTS_PATTERN.fullmatch(value) is not None
 
 
 class NullableValidator(ValueValidator):
@@ -137,6 +159,10 @@ class NullableValidator(ValueValidator):
             return ValidatedValue(value, True)
         return self.__value_validator.validate(value)
 
+    def compile(self) -> ValuePredicate:
+        is_valid = self.__value_validator.compile()
+        return lambda value: value == "" or is_valid(value)
+
 
 class LiteralValidator(ValueValidator):
     def __init__(self, literals: list[str]):
@@ -150,6 +176,9 @@ class LiteralValidator(ValueValidator):
             return ValidatedLiteral(value, False)
         return ValidatedLiteral(value, True)
 
+    def compile(self) -> ValuePredicate:
+        return frozenset(self.__literals).__contains__
+
 
 class URLValidator(ValueValidator):
     def validate(self, value: str) -> ValidatedValue:
@@ -161,16 +190,28 @@ class URLValidator(ValueValidator):
             return ValidatedURL(value, False)
         return ValidatedURL(value, True)
 
+    def compile(self) -> ValuePredicate:
+        def is_url(value: str) -> bool:
+            try:
+                result = urlparse(value)
+            except ValueError:
+                return False
+            return bool(result.scheme and result.netloc)
+        return is_url
+
 
 class CSVValidator:
     @staticmethod
     def __default_gettext(message: str) -> str:
         return message
 
-    def __check_header(self,
-                       reader: csv.DictReader,
-                       gettext: Callable[[str], str],
-                       ignore_extra_columns: bool = False) -> list[ErrorMessage]:
+    def check_header(self,
+                     reader: csv.DictReader,
+                     gettext: Union[Callable[[str], str], None] = None,
+                     ignore_extra_columns: bool = False) -> list[ErrorMessage]:
+        if gettext is None:
+            gettext = self.__default_gettext
+
         header_errors: list[ErrorMessage] = []
 
         if reader.fieldnames is None and self.columns:
@@ -190,38 +231,90 @@ class CSVValidator:
 
         return header_errors
 
+    def validate_row(self,
+                     row_number: int,
+                     row: dict[str, str],
+                     gettext: Union[Callable[[str], str], None] = None) -> list[ErrorMessage]:
+        if gettext is None:
+            gettext = self.__default_gettext
+
+        validated_values = []
+        for column_name, value_checkers in self.columns.items():
+            value = row.get(column_name, "")
+
+            for value_checker in value_checkers:
+                validated_value = value_checker.validate(value)
+                validated_value.set_position(row_number, column_name)
+                validated_values.append(validated_value)
+        invalid_values = filter(lambda validated_value: not validated_value.is_valid, validated_values)
+        return [validated_value.get_error_message(gettext) for validated_value in invalid_values]
+
+    def get_compiled_columns(self) -> list[tuple[str, list[tuple[ValuePredicate, ValueValidator]]]]:
+        if self.__compiled_columns is None:
+            self.__compiled_columns = [
+                (column_name, [(value_checker.compile(), value_checker) for value_checker in value_checkers])
+                for column_name, value_checkers in self.columns.items()
+            ]
+        return self.__compiled_columns
+
+    def validate_rows(self,
+                      rows: list[dict[str, str]],
+                      first_row_number: int = 1,
+                      gettext: Union[Callable[[str], str], None] = None,
+                      max_errors: Union[int, None] = None) -> list[ErrorMessage]:
+        """
+        Errors of all the rows in the order of the rows, at most max_errors of them.
+
+        The rows are checked column by column with the compiled predicates, the ValidatedValue is only built for the
+        invalid values to get their error message.
+        """
+        if gettext is None:
+            gettext = self.__default_gettext
+
+        invalid_values: list[tuple[int, int, ValueValidator, str]] = []
+        for column_index, (column_name, compiled_checkers) in enumerate(self.get_compiled_columns()):
+            if not compiled_checkers:
+                continue
+            # Short rows have None in the missing columns
+            values = [row.get(column_name) or "" for row in rows]
+            for is_valid, value_checker in compiled_checkers:
+                invalid_values += [(row_index, column_index, value_checker, value)
+                                   for row_index, value in enumerate(values) if not is_valid(value)]
+
+        invalid_values.sort(key=lambda invalid_value: invalid_value[:2])
+        if max_errors is not None:
+            invalid_values = invalid_values[:max_errors]
+
+        column_names = list(self.columns.keys())
+        errors: list[ErrorMessage] = []
+        for row_index, column_index, value_checker, value in invalid_values:
+            validated_value = value_checker.validate(value)
+            validated_value.set_position(first_row_number + row_index, column_names[column_index])
+            errors.append(validated_value.get_error_message(gettext))
+        return errors
+
     def validate(self,
                  file: io.TextIOWrapper,
                  gettext: Union[Callable[[str], str], None] = None,
-                 ignore_extra_column: bool = False) -> list[ErrorMessage]:
+                 ignore_extra_column: bool = False,
+                 max_errors: Union[int, None] = None) -> list[ErrorMessage]:
         if gettext is None:
             gettext = self.__default_gettext
 
         try:
             reader = csv.DictReader(file, delimiter=",")
 
-            if header_errors := self.__check_header(reader, gettext, ignore_extra_column):
+            if header_errors := self.check_header(reader, gettext, ignore_extra_column):
                 return header_errors
 
-            for row_number, row in enumerate(reader, start=1):
-                validated_values = []
-                for column_name, value_checkers in self.columns.items():
-                    value = row.get(column_name, "")
-
-                    for value_checker in value_checkers:
-                        validated_value = value_checker.validate(value)
-                        validated_value.set_position(row_number, column_name)
-                        validated_values.append(validated_value)
-                if any(not validated_value.is_valid for validated_value in validated_values):
-                    invalid_values = filter(lambda validated_value: not validated_value.is_valid, validated_values)
-                    return [validated_value.get_error_message(gettext) for validated_value in invalid_values]
+            return self.validate_rows(list(reader), 1, gettext, max_errors)
         except csv.Error:
             return [gettext("Invalid csv file format.")]
 
-        return []
-
     def add_column(self, name: str, value_checkers: list[ValueValidator]):
         self.columns[name] = value_checkers
+        self.__compiled_columns = None
 
     def __init__(self):
         self.columns: dict[str, list[ValueValidator]] = {}
+        self.__compiled_columns: Union[list[tuple[str, list[tuple[ValuePredicate, ValueValidator]]]], None] = None
@@ -0,0 +1,20 @@
+from typing import NamedTuple
+
+from ..models import ColorProperties, ClarityProperties
+from ..models.enums import Color, Clarity
+from .values import values
+
+
+class Grade(NamedTuple):
+    index: int
+    group: int | None = None
+
+
+# The grades of the stones are taken from the properties tables, these defaults are only used by the grade table
+# until it is loaded from them
+color_grades: dict[Color, Grade] = {
+    value.color: Grade(value.index, value.group) for value in values if isinstance(value, ColorProperties)
+}
+clarity_grades: dict[Clarity, Grade] = {
+    value.clarity: Grade(value.index, value.group) for value in values if isinstance(value, ClarityProperties)
+}
@@ -2,12 +2,13 @@ from uuid import uuid4
 
 from asyncpg import Connection
 from loguru import logger
-from sqlalchemy import URL
-from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, AsyncSession, create_async_engine
+from sqlalchemy import URL, text, select, func
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, async_sessionmaker, AsyncSession, create_async_engine
 from sqlalchemy_utils import database_exists, create_database
 
 from .defaults import add_all_defaults
-from .models import Base
+from .migrations import migrations, MIGRATIONS_LOCK_KEY
+from .models import Base, DiamondPair, SchemaMigration
 from ..core.config import sync_database_url, async_database_url
 
 
@@ -43,6 +44,41 @@ async def init_models():
         await conn.commit()
 
 
+async def apply_migrations(conn: AsyncConnection) -> None:
+    # The services start together, the first one applies the migrations and the others find them applied after the lock
+    await conn.execute(select(func.pg_advisory_xact_lock(MIGRATIONS_LOCK_KEY)))
+    logger.info("Creating missing tables")
+    await conn.run_sync(Base.metadata.create_all)
+    applied_names = await SchemaMigration.get_applied_names(conn)
+    pending_names = [name for name in migrations if name not in applied_names]
+    logger.info("Applying {} migrations", len(pending_names))
+    for name in pending_names:
+        for statement in migrations[name]:
+            await conn.execute(text(statement))
+        await SchemaMigration.add(conn, name)
+
+
+async def migrate_models():
+    logger.info("Migrating models")
+    async with engine.begin() as conn:
+        await apply_migrations(conn)
+        await conn.commit()
+
+
+async def backfill_diamond_pairs():
+    async with sessionmaker() as session:
+        if not await DiamondPair.is_empty(session):
+            return
+        # The services start together, the first one backfills the pairs and the others find them after the lock
+        await DiamondPair.lock(session)
+        if not await DiamondPair.is_empty(session):
+            return
+        logger.info("Backfilling diamond pairs")
+        await DiamondPair.add_for_all_diamonds(session)
+        await session.commit()
+        logger.success("Diamond pairs were backfilled")
+
+
 async def add_defaults():
     logger.info("Adding defaults")
     async with sessionmaker() as session:
@@ -71,6 +107,9 @@ async def init_database(fresh_init: bool = False) -> None:
         else:
             logger.info("Database was found")
 
+    await migrate_models()
+    await backfill_diamond_pairs()
+
     logger.success("Database initialization was finished")
 
 
@@ -0,0 +1,165 @@
+"""
+Schema changes for databases created before the corresponding model changes.
+
+create_all only creates missing tables, so the new columns and indexes of existing tables are added here.
+Every migration is applied once, it is recorded in the schema_migrations table by its name, so the new migrations are
+added to the end of migrations under a new name. The statements are still idempotent, the databases migrated before
+the schema_migrations table was introduced apply all of them once more.
+"""
+
+# Key of the advisory lock held by the migrating service, the other services wait for the migrations to be applied
+MIGRATIONS_LOCK_KEY = 1
+
+GRADE_COLUMNS = ('color_index', 'color_group', 'clarity_index', 'clarity_group', 'cut_index', 'polish_index',
+                 'symmetry_index')
+
+grade_columns_migrations = [
+    *(f'ALTER TABLE diamonds ADD COLUMN IF NOT EXISTS {column} SMALLINT' for column in GRADE_COLUMNS),
+    'UPDATE diamonds SET color_index = colors_properties.index, color_group = colors_properties."group" '
+    'FROM colors_properties WHERE diamonds.color = colors_properties.color AND diamonds.color_index IS NULL',
+    'UPDATE diamonds SET clarity_index = clarity_properties.index, clarity_group = clarity_properties."group" '
+    'FROM clarity_properties WHERE diamonds.clarity = clarity_properties.clarity AND diamonds.clarity_index IS NULL',
+    'UPDATE diamonds SET cut_index = cut_properties.index '
+    'FROM cut_properties WHERE diamonds.cut = cut_properties.cut AND diamonds.cut_index IS NULL',
+    'UPDATE diamonds SET polish_index = polish_properties.index '
+    'FROM polish_properties WHERE diamonds.polish = polish_properties.polish AND diamonds.polish_index IS NULL',
+    'UPDATE diamonds SET symmetry_index = symetry_properties.index '
+    'FROM symetry_properties WHERE diamonds.symmetry = symetry_properties.symmetry '
+    'AND diamonds.symmetry_index IS NULL',
+    *(f'ALTER TABLE diamonds ALTER COLUMN {column} SET NOT NULL' for column in GRADE_COLUMNS),
+    'CREATE INDEX IF NOT EXISTS ix_diamonds_pairs_search '
+    'ON diamonds (shape, fluorescence, color_group, clarity_group, weight)',
+    'CREATE INDEX IF NOT EXISTS ix_diamonds_similar_search '
+    'ON diamonds (shape, color_group, color_index, clarity_group, clarity_index, weight)',
+]
+
+pairs_candidates_migrations = [
+    'CREATE INDEX IF NOT EXISTS ix_diamonds_pairs_candidates ON diamonds (shape, fluorescence, weight)',
+]
+
+# Pairs stored before the score was introduced are dropped and computed again by backfill_diamond_pairs
+pairs_score_migrations = [
+    'ALTER TABLE diamond_pairs ADD COLUMN IF NOT EXISTS score DOUBLE PRECISION',
+    'DELETE FROM diamond_pairs WHERE score IS NULL',
+    'ALTER TABLE diamond_pairs ALTER COLUMN score SET NOT NULL',
+]
+
+# Resident copies of the inventory LISTEN to the diamond_owners_changed channel, the payload is the diamond id
+diamond_owners_notifications_migrations = [
+    '''
+    CREATE OR REPLACE FUNCTION notify_diamond_owners_changed() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM pg_notify('diamond_owners_changed', OLD.diamond_id::text);
+            RETURN OLD;
+        END IF;
+        PERFORM pg_notify('diamond_owners_changed', NEW.diamond_id::text);
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+    ''',
+    'DROP TRIGGER IF EXISTS diamond_owners_changed ON diamond_owners',
+    'CREATE TRIGGER diamond_owners_changed AFTER INSERT OR DELETE ON diamond_owners '
+    'FOR EACH ROW EXECUTE FUNCTION notify_diamond_owners_changed()',
+]
+
+unmatched_diamonds_notification_migrations = [
+    'ALTER TABLE unmatched_diamonds ADD COLUMN IF NOT EXISTS free_notification BOOLEAN NOT NULL DEFAULT FALSE',
+]
+
+# The hash is computed by the database only, so the existing and the uploaded diamonds are hashed the same way.
+# extra_float_digits is fixed, as the text of the floats depends on it.
+diamond_identity_columns = ['stock', 'shape', 'weight', 'color', 'clarity', 'lab', 'certificate_number', 'length',
+                            'width', 'depth', 'ratio', 'cut', 'polish', 'symmetry', 'fluorescence', 'table',
+                            'depth_percentage', 'gridle', 'culet']
+quoted_diamond_identity_columns = ", ".join(f'"{column}"' for column in diamond_identity_columns)
+diamond_identity_fields = ", ".join(f'diamond."{column}"' for column in diamond_identity_columns)
+diamond_identity_hash_migrations = [
+    'ALTER TABLE diamonds ADD COLUMN IF NOT EXISTS identity_hash UUID',
+    'CREATE OR REPLACE FUNCTION diamond_identity_hash(diamond diamonds) RETURNS uuid AS $$ '
+    f'SELECT md5(ROW({diamond_identity_fields})::text)::uuid '
+    '$$ LANGUAGE sql STABLE SET extra_float_digits = 3',
+    '''
+    CREATE OR REPLACE FUNCTION set_diamond_identity_hash() RETURNS trigger AS $$
+    BEGIN
+        NEW.identity_hash := diamond_identity_hash(NEW);
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+    ''',
+    'DROP TRIGGER IF EXISTS diamond_identity_hash ON diamonds',
+    f'CREATE TRIGGER diamond_identity_hash BEFORE INSERT OR UPDATE OF {quoted_diamond_identity_columns} ON diamonds '
+    'FOR EACH ROW EXECUTE FUNCTION set_diamond_identity_hash()',
+    'UPDATE diamonds SET identity_hash = diamond_identity_hash(diamonds) WHERE identity_hash IS NULL',
+    'ALTER TABLE diamonds ALTER COLUMN identity_hash SET NOT NULL',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_diamonds_identity_hash ON diamonds (identity_hash)',
+    # The unique constraint of all the identifying columns is replaced by the unique index of their hash
+    '''
+    DO $$
+    DECLARE
+        constraint_name name;
+    BEGIN
+        FOR constraint_name IN
+            SELECT conname FROM pg_constraint
+            WHERE conrelid = 'diamonds'::regclass AND contype = 'u' AND cardinality(conkey) = 19
+        LOOP
+            EXECUTE format('ALTER TABLE diamonds DROP CONSTRAINT %I', constraint_name);
+        END LOOP;
+    END;
+    $$
+    ''',
+]
+
+# The grade columns of the diamonds are only taken from the properties tables: they are set on insert, and the
+# diamonds of an edited grade are ranked again. The grade table of the running services is loaded at startup.
+diamond_grade_triggers_migrations = [
+    '''
+    CREATE OR REPLACE FUNCTION set_diamond_grade_columns() RETURNS trigger AS $$
+    BEGIN
+        SELECT "index", "group" INTO NEW.color_index, NEW.color_group
+        FROM colors_properties WHERE color = NEW.color;
+        SELECT "index", "group" INTO NEW.clarity_index, NEW.clarity_group
+        FROM clarity_properties WHERE clarity = NEW.clarity;
+        SELECT "index" INTO NEW.cut_index FROM cut_properties WHERE cut = NEW.cut;
+        SELECT "index" INTO NEW.polish_index FROM polish_properties WHERE polish = NEW.polish;
+        SELECT "index" INTO NEW.symmetry_index FROM symetry_properties WHERE symmetry = NEW.symmetry;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+    ''',
+    'DROP TRIGGER IF EXISTS diamond_grade_columns ON diamonds',
+    'CREATE TRIGGER diamond_grade_columns BEFORE INSERT OR UPDATE OF color, clarity, cut, polish, symmetry '
+    'ON diamonds FOR EACH ROW EXECUTE FUNCTION set_diamond_grade_columns()',
+]
+# Grade column of the diamonds, its properties table and the diamonds columns set from the properties
+grade_properties_tables = [
+    ('color', 'colors_properties', 'color_index = NEW."index", color_group = NEW."group"'),
+    ('clarity', 'clarity_properties', 'clarity_index = NEW."index", clarity_group = NEW."group"'),
+    ('cut', 'cut_properties', 'cut_index = NEW."index"'),
+    ('polish', 'polish_properties', 'polish_index = NEW."index"'),
+    ('symmetry', 'symetry_properties', 'symmetry_index = NEW."index"'),
+]
+for grade, table, grade_columns in grade_properties_tables:
+    diamond_grade_triggers_migrations += [
+        f'''
+        CREATE OR REPLACE FUNCTION update_diamonds_{grade}_grades() RETURNS trigger AS $$
+        BEGIN
+            UPDATE diamonds SET {grade_columns} WHERE {grade} = NEW.{grade};
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        f'DROP TRIGGER IF EXISTS diamonds_{grade}_grades ON {table}',
+        f'CREATE TRIGGER diamonds_{grade}_grades AFTER INSERT OR UPDATE ON {table} '
+        f'FOR EACH ROW EXECUTE FUNCTION update_diamonds_{grade}_grades()',
+    ]
+
+migrations: dict[str, list[str]] = {
+    'grade_columns': grade_columns_migrations,
+    'pairs_candidates': pairs_candidates_migrations,
+    'pairs_score': pairs_score_migrations,
+    'diamond_owners_notifications': diamond_owners_notifications_migrations,
+    'unmatched_diamonds_notification': unmatched_diamonds_notification_migrations,
+    'diamond_identity_hash': diamond_identity_hash_migrations,
+    'diamond_grade_triggers': diamond_grade_triggers_migrations,
+}
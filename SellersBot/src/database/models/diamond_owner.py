@@ -2,7 +2,7 @@ from datetime import datetime
 from typing import Any
 
 from loguru import logger
-from sqlalchemy import ForeignKey, UniqueConstraint, select, func, BigInteger
+from sqlalchemy import ForeignKey, UniqueConstraint, select, func, BigInteger, and_
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import mapped_column, Mapped
 from sqlalchemy.dialects.postgresql import insert
@@ -28,9 +28,17 @@ class DiamondOwner(Base):
             diamond_owner = {"user_id": user_id, "diamond_id": diamond_id, "upload_date": upload_date}
             logger.debug("DiamondOwner created: {}", diamond_owner)
             diamond_owners.append(diamond_owner)
-        await session.execute(insert(cls)
-                              .values(diamond_owners)
-                              .on_conflict_do_nothing())
+
+        from .diamond_pair import DiamondPair
+        await DiamondPair.lock(session)
+        result = await session.execute(insert(cls)
+                                       .values(diamond_owners)
+                                       .on_conflict_do_nothing()
+                                       .returning(cls.diamond_id))
+        newly_owned_diamonds_ids = list(result.scalars().all())
+        logger.debug("Diamonds newly owned by user {}: {}", user_id, len(newly_owned_diamonds_ids))
+
+        await DiamondPair.add_for_diamonds(session, newly_owned_diamonds_ids)
         await session.commit()
 
     @classmethod
@@ -40,6 +48,18 @@ class DiamondOwner(Base):
         owners = list(result.scalars().all())
         return owners
 
+    @classmethod
+    async def get_diamonds_ids_for_user(cls, session: AsyncSession, user_id: int) -> list[int]:
+        query = select(cls.diamond_id).filter(cls.user_id == user_id)
+        result = await session.execute(query)
+        return list(result.scalars().all())
+
+    @classmethod
+    async def get_diamonds_ids_uploaded_at(cls, session: AsyncSession, user_id: int, upload_date: datetime) -> list[int]:
+        query = select(cls.diamond_id).filter(and_(cls.user_id == user_id, cls.upload_date == upload_date))
+        result = await session.execute(query)
+        return list(result.scalars().all())
+
     async def delete(self, session: AsyncSession):
         await session.delete(self)
         await session.commit()
@@ -50,6 +70,11 @@ class DiamondOwner(Base):
         result = (await session.execute(query)).first()[0]
         return result
 
+    @classmethod
+    async def count_for_user_uploaded_at(cls, session: AsyncSession, user_id: int, upload_date: datetime) -> int:
+        query = select(func.count(cls.diamond_id)).filter(and_(cls.user_id == user_id, cls.upload_date == upload_date))
+        return (await session.execute(query)).scalar_one()
+
     def __repr__(self):
         return (f"<DiamondOwner(user_id={repr(self.user_id)}, diamond_id={repr(self.diamond_id)}, "
                 f"upload_date={repr(self.upload_date)})>")
@@ -0,0 +1,42 @@
+from datetime import datetime
+from typing import Any
+
+from sqlalchemy import Column, String, select, delete
+from sqlalchemy.dialects.postgresql import JSONB, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Mapped, mapped_column
+
+from .base import Base
+
+
+class ExtractionCacheEntry(Base):
+    """Diamonds extracted from a message by the AI model, by the hash of the normalized message text."""
+    __tablename__ = 'extraction_cache'
+
+    text_hash: Mapped[str] = mapped_column(String(64), primary_key=True)
+    # JSON of the ExtractedDiamond list, null if the message does not request diamonds
+    diamonds = Column(JSONB, nullable=True)
+    extraction_date: Mapped[datetime] = mapped_column(nullable=False, index=True)
+
+    @classmethod
+    async def get(cls, session: AsyncSession, text_hash: str, oldest_extraction_date: datetime) \
+            -> "ExtractionCacheEntry | None":
+        query = select(cls).where(cls.text_hash == text_hash, cls.extraction_date >= oldest_extraction_date)
+        return (await session.execute(query)).scalar_one_or_none()
+
+    @classmethod
+    async def put(cls, session: AsyncSession, text_hash: str, diamonds: list[dict[str, Any]] | None) -> None:
+        extraction_date = datetime.now()
+        stmt = insert(cls).values(text_hash=text_hash, diamonds=diamonds, extraction_date=extraction_date)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[cls.text_hash],
+            set_={"diamonds": stmt.excluded.diamonds, "extraction_date": stmt.excluded.extraction_date}
+        )
+        await session.execute(stmt)
+        await session.commit()
+
+    @classmethod
+    async def delete_expired(cls, session: AsyncSession, oldest_extraction_date: datetime) -> int:
+        result = await session.execute(delete(cls).where(cls.extraction_date < oldest_extraction_date))
+        await session.commit()
+        return result.rowcount
@@ -0,0 +1,26 @@
+from datetime import datetime
+
+from sqlalchemy import String, select, insert
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlalchemy.orm import Mapped, mapped_column
+
+from .base import Base
+
+
+class SchemaMigration(Base):
+    """Migration from database/migrations.py applied to the database, by its name."""
+    __tablename__ = 'schema_migrations'
+
+    name: Mapped[str] = mapped_column(String(64), primary_key=True)
+    applied_at: Mapped[datetime] = mapped_column(nullable=False)
+
+    @classmethod
+    async def get_applied_names(cls, connection: AsyncConnection) -> set[str]:
+        return set((await connection.execute(select(cls.name))).scalars().all())
+
+    @classmethod
+    async def add(cls, connection: AsyncConnection, name: str) -> None:
+        await connection.execute(insert(cls).values(name=name, applied_at=datetime.now()))
+
+    def __repr__(self):
+        return f"<SchemaMigration(name={repr(self.name)}, applied_at={repr(self.applied_at)})>"
@@ -4,6 +4,7 @@ from .settings import dp
 from .csv_file_upload import dp
 from .remove_from_paid import dp
 from .sold import dp
+from .pairs import dp
 from .handle_contact import dp
 from .b2b_group_message_handler import dp
 from .unknown_commands_handler import dp
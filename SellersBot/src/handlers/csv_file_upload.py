@@ -5,10 +5,12 @@ from aiogram.enums import ChatType
 from aiogram.exceptions import TelegramBadRequest
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..core.config import INSTRUCTIONS_FILE_PATH
+from ..core.config import INSTRUCTIONS_FILE_PATH, INLINE_UPLOAD_MAX_FILE_SIZE, MAX_UPLOAD_FILE_SIZE
 from ..services import (InvalidCSVFileError, TotalDiamondsLimitExceededError, DiamondsPerLoadLimitExceededError,
-                        NoActiveSubscriptionFoundError, process_uploaded_diamonds_csv)
-from ..services.diamond_utils import generate_csv_content, generate_text_table
+                        NoActiveSubscriptionFoundError, process_uploaded_diamonds, sync_uploaded_diamonds,
+                        InventorySyncResult, UploadedRowsReader, CSVRowsReader, XLSXRowsReader,
+                        schedule_pairs_delivery, schedule_unmatched_requests_matching, schedule_upload_job,
+                        get_upload_error_message)
 from ..core import dp, bot
 from aiogram import types, F
 from aiogram.types import ContentType, BufferedInputFile
@@ -19,26 +21,50 @@ from loguru import logger
 
 unsuccessful_attempts = defaultdict(int)
 
+# Caption of the file replacing the whole stock of the seller
+FULL_SYNC_CAPTIONS = ("sync", "/sync")
+
+CSV_MIME_TYPES = ["text/csv", "text/comma-separated-values"]
+XLSX_MIME_TYPES = ["application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"]
+
 
 @dp.message(F.chat.type == ChatType.PRIVATE, F.content_type == ContentType.DOCUMENT)
 async def csv_file_upload(message: types.Message, session: AsyncSession):
     user_id = message.from_user.id
     logger.info("Received a document from user {}", user_id)
 
-    if message.document.file_size > 1024 * 1024:
-        await handle_error_message(user_id, message, _("file_too_large_error"))
+    if message.document.file_size > MAX_UPLOAD_FILE_SIZE:
+        await handle_error_message(user_id, message,
+                                   _("file_too_large_error").format(MAX_UPLOAD_FILE_SIZE // (1024 * 1024)))
         return
 
-    if message.document.mime_type not in ["text/csv", "text/comma-separated-values"]:
+    if message.document.mime_type not in CSV_MIME_TYPES + XLSX_MIME_TYPES:
         logger.debug("Received file type {}", message.document.mime_type)
         await handle_error_message(user_id, message, _("invalid_file_type_error"))
         return
 
+    file_type = "xlsx" if message.document.mime_type in XLSX_MIME_TYPES else "csv"
+    full_sync = (message.caption or "").strip().lower() in FULL_SYNC_CAPTIONS
+
+    if message.document.file_size > INLINE_UPLOAD_MAX_FILE_SIZE:
+        logger.info("Scheduling an upload job for the {} bytes document", message.document.file_size)
+        progress_message = await message.answer(_("upload_job_scheduled_progress"))
+        await schedule_upload_job(session, user_id, message.document.file_id, file_type, full_sync,
+                                  progress_message.message_id)
+        return
+
     stream = io.BytesIO()
     await bot.download(message.document, destination=stream)
-    text_io = io.TextIOWrapper(stream, encoding='utf-8')
+    reader: UploadedRowsReader
+    if file_type == "xlsx":
+        reader = XLSXRowsReader(stream)
+    else:
+        reader = CSVRowsReader(io.TextIOWrapper(stream, encoding='utf-8'))
     try:
-        pairs = await process_uploaded_diamonds_csv(session, text_io, user_id)
+        if full_sync:
+            sync_result = await sync_uploaded_diamonds(session, reader, user_id)
+        else:
+            diamonds_ids = await process_uploaded_diamonds(session, reader, user_id)
     except (InvalidCSVFileError, TotalDiamondsLimitExceededError, DiamondsPerLoadLimitExceededError,
             NoActiveSubscriptionFoundError) as e:
         error_message = get_error_message(e)
@@ -46,7 +72,10 @@ async def csv_file_upload(message: types.Message, session: AsyncSession):
         return
     else:
         unsuccessful_attempts[user_id] = 0
-        await handle_successful_upload(message, pairs)
+        if full_sync:
+            await handle_successful_sync(message, sync_result)
+        else:
+            await handle_successful_upload(message, diamonds_ids)
 
 
 async def handle_error_message(user_id: int, message: types.Message, error_message: str):
@@ -73,38 +102,31 @@ async def send_instructions_file(user_id: int, message: types.Message):
 
 
 def get_error_message(exception: Exception) -> str:
-    if isinstance(exception, InvalidCSVFileError):
-        return _("Unable to process csv file.\n{errors}").format(errors="\n".join(exception.errors))
-    elif isinstance(exception, TotalDiamondsLimitExceededError):
-        return _("total_diamonds_limit_exceeded_error")
-    elif isinstance(exception, DiamondsPerLoadLimitExceededError):
-        return _("diamonds_per_load_limit_exceeded_error").format("1000")
-    elif isinstance(exception, NoActiveSubscriptionFoundError):
-        return _("no_active_subscription_found_error")
-    return _("An unknown error occurred")
-
-
-async def handle_successful_upload(message: types.Message, pairs: list):
+    return get_upload_error_message(exception, _)
+
+
+async def handle_successful_upload(message: types.Message, diamonds_ids: list[int]):
     logger.info("CSV file processed successfully.")
-    if len(pairs) == 0:
-        try:
-            await message.answer(_("csv_file_processed_successfully_without_pairs"))
-        except TelegramBadRequest:
-            logger.exception("Failed to notify user about the CSV file processed successfully without pairs")
-        else:
-            logger.success("User was notified about the CSV file processed successfully without pairs")
-        finally:
-            return
-    pairs_csv_file_content = generate_csv_content(pairs)
-    table_preview = generate_text_table(pairs)
-    pairs_csv_file = BufferedInputFile(pairs_csv_file_content, filename="pairs.csv")
     try:
-        await message.answer(_("list_of_pairs_preview").format(table_preview), parse_mode="markdown")
-        await message.answer_document(
-            document=pairs_csv_file,
-            caption=_("csv_file_processed_successfully_with_pairs")
-        )
+        await message.answer(_("csv_file_processed_searching_pairs").format(len(diamonds_ids)))
+    except TelegramBadRequest:
+        logger.exception("Failed to notify user about the pairs search in progress")
+    else:
+        logger.success("User was notified about the pairs search in progress")
+    schedule_pairs_delivery(message.from_user.id, diamonds_ids)
+    schedule_unmatched_requests_matching(message.from_user.id, diamonds_ids)
+
+
+async def handle_successful_sync(message: types.Message, sync_result: InventorySyncResult):
+    logger.info("CSV file synchronized successfully.")
+    try:
+        await message.answer(_("csv_file_synced_searching_pairs").format(added=len(sync_result.added_ids),
+                                                                         updated=len(sync_result.updated_ids),
+                                                                         removed=len(sync_result.removed_ids)))
     except TelegramBadRequest:
-        logger.exception("Failed to notify user about the CSV file processed successfully with pairs")
+        logger.exception("Failed to notify user about the pairs search in progress")
     else:
-        logger.success("User was notified about the CSV file processed successfully with pairs")
+        logger.success("User was notified about the pairs search in progress")
+    # The kept stones already have their pairs, only the added ones are searched
+    schedule_pairs_delivery(message.from_user.id, sync_result.added_ids)
+    schedule_unmatched_requests_matching(message.from_user.id, sync_result.added_ids)
@@ -0,0 +1,49 @@
+from aiogram import types, F
+from aiogram.enums import ChatType
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import Command
+from aiogram.types import BufferedInputFile
+from loguru import logger
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..core import dp
+from ..database.models import DiamondOwner
+from ..filters import HasActiveSubscription
+from ..services.diamond_utils import generate_csv_content, generate_text_table
+from ..services.find_pairs import find_pairs_for_diamonds
+from aiogram.utils.i18n import gettext as _
+
+
+@dp.message(F.chat.type == ChatType.PRIVATE,
+            Command("pairs", ignore_case=True),
+            HasActiveSubscription())
+async def pairs(message: types.Message, session: AsyncSession):
+    logger.info("/pairs handler triggered by user {}", message.from_user.id)
+    diamonds_ids = await DiamondOwner.get_diamonds_ids_for_user(session, message.from_user.id)
+    pairs_list = await find_pairs_for_diamonds(session, diamonds_ids)
+
+    if len(pairs_list) == 0:
+        try:
+            await message.answer(_("pairs_list_empty"))
+        except TelegramBadRequest:
+            logger.exception("Failed to notify user about the empty list of pairs")
+        finally:
+            return
+
+    pairs_csv_file = BufferedInputFile(generate_csv_content(pairs_list), filename="pairs.csv")
+    try:
+        await message.answer(_("list_of_pairs_preview").format(generate_text_table(pairs_list)),
+                             parse_mode="markdown")
+        await message.answer_document(document=pairs_csv_file, caption=_("pairs_list_file_caption"))
+    except TelegramBadRequest:
+        logger.exception("Failed to send the list of pairs to user {}", message.from_user.id)
+    else:
+        logger.success("/pairs handler finished")
+
+
+@dp.message(F.chat.type == ChatType.PRIVATE,
+            Command("pairs", ignore_case=True), HasActiveSubscription(False))
+async def pairs_without_of_subscription(message: types.Message):
+    logger.info("/pairs handler triggered by user {}, but without of subscription", message.from_user.id)
+    await message.answer(_("no_active_subscription_found_error"))
+    logger.success("/pairs handler for user without of a subscription finished")
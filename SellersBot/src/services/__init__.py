@@ -1,17 +1,27 @@
 from .users import get_language_code, set_language_code
 from .create_payment_url import create_payment_url
-from .process_uploaded_diamonds_csv import InvalidCSVFileError, process_uploaded_diamonds_csv, \
-    TotalDiamondsLimitExceededError, DiamondsPerLoadLimitExceededError, NoActiveSubscriptionFoundError
+from .process_uploaded_diamonds_csv import InvalidCSVFileError, process_uploaded_diamonds, \
+    TotalDiamondsLimitExceededError, DiamondsPerLoadLimitExceededError, NoActiveSubscriptionFoundError, \
+    sync_uploaded_diamonds, get_upload_error_message
+from .uploaded_rows import UploadedRowsReader, CSVRowsReader, XLSXRowsReader
+from .inventory_sync import InventorySyncResult
 from .ai_json_extraction import extract_diamonds_from_message_with_ai
 from .diamond_filtering import filter_incomplete_diamonds
 from .diamond_grouping import get_diamond_lists_grouped_by_sellers
 from .notification import notify_diamonds_owner
 from .diamond_utils import generate_text_table
 from .diamond_utils import generate_csv_content
+from .pairs_delivery import schedule_pairs_delivery
+from .unmatched_requests import schedule_unmatched_requests_matching
+from .upload_jobs import schedule_upload_job, resume_upload_jobs, upload_jobs_runner
 
 
 __all__ = ["get_language_code", "set_language_code", "create_payment_url",
-           "process_uploaded_diamonds_csv", "TotalDiamondsLimitExceededError", "DiamondsPerLoadLimitExceededError",
+           "process_uploaded_diamonds", "sync_uploaded_diamonds", "InventorySyncResult", "UploadedRowsReader",
+           "CSVRowsReader", "XLSXRowsReader",
+           "TotalDiamondsLimitExceededError", "DiamondsPerLoadLimitExceededError",
            "NoActiveSubscriptionFoundError", "extract_diamonds_from_message_with_ai", "filter_incomplete_diamonds",
            "get_diamond_lists_grouped_by_sellers", "notify_diamonds_owner", "generate_text_table", "generate_csv_content",
-           "InvalidCSVFileError"]
+           "InvalidCSVFileError", "schedule_pairs_delivery",
+           "schedule_unmatched_requests_matching", "get_upload_error_message", "schedule_upload_job",
+           "resume_upload_jobs", "upload_jobs_runner"]
@@ -0,0 +1,118 @@
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import wraps
+from typing import Any, Awaitable, Callable, Hashable, NamedTuple
+
+
+class CacheEntry(NamedTuple):
+    value: Any
+    expiration_time: float
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    # Calls which waited for the same call in flight instead of computing the value again
+    joined: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        calls_amount = self.hits + self.misses + self.joined
+        return (self.hits + self.joined) / calls_amount if calls_amount else 0.0
+
+
+class AsyncCache:
+    """
+    LRU cache of coroutine results with a TTL, shared by the concurrent calls.
+
+    The concurrent calls with the same key wait for a single computation, which is not cancelled with its callers.
+    Negative results, None by default, are kept for their own TTL. Exceptions are raised to all the waiting callers and
+    are never cached, the next call computes the value again.
+    """
+
+    def __init__(self, max_size: int, ttl: float, negative_ttl: float,
+                 is_negative: Callable[[Any], bool] = lambda value: value is None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.is_negative = is_negative
+        self.entries: OrderedDict[Hashable, CacheEntry] = OrderedDict()
+        self.computations: dict[Hashable, asyncio.Task] = {}
+        self.stats = CacheStats()
+
+    @property
+    def is_enabled(self) -> bool:
+        return self.max_size > 0
+
+    def get(self, key: Hashable) -> tuple[bool, Any]:
+        """Whether the key is cached, and its value."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return False, None
+        if entry.expiration_time <= time.monotonic():
+            del self.entries[key]
+            return False, None
+        self.entries.move_to_end(key)
+        return True, entry.value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        ttl = self.negative_ttl if self.is_negative(value) else self.ttl
+        if not self.is_enabled or ttl <= 0:
+            return
+        self.entries[key] = CacheEntry(value, time.monotonic() + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self.entries.pop(key, None)
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    async def get_or_compute(self, key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Any:
+        is_cached, value = self.get(key)
+        if is_cached:
+            self.stats.hits += 1
+            return value
+
+        computation = self.computations.get(key)
+        if computation is not None:
+            self.stats.joined += 1
+        else:
+            self.stats.misses += 1
+            computation = asyncio.ensure_future(compute())
+            self.computations[key] = computation
+            computation.add_done_callback(lambda task: self.finish_computation(key, task))
+        # A cancelled caller does not cancel the computation awaited by the others
+        return await asyncio.shield(computation)
+
+    def finish_computation(self, key: Hashable, computation: asyncio.Task) -> None:
+        if self.computations.get(key) is computation:
+            del self.computations[key]
+        if computation.cancelled() or computation.exception() is not None:
+            return
+        self.put(key, computation.result())
+
+
+def get_call_key(*args, **kwargs) -> Hashable:
+    return args, tuple(sorted(kwargs.items()))
+
+
+def async_cache(max_size: int = 128, ttl: float = 3600, negative_ttl: float = 60,
+                key: Callable[..., Hashable] = get_call_key):
+    """Cache the results of a coroutine function by its arguments, the cache is the cache attribute of the wrapper."""
+    def decorator(function):
+        cache = AsyncCache(max_size, ttl, negative_ttl)
+
+        @wraps(function)
+        async def wrapper(*args, **kwargs):
+            return await cache.get_or_compute(key(*args, **kwargs), lambda: function(*args, **kwargs))
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
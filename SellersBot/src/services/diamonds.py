@@ -1,7 +1,8 @@
 from sqlalchemy import delete, select, and_
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..database.models import DiamondOwner, Diamond
+from ..database.models import DiamondOwner, Diamond, DiamondPair
+from .search_cache import search_results_cache
 
 
 async def is_user_owns_diamond(session: AsyncSession, user_id: int, stock: str) -> bool:
@@ -24,7 +25,7 @@ async def is_user_owns_diamond(session: AsyncSession, user_id: int, stock: str)
 
 async def delete_diamond_for_user(session: AsyncSession, user_id: int, stock: str) -> None:
     """Delete the stone from the user's stock."""
-    diamonds_to_delete = (
+    diamonds_ids_query = (
         select(DiamondOwner.diamond_id)
         .join(Diamond)
         .where(
@@ -34,15 +35,18 @@ async def delete_diamond_for_user(session: AsyncSession, user_id: int, stock: st
             )
         )
     )
+    diamonds_ids = list((await session.execute(diamonds_ids_query)).scalars().all())
     query = (
         delete(DiamondOwner)
         .where(
             and_(
-                DiamondOwner.diamond_id.in_(diamonds_to_delete),
+                DiamondOwner.diamond_id.in_(diamonds_ids),
                 DiamondOwner.user_id == user_id
             )
         )
     )
 
     await session.execute(query)
+    await DiamondPair.delete_for_unowned_diamonds(session, diamonds_ids)
     await session.commit()
+    search_results_cache.bump_inventory_version()
@@ -0,0 +1,107 @@
+import hashlib
+import re
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import Any, Optional
+
+from loguru import logger
+from sqlalchemy.exc import SQLAlchemyError
+
+from ..core.config import EXTRACTION_CACHE_TTL_HOURS
+from ..database.loader import sessionmaker
+from ..database.models import ExtractionCacheEntry
+from ..database.models.processing_types import ExtractedDiamond, ValueRange
+
+type Extraction = Optional[list[ExtractedDiamond]]
+
+
+def normalize_message_text(text: str) -> str:
+    """Case, spacing and the space between a number and its unit do not change the requested diamonds."""
+    text = text.lower()
+    text = re.sub(r"(\d)\s*(ct|cts|carat|carats)\b", r"\1 \2", text)
+    text = re.sub(r"\s*([-,/+])\s*", r"\1", text)
+    return " ".join(text.split())
+
+
+def get_message_text_hash(text: str) -> str:
+    return hashlib.sha256(normalize_message_text(text).encode()).hexdigest()
+
+
+def serialize_criterion(value: Any) -> Any:
+    """
+    A criterion of ExtractedDiamond like ExtractedDiamond.from_dict reads it, enums by value and ranges as objects.
+
+    The missing end of an open range is left out, like the assistant leaves it out.
+    """
+    # ValueRange is a named tuple, the JSON encoder would write it as a list
+    if isinstance(value, ValueRange):
+        ends = {"from": value.from_value, "to": value.to_value}
+        return {key: serialize_criterion(end) for key, end in ends.items() if end is not None}
+    if isinstance(value, list):
+        return [serialize_criterion(item) for item in value]
+    if isinstance(value, Enum):
+        return value.value
+    return value
+
+
+def get_oldest_extraction_date() -> datetime:
+    return datetime.now() - timedelta(hours=EXTRACTION_CACHE_TTL_HOURS)
+
+
+class ExtractionCache:
+    """
+    Extractions shared by all the processes through the extraction_cache table, for EXTRACTION_CACHE_TTL_HOURS.
+
+    The cache is an optimization, so the database errors and the entries which cannot be read are logged and the
+    message is extracted by the AI model.
+    """
+
+    @property
+    def is_enabled(self) -> bool:
+        return EXTRACTION_CACHE_TTL_HOURS > 0
+
+    async def get(self, text_hash: str) -> tuple[bool, Extraction]:
+        """Whether the extraction was found, and the extraction."""
+        if not self.is_enabled:
+            return False, None
+        try:
+            async with sessionmaker() as session:
+                entry = await ExtractionCacheEntry.get(session, text_hash, get_oldest_extraction_date())
+        except SQLAlchemyError:
+            logger.exception("Failed to read the extraction cache")
+            return False, None
+        if entry is None:
+            return False, None
+        if entry.diamonds is None:
+            logger.debug("Extraction was found in the cache")
+            return True, None
+        try:
+            diamonds = list(map(ExtractedDiamond.from_dict, entry.diamonds))
+        except (TypeError, ValueError, AttributeError):
+            logger.exception("Failed to read the cached extraction")
+            return False, None
+        logger.debug("Extraction was found in the cache")
+        return True, diamonds
+
+    async def put(self, text_hash: str, diamonds: Extraction) -> None:
+        if not self.is_enabled:
+            return
+        serialized_diamonds = None
+        if diamonds is not None:
+            serialized_diamonds = [{key: serialize_criterion(value) for key, value in diamond.as_dict().items()}
+                                   for diamond in diamonds]
+        try:
+            async with sessionmaker() as session:
+                await ExtractionCacheEntry.put(session, text_hash, serialized_diamonds)
+        except SQLAlchemyError:
+            logger.exception("Failed to write the extraction cache")
+
+    async def delete_expired(self) -> None:
+        if not self.is_enabled:
+            return
+        async with sessionmaker() as session:
+            deleted_amount = await ExtractionCacheEntry.delete_expired(session, get_oldest_extraction_date())
+        logger.info("{} expired extractions were deleted from the cache", deleted_amount)
+
+
+extraction_cache = ExtractionCache()
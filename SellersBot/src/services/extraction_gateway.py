@@ -0,0 +1,272 @@
+import asyncio
+import random
+import re
+import statistics
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Optional
+
+from loguru import logger
+from openai import APIConnectionError, APIError, APIStatusError, RateLimitError
+
+from ..core.config import (EXTRACTION_MIN_CONCURRENCY, EXTRACTION_MAX_CONCURRENCY, EXTRACTION_ATTEMPTS,
+                           EXTRACTION_BACKOFF_BASE, EXTRACTION_BACKOFF_MAX, EXTRACTION_CIRCUIT_FAILURES,
+                           EXTRACTION_CIRCUIT_RESET_TIMEOUT)
+from .extraction_backends import ExtractionBackend, ExtractionFailed, extraction_backend
+
+# Durations of the x-ratelimit-reset-* headers, like "1s", "6m0s" or "20ms"
+RESET_DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+# Recent queue wait times the percentiles are computed from
+QUEUE_WAITS_WINDOW = 1000
+
+
+class ExtractionUnavailable(Exception):
+    pass
+
+
+class AIMDLimiter:
+    """
+    Limit of the concurrent requests, additive increase and multiplicative decrease.
+
+    Every successful request raises the limit by 1 / limit, so by one per limit of requests, a rate limited request
+    halves it. The waiting requests get the free slots in their order.
+    """
+
+    def __init__(self, min_limit: int, max_limit: int):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min_limit)
+        self.in_flight = 0
+        self.waiters: deque[asyncio.Future] = deque()
+
+    async def acquire(self) -> float:
+        """Wait for a free slot and return the seconds waited."""
+        start_time = time.monotonic()
+        if self.in_flight < int(self.limit) and not self.waiters:
+            self.in_flight += 1
+            return 0.0
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            # The slot is taken by wake_waiters
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            elif waiter in self.waiters:
+                self.waiters.remove(waiter)
+            raise
+        return time.monotonic() - start_time
+
+    def release(self, is_successful: bool = False, is_overloaded: bool = False) -> None:
+        self.in_flight -= 1
+        if is_overloaded:
+            self.limit = max(float(self.min_limit), self.limit / 2)
+            logger.warning("The extraction requests are rate limited, the concurrency limit is {:.1f}", self.limit)
+        elif is_successful:
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+        self.wake_waiters()
+
+    def wake_waiters(self) -> None:
+        while self.waiters and self.in_flight < int(self.limit):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+
+class CircuitState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half open"
+
+
+class CircuitBreaker:
+    """
+    Rejects the requests for reset_timeout seconds after failures_threshold consecutive failures.
+
+    Then a single trial request is let through, its success closes the circuit and its failure opens it again.
+    """
+
+    def __init__(self, failures_threshold: int, reset_timeout: float):
+        self.failures_threshold = failures_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitState.CLOSED
+        self.failures_amount = 0
+        self.opening_time = 0.0
+        self.is_trial_in_flight = False
+
+    def allow_request(self) -> bool:
+        if self.state == CircuitState.OPEN:
+            if time.monotonic() - self.opening_time < self.reset_timeout:
+                return False
+            self.state = CircuitState.HALF_OPEN
+        if self.state == CircuitState.HALF_OPEN:
+            if self.is_trial_in_flight:
+                return False
+            self.is_trial_in_flight = True
+        return True
+
+    def record_success(self) -> None:
+        if self.state != CircuitState.CLOSED:
+            logger.success("The AI model API recovered, the extraction circuit is closed")
+        self.state = CircuitState.CLOSED
+        self.failures_amount = 0
+        self.is_trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures_amount += 1
+        self.is_trial_in_flight = False
+        if self.state == CircuitState.HALF_OPEN or self.failures_amount >= self.failures_threshold:
+            if self.state != CircuitState.OPEN:
+                logger.error("The AI model API is degraded, the extraction circuit is open for {}s",
+                             self.reset_timeout)
+            self.state = CircuitState.OPEN
+            self.opening_time = time.monotonic()
+
+    def cancel_request(self) -> None:
+        """The request was cancelled before its result was known."""
+        self.is_trial_in_flight = False
+
+
+def is_api_degraded(error: APIError) -> bool:
+    """Whether the error is a sign of an overloaded or unavailable API rather than a rejected request."""
+    if isinstance(error, (RateLimitError, APIConnectionError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+
+def get_rate_limit_delay(error: Exception) -> Optional[float]:
+    """Seconds until the rate limit is reset, by the headers of the error response."""
+    if not isinstance(error, APIStatusError):
+        return None
+    headers = error.response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    reset_delays = [sum(float(amount) * DURATION_UNITS[unit]
+                        for amount, unit in RESET_DURATION_PATTERN.findall(headers[name]))
+                    for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens") if name in headers]
+    return max(reset_delays) if reset_delays else None
+
+
+def get_retry_delay(retry_number: int, error: Exception) -> float:
+    """
+    The rate limit reset announced by the API, or the exponential backoff with the full jitter.
+
+    The jitter is added to the announced delay too, so the requests limited together are not retried together.
+    """
+    backoff = min(EXTRACTION_BACKOFF_MAX, EXTRACTION_BACKOFF_BASE * 2 ** retry_number)
+    rate_limit_delay = get_rate_limit_delay(error)
+    if rate_limit_delay is None:
+        return random.uniform(0, backoff)
+    return min(EXTRACTION_BACKOFF_MAX, rate_limit_delay) + random.uniform(0, EXTRACTION_BACKOFF_BASE)
+
+
+@dataclass
+class GatewayStats:
+    requests: int = 0
+    retries: int = 0
+    rate_limited: int = 0
+    rejected: int = 0
+    queue_waits: deque[float] = field(default_factory=lambda: deque(maxlen=QUEUE_WAITS_WINDOW))
+
+    def record_queue_wait(self, wait_time: float) -> None:
+        self.requests += 1
+        self.queue_waits.append(wait_time)
+
+    def __str__(self) -> str:
+        if len(self.queue_waits) > 1:
+            percentiles = statistics.quantiles(self.queue_waits, n=100)
+            queue_wait = f"p50 {percentiles[49]:.3f}s, p95 {percentiles[94]:.3f}s, max {max(self.queue_waits):.3f}s"
+        else:
+            queue_wait = "no data"
+        return (f"{self.requests} requests, {self.retries} retries, {self.rate_limited} rate limited, "
+                f"{self.rejected} rejected, queue wait {queue_wait}")
+
+
+class ExtractionGateway:
+    """
+    The only way to the extraction backend: bounds the concurrent requests, retries the failed ones with a backoff and
+    fails fast while the API is degraded.
+    """
+
+    def __init__(self, backend: ExtractionBackend, limiter: AIMDLimiter, circuit_breaker: CircuitBreaker,
+                 attempts_limit: int):
+        self.backend = backend
+        self.limiter = limiter
+        self.circuit_breaker = circuit_breaker
+        self.attempts_limit = attempts_limit
+        self.stats = GatewayStats()
+
+    async def extract(self, message: str) -> Optional[list[dict[str, Any]]]:
+        """
+        The raw diamonds list like ExtractionBackend.extract.
+
+        ExtractionUnavailable is raised while the circuit is open, ExtractionFailed when the attempts are exhausted or
+        the request is rejected by the API.
+        """
+        error: Exception | None = None
+        for attempt in range(self.attempts_limit):
+            if attempt > 0:
+                delay = get_retry_delay(attempt - 1, error)
+                logger.warning("Extraction attempt {}/{} failed, retrying in {:.2f}s: {!r}", attempt,
+                               self.attempts_limit, delay, error)
+                self.stats.retries += 1
+                await asyncio.sleep(delay)
+
+            if not self.circuit_breaker.allow_request():
+                self.stats.rejected += 1
+                raise ExtractionUnavailable("The extraction circuit is open")
+
+            try:
+                wait_time = await self.limiter.acquire()
+            except asyncio.CancelledError:
+                self.circuit_breaker.cancel_request()
+                raise
+            self.stats.record_queue_wait(wait_time)
+            logger.debug("The extraction waited {:.3f}s in the queue, the concurrency limit is {:.1f}", wait_time,
+                         self.limiter.limit)
+
+            try:
+                raw_diamonds_list = await self.backend.extract(message)
+            except ExtractionFailed as e:
+                # The API answered, the answer is not usable
+                self.limiter.release()
+                self.circuit_breaker.record_success()
+                error = e
+            except APIError as e:
+                is_rate_limited = isinstance(e, RateLimitError)
+                self.stats.rate_limited += is_rate_limited
+                self.limiter.release(is_overloaded=is_rate_limited)
+                if not is_api_degraded(e):
+                    self.circuit_breaker.record_success()
+                    raise ExtractionFailed(f"The extraction request was rejected: {e}") from e
+                self.circuit_breaker.record_failure()
+                error = e
+            except BaseException:
+                self.limiter.release()
+                self.circuit_breaker.cancel_request()
+                raise
+            else:
+                self.limiter.release(is_successful=True)
+                self.circuit_breaker.record_success()
+                return raw_diamonds_list
+
+        raise ExtractionFailed(f"The extraction failed after {self.attempts_limit} attempts") from error
+
+
+extraction_gateway = ExtractionGateway(
+    extraction_backend,
+    AIMDLimiter(EXTRACTION_MIN_CONCURRENCY, EXTRACTION_MAX_CONCURRENCY),
+    CircuitBreaker(EXTRACTION_CIRCUIT_FAILURES, EXTRACTION_CIRCUIT_RESET_TIMEOUT),
+    EXTRACTION_ATTEMPTS,
+)
@@ -1,83 +1,159 @@
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import and_
+from sqlalchemy import and_, exists, true, func
 from sqlalchemy.orm import aliased
 
-from ..database.models import (
-    Diamond, ColorProperties, ClarityProperties, CutProperties, PolishProperties, SymmetryProperties,
-    DiamondOwner
-)
+from ..database.models import Diamond, DiamondOwner, DiamondPair
+from .pairs_index import pairs_index_holder
+from ..core.config import PAIRS_SEARCH_ENGINE, PAIRS_TOP_K
 from loguru import logger
 
 
 async def find_pairs_for_diamonds(session: AsyncSession, diamonds_ids: list[int]) -> list[Diamond]:
+    """Best PAIRS_TOP_K pairs of every given diamond, the most similar pairs first."""
+    match PAIRS_SEARCH_ENGINE:
+        case "stored":
+            return await DiamondPair.get_pairs(session, diamonds_ids, PAIRS_TOP_K)
+        case "memory" if pairs_index_holder.is_ready:
+            return await pairs_index_holder.find_pairs_for_diamonds(session, diamonds_ids, PAIRS_TOP_K)
+        case "memory":
+            logger.warning("Pairs index is not ready, searching pairs in the database")
+            return await DiamondPair.get_pairs(session, diamonds_ids, PAIRS_TOP_K)
+        case "lateral":
+            return await find_pairs_for_diamonds_with_lateral(session, diamonds_ids, PAIRS_TOP_K)
+        case _:
+            return await find_pairs_for_diamonds_with_sql(session, diamonds_ids, PAIRS_TOP_K)
+
+
+async def find_pairs_for_diamonds_with_sql(session: AsyncSession, diamonds_ids: list[int],
+                                           limit_per_diamond: int | None = None) -> list[Diamond]:
     initial_diamond = aliased(Diamond)
     pair_diamond = aliased(Diamond)
 
-    initial_diamond_color = aliased(ColorProperties)
-    initial_diamond_clarity = aliased(ClarityProperties)
-    initial_diamond_cut = aliased(CutProperties)
-    initial_diamond_polish = aliased(PolishProperties)
-    initial_diamond_symmetry = aliased(SymmetryProperties)
     initial_diamond_owner = aliased(DiamondOwner)
-
-    pair_diamond_color = aliased(ColorProperties)
-    pair_diamond_clarity = aliased(ClarityProperties)
-    pair_diamond_cut = aliased(CutProperties)
-    pair_diamond_polish = aliased(PolishProperties)
-    pair_diamond_symmetry = aliased(SymmetryProperties)
-
     pair_diamond_owner = aliased(DiamondOwner)
 
-    query = (
-        select(pair_diamond)
+    score = DiamondPair.get_score(initial_diamond, pair_diamond)
+
+    ranked_pairs = (
+        select(pair_diamond.id.label("pair_diamond_id"), score.label("score"),
+               func.row_number().over(partition_by=initial_diamond.id,
+                                      # The pair id breaks the ties the same way as the lateral search
+                                      order_by=(score.self_group(), pair_diamond.id)).label("rank"))
         .select_from(initial_diamond)
-        # Join the initial diamond properties
-        .join(initial_diamond_color, initial_diamond.color == initial_diamond_color.color)
-        .join(initial_diamond_clarity, initial_diamond.clarity == initial_diamond_clarity.clarity)
-        .join(initial_diamond_cut, initial_diamond.cut == initial_diamond_cut.cut)
-        .join(initial_diamond_polish, initial_diamond.polish == initial_diamond_polish.polish)
-        .join(initial_diamond_symmetry, initial_diamond.symmetry == initial_diamond_symmetry.symmetry)
-        .join(initial_diamond_owner, initial_diamond.id == initial_diamond_owner.diamond_id)
         # Join the pair diamond
         .join(pair_diamond, pair_diamond.id != initial_diamond.id)
-        # Join the pair diamond properties
-        .join(pair_diamond_color, pair_diamond.color == pair_diamond_color.color)
-        .join(pair_diamond_clarity, pair_diamond.clarity == pair_diamond_clarity.clarity)
-        .join(pair_diamond_cut, pair_diamond.cut == pair_diamond_cut.cut)
-        .join(pair_diamond_polish, pair_diamond.polish == pair_diamond_polish.polish)
-        .join(pair_diamond_symmetry, pair_diamond.symmetry == pair_diamond_symmetry.symmetry)
-        .join(pair_diamond_owner, pair_diamond.id == pair_diamond_owner.diamond_id)
         # Apply the where condition
         .where(
             and_(
                 initial_diamond.id.in_(diamonds_ids),
                 initial_diamond.shape == pair_diamond.shape,
                 pair_diamond.weight.between(initial_diamond.weight * 0.985, initial_diamond.weight * 1.015),
-                initial_diamond_color.index.between(pair_diamond_color.index - 1, pair_diamond_color.index + 1),
-                initial_diamond_color.group == pair_diamond_color.group,
-                initial_diamond_clarity.index.between(pair_diamond_clarity.index - 1, pair_diamond_clarity.index + 1),
-                initial_diamond_clarity.group == pair_diamond_clarity.group,
+                initial_diamond.color_index.between(pair_diamond.color_index - 1, pair_diamond.color_index + 1),
+                initial_diamond.color_group == pair_diamond.color_group,
+                initial_diamond.clarity_index.between(pair_diamond.clarity_index - 1, pair_diamond.clarity_index + 1),
+                initial_diamond.clarity_group == pair_diamond.clarity_group,
                 initial_diamond.length.between(pair_diamond.length * 0.985, pair_diamond.length * 1.015),
                 initial_diamond.weight.between(pair_diamond.weight * 0.985, pair_diamond.weight * 1.015),
                 initial_diamond.depth_percentage.between(pair_diamond.depth_percentage * 0.985, pair_diamond.depth_percentage * 1.015),
-                initial_diamond_cut.index.between(pair_diamond_cut.index - 1, pair_diamond_cut.index + 1),
-                initial_diamond_polish.index.between(pair_diamond_polish.index - 1, pair_diamond_polish.index + 1),
-                initial_diamond_symmetry.index.between(pair_diamond_symmetry.index - 1, pair_diamond_symmetry.index + 1),
+                initial_diamond.cut_index.between(pair_diamond.cut_index - 1, pair_diamond.cut_index + 1),
+                initial_diamond.polish_index.between(pair_diamond.polish_index - 1, pair_diamond.polish_index + 1),
+                initial_diamond.symmetry_index.between(pair_diamond.symmetry_index - 1, pair_diamond.symmetry_index + 1),
                 initial_diamond.fluorescence == pair_diamond.fluorescence,
                 pair_diamond.table.between(initial_diamond.table * 0.985, initial_diamond.table * 1.015),
                 pair_diamond.depth_percentage.between(initial_diamond.depth_percentage * 0.985, initial_diamond.depth_percentage * 1.015),
-                initial_diamond_owner.user_id != pair_diamond_owner.user_id
+                exists().where(
+                    and_(
+                        initial_diamond_owner.diamond_id == initial_diamond.id,
+                        pair_diamond_owner.diamond_id == pair_diamond.id,
+                        initial_diamond_owner.user_id != pair_diamond_owner.user_id
+                    )
+                )
             )
         )
-        .group_by(pair_diamond.id)
+        .subquery()
+    )
+
+    query = (
+        select(Diamond)
+        .join(ranked_pairs, ranked_pairs.c.pair_diamond_id == Diamond.id)
+        .group_by(Diamond.id)
+        .order_by(func.min(ranked_pairs.c.score))
     )
+    if limit_per_diamond is not None:
+        query = query.where(ranked_pairs.c.rank <= limit_per_diamond)
 
     logger.debug("Query: {}", query)
 
     result = await session.execute(query)
-    pairs = result.all()
+    return list(result.scalars().all())
 
-    diamonds = [diamond for pair in pairs for diamond in pair]
 
-    return diamonds
+async def find_pairs_for_diamonds_with_lateral(session: AsyncSession, diamonds_ids: list[int],
+                                               limit_per_diamond: int | None = None) -> list[Diamond]:
+    """
+    Same search as find_pairs_for_diamonds_with_sql, but the candidates of every initial diamond are looked up by a
+    LATERAL subquery. Its leading conditions (equal shape and fluorescence, weight band) match the
+    ix_diamonds_pairs_candidates index, so each lookup is an index range scan, and the best pairs are cut off inside
+    of the lookup.
+    """
+    initial_diamond = aliased(Diamond)
+    initial_diamond_owner = aliased(DiamondOwner)
+    pair_diamond = aliased(Diamond)
+    pair_diamond_owner = aliased(DiamondOwner)
+
+    score = DiamondPair.get_score(initial_diamond, pair_diamond)
+
+    candidates = (
+        select(pair_diamond.id, score.label("score"))
+        .where(
+            and_(
+                pair_diamond.shape == initial_diamond.shape,
+                pair_diamond.fluorescence == initial_diamond.fluorescence,
+                pair_diamond.weight.between(initial_diamond.weight * 0.985, initial_diamond.weight * 1.015),
+                pair_diamond.id != initial_diamond.id,
+                initial_diamond.weight.between(pair_diamond.weight * 0.985, pair_diamond.weight * 1.015),
+                initial_diamond.color_index.between(pair_diamond.color_index - 1, pair_diamond.color_index + 1),
+                initial_diamond.color_group == pair_diamond.color_group,
+                initial_diamond.clarity_index.between(pair_diamond.clarity_index - 1, pair_diamond.clarity_index + 1),
+                initial_diamond.clarity_group == pair_diamond.clarity_group,
+                initial_diamond.length.between(pair_diamond.length * 0.985, pair_diamond.length * 1.015),
+                initial_diamond.depth_percentage.between(pair_diamond.depth_percentage * 0.985, pair_diamond.depth_percentage * 1.015),
+                initial_diamond.cut_index.between(pair_diamond.cut_index - 1, pair_diamond.cut_index + 1),
+                initial_diamond.polish_index.between(pair_diamond.polish_index - 1, pair_diamond.polish_index + 1),
+                initial_diamond.symmetry_index.between(pair_diamond.symmetry_index - 1, pair_diamond.symmetry_index + 1),
+                pair_diamond.table.between(initial_diamond.table * 0.985, initial_diamond.table * 1.015),
+                pair_diamond.depth_percentage.between(initial_diamond.depth_percentage * 0.985, initial_diamond.depth_percentage * 1.015),
+                # The owners are only checked here, an outer join of them would cut the best pairs off per owner
+                exists().where(
+                    and_(
+                        initial_diamond_owner.diamond_id == initial_diamond.id,
+                        pair_diamond_owner.diamond_id == pair_diamond.id,
+                        initial_diamond_owner.user_id != pair_diamond_owner.user_id
+                    )
+                ).correlate_except(initial_diamond_owner, pair_diamond_owner)
+            )
+        )
+        .order_by(score, pair_diamond.id)
+        .limit(limit_per_diamond)
+        .lateral()
+    )
+
+    pairs = (
+        select(candidates.c.id, candidates.c.score)
+        .select_from(initial_diamond)
+        .join(candidates, true())
+        .where(initial_diamond.id.in_(diamonds_ids))
+        .subquery()
+    )
+    query = (
+        select(Diamond)
+        .join(pairs, pairs.c.id == Diamond.id)
+        .group_by(Diamond.id)
+        .order_by(func.min(pairs.c.score))
+    )
+
+    logger.debug("Query: {}", query)
+
+    result = await session.execute(query)
+    return list(result.scalars().all())
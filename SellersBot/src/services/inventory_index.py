@@ -0,0 +1,340 @@
+import asyncio
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from typing import Any, Callable, Iterable, NamedTuple, Sequence
+
+import asyncpg
+import numpy as np
+from loguru import logger
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..core.config import sync_database_url
+from ..database.defaults.grades import Grade
+from ..database.loader import sessionmaker
+from ..database.models import Diamond, DiamondOwner
+from ..database.models.enums import Shape, Color, Clarity
+from ..database.models.processing_types import ExtractedDiamond, ValueRange
+from ..database.models.search_criteria import grade_table
+from .search_cache import search_results_cache
+
+# Sent by the diamond_owners triggers from database/migrations.py with the diamond id as the payload
+DIAMOND_OWNERS_CHANNEL = "diamond_owners_changed"
+LISTENER_RECONNECT_DELAY = 5
+
+CARAT_TOLERANCE = 0.15
+
+type WeightRange = tuple[float | None, float | None]
+
+
+class InventoryRow(NamedTuple):
+    diamond_id: int
+    shape: Shape
+    weight: float
+    color_index: int
+    color_group: int
+    clarity_index: int
+    clarity_group: int
+
+
+class ShapeInventory:
+    """Owned diamonds of one shape, sorted by weight."""
+
+    def __init__(self, rows: Sequence[InventoryRow]):
+        rows = sorted(rows, key=lambda row: row.weight)
+        self.ids = np.fromiter((row.diamond_id for row in rows), dtype=np.int64, count=len(rows))
+        self.weights = np.fromiter((row.weight for row in rows), dtype=np.float64, count=len(rows))
+        self.color_indexes = np.fromiter((row.color_index for row in rows), dtype=np.int16, count=len(rows))
+        self.color_groups = np.fromiter((row.color_group for row in rows), dtype=np.int16, count=len(rows))
+        self.clarity_indexes = np.fromiter((row.clarity_index for row in rows), dtype=np.int16, count=len(rows))
+        self.clarity_groups = np.fromiter((row.clarity_group for row in rows), dtype=np.int16, count=len(rows))
+
+    def get_weight_mask(self, weight_ranges: list[WeightRange] | None) -> np.ndarray:
+        if weight_ranges is None:
+            return np.ones(len(self.ids), dtype=bool)
+        mask = np.zeros(len(self.ids), dtype=bool)
+        for from_weight, to_weight in weight_ranges:
+            # BETWEEN with a NULL bound matches nothing
+            if from_weight is None or to_weight is None:
+                continue
+            start = np.searchsorted(self.weights, from_weight, side="left")
+            stop = np.searchsorted(self.weights, to_weight, side="right")
+            mask[start:stop] = True
+        return mask
+
+
+def get_shapes(shape: Any) -> set[Shape] | None:
+    """Shapes allowed by the criteria, None if the shape is not filtered."""
+    match shape:
+        case Shape():
+            return {shape}
+        case list() as shapes:
+            allowed_shapes = set()
+            is_filtered = False
+            for shape_item in shapes:
+                match shape_item:
+                    case Shape():
+                        allowed_shapes.add(shape_item)
+                        is_filtered = True
+                    case ValueRange(from_value=Shape() | None as from_value, to_value=Shape() | None as to_value):
+                        allowed_shapes.update(value for value in (from_value, to_value) if value is not None)
+                        is_filtered = True
+            return allowed_shapes if is_filtered else None
+        case ValueRange(from_value=Shape() | None as from_shape, to_value=Shape() | None as to_shape):
+            return {value for value in (from_shape, to_shape) if value is not None}
+        case None:
+            return None
+        case _:
+            logger.error("Matched unknown shape: {}", shape)
+            return None
+
+
+def get_weight_ranges(carat: Any) -> list[WeightRange] | None:
+    """Weight ranges allowed by the criteria, None if the weight is not filtered."""
+    match carat:
+        case float() | int():
+            return [(carat - CARAT_TOLERANCE, carat + CARAT_TOLERANCE)]
+        case list() as carats:
+            weight_ranges = []
+            for carat_item in carats:
+                match carat_item:
+                    case float() | int():
+                        weight_ranges.append((carat_item - CARAT_TOLERANCE, carat_item + CARAT_TOLERANCE))
+                    case ValueRange(from_value=float() | int() | None as from_value,
+                                    to_value=float() | int() | None as to_value):
+                        weight_ranges.append((from_value, to_value))
+            return weight_ranges if weight_ranges else None
+        case ValueRange(from_value=float() | int() as from_carat, to_value=float() | int() as to_carat):
+            return [(from_carat, to_carat)]
+        case None:
+            return None
+        case _:
+            logger.error("Matched unknown carats: {}", carat)
+            return None
+
+
+def get_grade_mask(value: Any, grade_type: type[Color] | type[Clarity], get_grade: Callable[[Any], Grade],
+                   indexes: np.ndarray, groups: np.ndarray, list_range_tolerance: int,
+                   open_range_matches_nothing: bool) -> np.ndarray:
+    """
+    Mask of the grade criteria, the same as the color and clarity filters of Diamond.find_similar_diamonds_ids.
+
+    A list ANDs the neighbourhood of every single grade in it and ORs the neighbourhoods and groups of all of its items.
+    Ranges in a list are widened by list_range_tolerance, an open range in a list matches nothing.
+    """
+    def between(from_index: int, to_index: int) -> np.ndarray:
+        return (indexes >= from_index) & (indexes <= to_index)
+
+    mask = np.ones(len(indexes), dtype=bool)
+    match value:
+        case grade_type():
+            grade = get_grade(value)
+            mask &= between(grade.index - 1, grade.index + 1) & (groups == grade.group)
+        case list() as values:
+            units = []
+            for item in values:
+                match item:
+                    case grade_type():
+                        grade = get_grade(item)
+                        mask &= between(grade.index - 1, grade.index + 1)
+                        units.append(between(grade.index - 1, grade.index + 1))
+                        units.append(groups == grade.group)
+                    case ValueRange(from_value=grade_type() as from_value, to_value=grade_type() as to_value):
+                        from_grade, to_grade = get_grade(from_value), get_grade(to_value)
+                        units.append(between(from_grade.index - list_range_tolerance,
+                                             to_grade.index + list_range_tolerance))
+                        units.append(groups == from_grade.group)
+                    case ValueRange(from_value=grade_type() | None, to_value=grade_type() | None):
+                        mask &= False
+            if units:
+                mask &= np.logical_or.reduce(units)
+        case ValueRange(from_value=grade_type() as from_value, to_value=grade_type() as to_value):
+            from_grade, to_grade = get_grade(from_value), get_grade(to_value)
+            mask &= between(from_grade.index, to_grade.index) & (groups == from_grade.group)
+        case ValueRange(from_value=grade_type() | None, to_value=grade_type() | None) if open_range_matches_nothing:
+            mask &= False
+        case None:
+            pass
+        case _:
+            logger.error("Matched unknown {}: {}", grade_type.__name__, value)
+    return mask
+
+
+class InventoryIndex:
+    """
+    Resident copy of the owned diamonds that answers find_similar_diamonds_ids criteria without the database.
+
+    Diamonds are split by shape and sorted by weight, so carat criteria are binary searches and grade criteria are
+    vectorized comparisons over compact rank columns.
+    """
+
+    def __init__(self, rows: Sequence[InventoryRow]):
+        self.diamonds: dict[int, InventoryRow] = {row.diamond_id: row for row in rows}
+        self.shapes: dict[Shape, ShapeInventory] = {}
+        self.rebuild_shapes(set(row.shape for row in rows))
+
+    def rebuild_shapes(self, shapes: set[Shape]) -> None:
+        shape_rows: defaultdict[Shape, list[InventoryRow]] = defaultdict(list)
+        for row in self.diamonds.values():
+            if row.shape in shapes:
+                shape_rows[row.shape].append(row)
+        for shape in shapes:
+            self.shapes[shape] = ShapeInventory(shape_rows[shape])
+
+    def update(self, diamonds_ids: set[int], rows: Sequence[InventoryRow]) -> None:
+        """Replace the given diamonds with the rows, the diamonds without rows are not owned anymore."""
+        changed_shapes = set()
+        for diamond_id in diamonds_ids:
+            if (row := self.diamonds.pop(diamond_id, None)) is not None:
+                changed_shapes.add(row.shape)
+        for row in rows:
+            self.diamonds[row.diamond_id] = row
+            changed_shapes.add(row.shape)
+        self.rebuild_shapes(changed_shapes)
+
+    def find_similar_diamonds_ids(self, extracted_diamonds: list[ExtractedDiamond]) -> list[int]:
+        similar_diamonds_ids: set[int] = set()
+        for diamond in extracted_diamonds:
+            allowed_shapes = get_shapes(diamond.shape)
+            weight_ranges = get_weight_ranges(diamond.carat)
+            for shape, inventory in self.shapes.items():
+                if allowed_shapes is not None and shape not in allowed_shapes:
+                    continue
+                mask = inventory.get_weight_mask(weight_ranges)
+                if not mask.any():
+                    continue
+                mask &= get_grade_mask(diamond.color, Color, grade_table.get_color, inventory.color_indexes,
+                                       inventory.color_groups, list_range_tolerance=1,
+                                       open_range_matches_nothing=False)
+                mask &= get_grade_mask(diamond.clarity, Clarity, grade_table.get_clarity, inventory.clarity_indexes,
+                                       inventory.clarity_groups, list_range_tolerance=0,
+                                       open_range_matches_nothing=True)
+                similar_diamonds_ids.update(inventory.ids[mask].tolist())
+        return list(similar_diamonds_ids)
+
+
+async def load_inventory_rows(session: AsyncSession, diamonds_ids: set[int] | None = None) -> list[InventoryRow]:
+    query = (
+        select(Diamond.id, Diamond.shape, Diamond.weight, Diamond.color_index, Diamond.color_group,
+               Diamond.clarity_index, Diamond.clarity_group)
+        .where(Diamond.id.in_(select(DiamondOwner.diamond_id)))
+    )
+    if diamonds_ids is not None:
+        query = query.where(Diamond.id.in_(list(diamonds_ids)))
+    result = await session.execute(query)
+    return [InventoryRow(*row) for row in result.all()]
+
+
+class NotifiedIndexHolder[T](ABC):
+    """
+    Keeps a resident index of the owned diamonds fresh with the diamond_owners notifications.
+
+    Notified diamonds are only collected by the listener and reloaded by the next search, so an upload of thousands of
+    diamonds costs a single query. While the listener is disconnected the index is not ready and the searches should
+    fall back to the database.
+    """
+
+    def __init__(self):
+        self.index: T | None = None
+        self.pending_diamonds_ids: set[int] = set()
+        self.refresh_lock = asyncio.Lock()
+        self.listener_task: asyncio.Task | None = None
+
+    @property
+    def is_ready(self) -> bool:
+        return self.index is not None
+
+    @abstractmethod
+    async def load_index(self, session: AsyncSession) -> T:
+        ...
+
+    @abstractmethod
+    async def update_index(self, session: AsyncSession, diamonds_ids: set[int]) -> None:
+        """Reload the given diamonds into the index, the ones not owned anymore are removed."""
+        ...
+
+    def on_notification(self, connection: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+        self.pending_diamonds_ids.add(int(payload))
+
+    async def refresh(self, session: AsyncSession, diamonds_ids: Iterable[int] = ()) -> None:
+        """
+        Reload the notified diamonds and the given ones. The notifications arrive asynchronously, so the diamonds just
+        committed by the caller may not be notified yet.
+        """
+        async with self.refresh_lock:
+            if self.index is None:
+                return
+            diamonds_ids = self.pending_diamonds_ids | set(diamonds_ids)
+            if not diamonds_ids:
+                return
+            self.pending_diamonds_ids = set()
+            await self.update_index(session, diamonds_ids)
+            logger.debug("{} was refreshed for {} diamonds", type(self).__name__, len(diamonds_ids))
+
+    async def listen(self) -> None:
+        name = type(self).__name__
+        while True:
+            try:
+                connection = await asyncpg.connect(sync_database_url)
+            except (OSError, asyncpg.PostgresError):
+                logger.exception("Failed to connect the {} listener", name)
+                await asyncio.sleep(LISTENER_RECONNECT_DELAY)
+                continue
+
+            disconnected = asyncio.Event()
+            connection.add_termination_listener(lambda _: disconnected.set())
+            try:
+                self.pending_diamonds_ids = set()
+                # The listener is added before the load, so no change is missed in between
+                await connection.add_listener(DIAMOND_OWNERS_CHANNEL, self.on_notification)
+                async with sessionmaker() as session:
+                    self.index = await self.load_index(session)
+                logger.success("{} was loaded", name)
+                await disconnected.wait()
+                logger.warning("{} listener was disconnected", name)
+            except Exception:
+                logger.exception("{} listener failed", name)
+            finally:
+                self.index = None
+                if not connection.is_closed():
+                    await connection.close()
+            await asyncio.sleep(LISTENER_RECONNECT_DELAY)
+
+    def start(self) -> None:
+        self.listener_task = asyncio.create_task(self.listen())
+
+    async def stop(self) -> None:
+        if self.listener_task is not None:
+            self.listener_task.cancel()
+            self.listener_task = None
+
+
+class InventoryIndexHolder(NotifiedIndexHolder[InventoryIndex]):
+    """
+    Keeps the inventory index fresh with the diamond_owners notifications.
+
+    Every notification also bumps the version of the search results cache, so the cache is only trusted while the
+    index is ready.
+    """
+
+    def on_notification(self, connection: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+        super().on_notification(connection, pid, channel, payload)
+        search_results_cache.bump_inventory_version()
+
+    async def load_index(self, session: AsyncSession) -> InventoryIndex:
+        rows = await load_inventory_rows(session)
+        # Changes made while the listener was disconnected were not notified
+        search_results_cache.bump_inventory_version()
+        logger.info("Inventory index has {} diamonds", len(rows))
+        return InventoryIndex(rows)
+
+    async def update_index(self, session: AsyncSession, diamonds_ids: set[int]) -> None:
+        self.index.update(diamonds_ids, await load_inventory_rows(session, diamonds_ids))
+
+    async def find_similar_diamonds_ids(self, session: AsyncSession,
+                                        extracted_diamonds: list[ExtractedDiamond]) -> list[int]:
+        await self.refresh(session)
+        return self.index.find_similar_diamonds_ids(extracted_diamonds)
+
+
+inventory_index_holder = InventoryIndexHolder()
@@ -0,0 +1,100 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, NamedTuple
+
+from loguru import logger
+from sqlalchemy import select, update, delete, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..database.models import Diamond, DiamondOwner, DiamondPair
+from ..database.models.diamond import DIAMOND_UNIQUE_COLUMNS, DIAMOND_UPDATED_COLUMNS
+
+
+class InventorySyncResult(NamedTuple):
+    added_ids: list[int]
+    updated_ids: list[int]
+    removed_ids: list[int]
+
+
+class InventoryDiff(NamedTuple):
+    added_diamonds: list[dict[str, Any]]
+    # Values of DIAMOND_UPDATED_COLUMNS with the id of the updated diamond
+    updated_values: list[dict[str, Any]]
+    removed_ids: list[int]
+
+
+def get_inventory_diff(owned_diamonds: list[dict[str, Any]], uploaded_diamonds: list[dict[str, Any]]) -> InventoryDiff:
+    """
+    Compare the uploaded diamonds with the owned ones by the stock number.
+
+    An owned diamond with the same DIAMOND_UNIQUE_COLUMNS is kept, and updated if its DIAMOND_UPDATED_COLUMNS differ.
+    The uploaded diamonds without such an owned one are added, the other owned diamonds are removed. The last of the
+    uploaded diamonds with the same stock number wins, like in the upsert.
+    """
+    owned_by_stocks: defaultdict[str, list[dict[str, Any]]] = defaultdict(list)
+    for diamond in owned_diamonds:
+        owned_by_stocks[diamond['stock']].append(diamond)
+    uploaded_by_stocks = {diamond['stock']: diamond for diamond in uploaded_diamonds}
+
+    diff = InventoryDiff([], [], [])
+    for stock, uploaded_diamond in uploaded_by_stocks.items():
+        identity = tuple(uploaded_diamond[column] for column in DIAMOND_UNIQUE_COLUMNS)
+        kept_diamond = None
+        for owned_diamond in owned_by_stocks.pop(stock, []):
+            if kept_diamond is None and tuple(owned_diamond[column] for column in DIAMOND_UNIQUE_COLUMNS) == identity:
+                kept_diamond = owned_diamond
+            else:
+                diff.removed_ids.append(owned_diamond['id'])
+
+        if kept_diamond is None:
+            diff.added_diamonds.append(uploaded_diamond)
+        elif any(kept_diamond[column] != uploaded_diamond[column] for column in DIAMOND_UPDATED_COLUMNS):
+            diff.updated_values.append({'id': kept_diamond['id']}
+                                       | {column: uploaded_diamond[column] for column in DIAMOND_UPDATED_COLUMNS})
+
+    # Stocks missing from the file
+    diff.removed_ids.extend(diamond['id'] for diamonds in owned_by_stocks.values() for diamond in diamonds)
+    return diff
+
+
+async def get_owned_diamonds(session: AsyncSession, user_id: int) -> list[dict[str, Any]]:
+    columns = [getattr(Diamond, column) for column in ['id', *DIAMOND_UNIQUE_COLUMNS, *DIAMOND_UPDATED_COLUMNS]]
+    query = (
+        select(*columns)
+        .join(DiamondOwner, DiamondOwner.diamond_id == Diamond.id)
+        .where(DiamondOwner.user_id == user_id)
+    )
+    return [dict(row) for row in (await session.execute(query)).mappings()]
+
+
+async def sync_user_diamonds(session: AsyncSession, user_id: int, uploaded_diamonds: list[dict[str, Any]],
+                             upload_date: datetime) -> InventorySyncResult:
+    """Apply the diff of the user stock and the uploaded diamonds with one statement per kind of change."""
+    diff = get_inventory_diff(await get_owned_diamonds(session, user_id), uploaded_diamonds)
+    logger.debug("Stock diff of user {}: {} added, {} updated, {} removed", user_id, len(diff.added_diamonds),
+                 len(diff.updated_values), len(diff.removed_ids))
+
+    if diff.removed_ids:
+        await session.execute(
+            delete(DiamondOwner)
+            .where(
+                and_(
+                    DiamondOwner.user_id == user_id,
+                    DiamondOwner.diamond_id.in_(diff.removed_ids)
+                )
+            )
+        )
+        await DiamondPair.delete_for_unowned_diamonds(session, diff.removed_ids)
+
+    if diff.updated_values:
+        # Bulk UPDATE by the primary key
+        await session.execute(update(Diamond), diff.updated_values)
+
+    added_ids = []
+    if diff.added_diamonds:
+        added_ids = await Diamond.add_diamonds(session, diff.added_diamonds, commit=False)
+        await DiamondOwner.make_user(session, user_id, added_ids, upload_date)
+    else:
+        await session.commit()
+
+    return InventorySyncResult(added_ids, [values['id'] for values in diff.updated_values], diff.removed_ids)
@@ -0,0 +1,66 @@
+import asyncio
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile
+from loguru import logger
+
+from ..core import bot
+from ..core.config import PAIRS_SEARCH_CONCURRENCY
+from ..database.loader import sessionmaker
+from .diamond_utils import generate_csv_content, generate_text_table
+from .find_pairs import find_pairs_for_diamonds
+from .users import get_gettext
+
+pairs_search_semaphore = asyncio.Semaphore(PAIRS_SEARCH_CONCURRENCY)
+
+# Keeps references to the running deliveries, otherwise the tasks may be garbage collected before they finish
+pairs_delivery_tasks: set[asyncio.Task] = set()
+
+
+def schedule_pairs_delivery(user_id: int, diamonds_ids: list[int]) -> None:
+    """Search the pairs of the uploaded diamonds in the background and send them to the user when they are ready."""
+    task = asyncio.create_task(deliver_pairs(user_id, diamonds_ids))
+    pairs_delivery_tasks.add(task)
+    task.add_done_callback(pairs_delivery_tasks.discard)
+    logger.info("Pairs delivery for user {} was scheduled, {} deliveries are pending", user_id,
+                len(pairs_delivery_tasks))
+
+
+async def deliver_pairs(user_id: int, diamonds_ids: list[int]) -> None:
+    async with pairs_search_semaphore:
+        logger.info("Searching pairs for {} diamonds uploaded by user {}", len(diamonds_ids), user_id)
+        async with sessionmaker() as session:
+            _ = await get_gettext(session, user_id)
+            try:
+                pairs = await find_pairs_for_diamonds(session, diamonds_ids)
+            except Exception:
+                logger.exception("Failed to search pairs for user {}", user_id)
+                try:
+                    await bot.send_message(user_id, _("pairs_search_failed_error"))
+                except TelegramBadRequest:
+                    logger.exception("Failed to notify user about the failed pairs search")
+                return
+
+    if len(pairs) == 0:
+        try:
+            await bot.send_message(user_id, _("csv_file_processed_successfully_without_pairs"))
+        except TelegramBadRequest:
+            logger.exception("Failed to notify user about the CSV file processed successfully without pairs")
+        else:
+            logger.success("User was notified about the CSV file processed successfully without pairs")
+        return
+
+    pairs_csv_file = BufferedInputFile(generate_csv_content(pairs), filename="pairs.csv")
+    try:
+        await bot.send_message(user_id, _("list_of_pairs_preview").format(generate_text_table(pairs)),
+                               parse_mode="markdown")
+        await bot.send_document(
+            chat_id=user_id,
+            document=pairs_csv_file,
+            caption=_("csv_file_processed_successfully_with_pairs")
+        )
+    except TelegramBadRequest:
+        logger.exception("Failed to notify user about the CSV file processed successfully with pairs")
+    else:
+        logger.success("User was notified about the CSV file processed successfully with pairs")
+
@@ -0,0 +1,239 @@
+from collections import defaultdict
+from typing import Any, NamedTuple, Sequence
+
+import numpy as np
+from loguru import logger
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..database.models import Diamond, DiamondOwner
+from ..database.models.enums import Shape, Fluorescence
+from .inventory_index import NotifiedIndexHolder
+
+WEIGHT_TOLERANCE = 0.015
+DIMENSIONS_TOLERANCE = 0.015
+GRADE_TOLERANCE = 1
+
+# Marks a diamond owned by several users. Such a diamond always has an owner different from any other diamond owner.
+MULTIPLE_OWNERS = -1
+
+type BucketKey = tuple[Shape, Fluorescence, int, int]
+
+
+def get_relative_deltas(initial_value: float, pair_values: np.ndarray) -> np.ndarray:
+    if initial_value == 0:
+        return np.zeros_like(pair_values)
+    return np.abs(pair_values - initial_value) / initial_value
+
+
+class PairsIndexRow(NamedTuple):
+    diamond_id: int
+    owner_id: int
+    shape: Shape
+    fluorescence: Fluorescence
+    weight: float
+    length: float
+    table: float
+    depth_percentage: float
+    color_index: int
+    color_group: int
+    clarity_index: int
+    clarity_group: int
+    cut_index: int
+    polish_index: int
+    symmetry_index: int
+
+
+class PairsBucket:
+    """Diamonds sharing shape, fluorescence, color group and clarity group, sorted by weight."""
+
+    def __init__(self, rows: Sequence[PairsIndexRow]):
+        rows = sorted(rows, key=lambda row: row.weight)
+        self.ids = np.fromiter((row.diamond_id for row in rows), dtype=np.int64, count=len(rows))
+        self.owners = np.fromiter((row.owner_id for row in rows), dtype=np.int64, count=len(rows))
+        self.weights = np.fromiter((row.weight for row in rows), dtype=np.float64, count=len(rows))
+        self.lengths = np.fromiter((row.length for row in rows), dtype=np.float64, count=len(rows))
+        self.tables = np.fromiter((row.table for row in rows), dtype=np.float64, count=len(rows))
+        self.depth_percentages = np.fromiter((row.depth_percentage for row in rows), dtype=np.float64,
+                                             count=len(rows))
+        self.color_indexes = np.fromiter((row.color_index for row in rows), dtype=np.int16, count=len(rows))
+        self.clarity_indexes = np.fromiter((row.clarity_index for row in rows), dtype=np.int16, count=len(rows))
+        self.cut_indexes = np.fromiter((row.cut_index for row in rows), dtype=np.int16, count=len(rows))
+        self.polish_indexes = np.fromiter((row.polish_index for row in rows), dtype=np.int16, count=len(rows))
+        self.symmetry_indexes = np.fromiter((row.symmetry_index for row in rows), dtype=np.int16, count=len(rows))
+
+    def find_pairs(self, diamond: PairsIndexRow, limit: int | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """Ids and scores of the pairs of the diamond, only the best ones if the limit is given."""
+        weight = diamond.weight
+        start = np.searchsorted(self.weights, weight * (1 - WEIGHT_TOLERANCE), side="left")
+        stop = np.searchsorted(self.weights, weight * (1 + WEIGHT_TOLERANCE), side="right")
+        if start >= stop:
+            return self.ids[:0], self.weights[:0]
+
+        candidates = slice(start, stop)
+        weights = self.weights[candidates]
+        lengths = self.lengths[candidates]
+        tables = self.tables[candidates]
+        depth_percentages = self.depth_percentages[candidates]
+        owners = self.owners[candidates]
+        color_distances = np.abs(self.color_indexes[candidates] - diamond.color_index)
+        clarity_distances = np.abs(self.clarity_indexes[candidates] - diamond.clarity_index)
+        cut_distances = np.abs(self.cut_indexes[candidates] - diamond.cut_index)
+        polish_distances = np.abs(self.polish_indexes[candidates] - diamond.polish_index)
+        symmetry_distances = np.abs(self.symmetry_indexes[candidates] - diamond.symmetry_index)
+
+        mask = self.ids[candidates] != diamond.diamond_id
+        mask &= (weight >= weights * (1 - WEIGHT_TOLERANCE)) & (weight <= weights * (1 + WEIGHT_TOLERANCE))
+        mask &= (diamond.length >= lengths * (1 - DIMENSIONS_TOLERANCE)) & \
+                (diamond.length <= lengths * (1 + DIMENSIONS_TOLERANCE))
+        mask &= (tables >= diamond.table * (1 - DIMENSIONS_TOLERANCE)) & \
+                (tables <= diamond.table * (1 + DIMENSIONS_TOLERANCE))
+        mask &= (depth_percentages >= diamond.depth_percentage * (1 - DIMENSIONS_TOLERANCE)) & \
+                (depth_percentages <= diamond.depth_percentage * (1 + DIMENSIONS_TOLERANCE))
+        mask &= (diamond.depth_percentage >= depth_percentages * (1 - DIMENSIONS_TOLERANCE)) & \
+                (diamond.depth_percentage <= depth_percentages * (1 + DIMENSIONS_TOLERANCE))
+        mask &= color_distances <= GRADE_TOLERANCE
+        mask &= clarity_distances <= GRADE_TOLERANCE
+        mask &= cut_distances <= GRADE_TOLERANCE
+        mask &= polish_distances <= GRADE_TOLERANCE
+        mask &= symmetry_distances <= GRADE_TOLERANCE
+        if diamond.owner_id != MULTIPLE_OWNERS:
+            mask &= (owners == MULTIPLE_OWNERS) | (owners != diamond.owner_id)
+
+        # Same as DiamondPair.get_score
+        scores = (
+            (get_relative_deltas(diamond.weight, weights[mask])
+             + get_relative_deltas(diamond.length, lengths[mask])
+             + get_relative_deltas(diamond.table, tables[mask])
+             + get_relative_deltas(diamond.depth_percentage, depth_percentages[mask])) / DIMENSIONS_TOLERANCE
+            + color_distances[mask] + clarity_distances[mask] + cut_distances[mask] + polish_distances[mask]
+            + symmetry_distances[mask]
+        )
+        pair_ids = self.ids[candidates][mask]
+
+        if limit is not None and len(pair_ids) > limit:
+            best = np.argpartition(scores, limit - 1)[:limit]
+            return pair_ids[best], scores[best]
+        return pair_ids, scores
+
+
+def collapse_owned_diamonds(rows: Sequence[Sequence[Any]]) -> list[PairsIndexRow]:
+    """Rows of the (diamond_id, owner_id, ...) rows, a diamond with several owners is a single MULTIPLE_OWNERS row."""
+    diamonds: dict[int, PairsIndexRow] = {}
+    for row in rows:
+        diamond = PairsIndexRow(*row)
+        if (known_diamond := diamonds.get(diamond.diamond_id)) is not None:
+            if known_diamond.owner_id != diamond.owner_id:
+                diamonds[diamond.diamond_id] = known_diamond._replace(owner_id=MULTIPLE_OWNERS)
+            continue
+        diamonds[diamond.diamond_id] = diamond
+    return list(diamonds.values())
+
+
+class PairsIndex:
+    """
+    In-memory alternative to the SQL self-join in find_pairs.py.
+
+    Owned diamonds are bucketed by the attributes the pair search requires to be equal (shape, fluorescence,
+    color group and clarity group), so a pair lookup only binary searches the weight band of a single bucket and
+    checks the remaining tolerances with vectorized comparisons.
+    """
+
+    def __init__(self, rows: Sequence[PairsIndexRow]):
+        self.diamonds: dict[int, PairsIndexRow] = {row.diamond_id: row for row in rows}
+        self.buckets: dict[BucketKey, PairsBucket] = {}
+        self.rebuild_buckets(set(map(self.get_bucket_key, rows)))
+
+    @staticmethod
+    def get_bucket_key(row: PairsIndexRow) -> BucketKey:
+        return row.shape, row.fluorescence, row.color_group, row.clarity_group
+
+    @classmethod
+    def from_owned_diamonds(cls, rows: Sequence[Sequence[Any]]) -> "PairsIndex":
+        """Build the index from (diamond_id, owner_id, ...) rows, collapsing diamonds with several owners."""
+        return cls(collapse_owned_diamonds(rows))
+
+    def rebuild_buckets(self, keys: set[BucketKey]) -> None:
+        bucket_rows: defaultdict[BucketKey, list[PairsIndexRow]] = defaultdict(list)
+        for row in self.diamonds.values():
+            if (key := self.get_bucket_key(row)) in keys:
+                bucket_rows[key].append(row)
+        for key in keys:
+            if bucket_rows[key]:
+                self.buckets[key] = PairsBucket(bucket_rows[key])
+            else:
+                self.buckets.pop(key, None)
+
+    def update(self, diamonds_ids: set[int], rows: Sequence[Sequence[Any]]) -> None:
+        """
+        Replace the given diamonds with the (diamond_id, owner_id, ...) rows, the diamonds without rows are not owned
+        anymore.
+        """
+        changed_keys = set()
+        for diamond_id in diamonds_ids:
+            if (row := self.diamonds.pop(diamond_id, None)) is not None:
+                changed_keys.add(self.get_bucket_key(row))
+        for row in collapse_owned_diamonds(rows):
+            self.diamonds[row.diamond_id] = row
+            changed_keys.add(self.get_bucket_key(row))
+        self.rebuild_buckets(changed_keys)
+
+    def find_pairs(self, diamonds_ids: list[int], limit_per_diamond: int | None = None) -> dict[int, float]:
+        """Best score of every pair found for the given diamonds by pair id, the ones not in the index are skipped."""
+        pairs_scores: dict[int, float] = {}
+        for diamond_id in diamonds_ids:
+            diamond = self.diamonds.get(diamond_id)
+            if diamond is None:
+                continue
+            bucket = self.buckets[self.get_bucket_key(diamond)]
+            pair_ids, scores = bucket.find_pairs(diamond, limit_per_diamond)
+            for pair_id, score in zip(pair_ids.tolist(), scores.tolist()):
+                if score < pairs_scores.get(pair_id, float("inf")):
+                    pairs_scores[pair_id] = score
+        return pairs_scores
+
+
+async def load_owned_diamonds_rows(session: AsyncSession, diamonds_ids: set[int] | None = None) -> list[Any]:
+    query = (
+        select(Diamond.id, DiamondOwner.user_id, Diamond.shape, Diamond.fluorescence, Diamond.weight, Diamond.length,
+               Diamond.table, Diamond.depth_percentage, Diamond.color_index, Diamond.color_group,
+               Diamond.clarity_index, Diamond.clarity_group, Diamond.cut_index, Diamond.polish_index,
+               Diamond.symmetry_index)
+        .join(DiamondOwner, Diamond.id == DiamondOwner.diamond_id)
+    )
+    if diamonds_ids is not None:
+        query = query.where(Diamond.id.in_(list(diamonds_ids)))
+    result = await session.execute(query)
+    return list(result.all())
+
+
+async def load_pairs_index(session: AsyncSession) -> PairsIndex:
+    pairs_index = PairsIndex.from_owned_diamonds(await load_owned_diamonds_rows(session))
+    logger.debug("Pairs index built for {} diamonds in {} buckets", len(pairs_index.diamonds),
+                 len(pairs_index.buckets))
+    return pairs_index
+
+
+class PairsIndexHolder(NotifiedIndexHolder[PairsIndex]):
+    """Keeps the pairs index resident, the owners of the diamonds are refreshed by the diamond_owners notifications."""
+
+    async def load_index(self, session: AsyncSession) -> PairsIndex:
+        return await load_pairs_index(session)
+
+    async def update_index(self, session: AsyncSession, diamonds_ids: set[int]) -> None:
+        self.index.update(diamonds_ids, await load_owned_diamonds_rows(session, diamonds_ids))
+
+    async def find_pairs_for_diamonds(self, session: AsyncSession, diamonds_ids: list[int],
+                                      limit_per_diamond: int | None = None) -> list[Diamond]:
+        # The diamonds are reloaded, an unknown diamond is only skipped if it is not owned in the database
+        await self.refresh(session, diamonds_ids)
+        pairs_scores = self.index.find_pairs(diamonds_ids, limit_per_diamond)
+        logger.debug("Found {} pairs in memory", len(pairs_scores))
+        if not pairs_scores:
+            return []
+
+        result = await session.execute(select(Diamond).filter(Diamond.id.in_(list(pairs_scores))))
+        return sorted(result.scalars().all(), key=lambda pair: pairs_scores[pair.id])
+
+
+pairs_index_holder = PairsIndexHolder()
@@ -1,11 +1,18 @@
+from loguru import logger
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from ..core.config import DIAMONDS_QUERY_PARSER, EXTRACTION_CIRCUIT_FALLBACK
+
 from .save_extracted_diamonds_as_unmatched import save_extracted_diamonds_as_unmatched
-from ..database.models import Diamond
 from .ai_json_extraction import extract_diamonds_from_message_with_ai, FailedAttempt
 from .diamond_filtering import filter_incomplete_diamonds
+from .extraction_gateway import ExtractionUnavailable
 from .diamond_grouping import get_diamond_lists_grouped_by_sellers
 from .notification import notify_diamonds_owner
+from .query_parser import parse_diamonds_query
+from .inventory_index import inventory_index_holder
+from .search_cache import search_results_cache, get_search_key
+from .similar_diamonds import find_similar_diamonds_ids
 
 
 class SellersNotificationError(Exception):
@@ -22,10 +29,21 @@ class NoDiamondsInMessage(Exception):
 
 async def process_search_query(session: AsyncSession, message_text: str, interested_user_id: int,
                                free_notification: bool = False) -> int:
-    try:
-        diamonds = await extract_diamonds_from_message_with_ai(message_text)
-    except FailedAttempt:
-        raise SellersNotificationError
+    diamonds = parse_diamonds_query(message_text) if DIAMONDS_QUERY_PARSER == "local" else None
+    if diamonds is not None:
+        logger.debug("Diamonds were parsed without the AI model: {}", diamonds)
+    else:
+        try:
+            diamonds = await extract_diamonds_from_message_with_ai(message_text)
+        except ExtractionUnavailable:
+            diamonds = parse_diamonds_query(message_text, strict=False) \
+                if EXTRACTION_CIRCUIT_FALLBACK == "local" else None
+            # Without the AI model it is unknown whether the message requests diamonds
+            if diamonds is None:
+                raise SellersNotificationError
+            logger.warning("The AI model is unavailable, diamonds were parsed without it: {}", diamonds)
+        except FailedAttempt:
+            raise SellersNotificationError
     if not diamonds:
         raise NoDiamondsInMessage
 
@@ -33,11 +51,20 @@ async def process_search_query(session: AsyncSession, message_text: str, interes
     if not diamonds:
         raise NotEnoughDataAboutDiamondsException
 
-    similar_diamonds_ids = await Diamond.find_similar_diamonds_ids(session, diamonds)
+    # Other services change the inventory too, their changes only bump the cache version while the index listens
+    use_cache = search_results_cache.is_enabled and inventory_index_holder.is_ready
+    search_key = get_search_key(diamonds)
+    similar_diamonds_ids = search_results_cache.get(search_key) if use_cache else None
+    if similar_diamonds_ids is None:
+        inventory_version = search_results_cache.inventory_version
+        similar_diamonds_ids = await find_similar_diamonds_ids(session, diamonds)
+        if use_cache:
+            search_results_cache.put(search_key, inventory_version, similar_diamonds_ids)
+    # The rows are loaded fresh, the prices are updated without notifications
     diamonds_by_sellers = await get_diamond_lists_grouped_by_sellers(session, similar_diamonds_ids)
 
     if not diamonds_by_sellers:
-        await save_extracted_diamonds_as_unmatched(session, diamonds, interested_user_id)
+        await save_extracted_diamonds_as_unmatched(session, diamonds, interested_user_id, free_notification)
         return 0
 
     return await notify_diamonds_owner(session, interested_user_id, diamonds_by_sellers, diamonds, free_notification)
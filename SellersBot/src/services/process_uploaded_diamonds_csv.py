@@ -1,19 +1,21 @@
 import csv
-import io
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Callable, Awaitable
 
 from loguru import logger
 from sqlalchemy import select, func, and_
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from ..core.config import CSV_MAX_ERRORS
 from ..database.loader import sessionmaker
 from .users import get_gettext
+from .search_cache import search_results_cache
+from .inventory_sync import InventorySyncResult, sync_user_diamonds
+from .uploaded_rows import UploadedRowsReader, InvalidXLSXFileError
 from ..csv_validation import CSVValidator, NotEmptyTextValidator, LiteralValidator, NumericValidator, IntegerValidator, \
     MeasurementsValidator, NullableValidator, URLValidator
 from ..database.models.enums import shape_aliases, color_aliases, clarity_aliases, quality_aliases, \
     fluorescence_aliases, culet_aliases
-from .find_pairs import find_pairs_for_diamonds
 from ..database.models import Diamond, DiamondOwner, DiamondAddError, SubscriptionType, ActivatedSubscription
 
 
@@ -52,18 +54,75 @@ csv_file_validator.add_column('Price/Crt', [NullableValidator(NumericValidator()
 csv_file_validator.add_column('Pic', [NullableValidator(URLValidator())])
 
 
+DIAMONDS_INSERT_BATCH_SIZE = 500
+
+
 class InvalidCSVFileError(Exception):
     def __init__(self, errors: list[str]):
         self.errors = errors
         super().__init__()
 
 
-async def process_uploaded_diamonds_csv(session: AsyncSession, csv_file: io.TextIOWrapper, user_id: int) -> List[Diamond]:
+async def process_uploaded_diamonds(session: AsyncSession, reader: UploadedRowsReader, user_id: int) -> List[int]:
+    """Add the diamonds from the file to the user stock and return their ids, the pairs are searched separately."""
+    _ = await get_gettext(session, user_id)
+
+    upload_datetime = datetime.now()
+    max_diamonds_per_load, max_total_diamonds_amount = await get_upload_limits(session, user_id, upload_datetime)
+    max_new_diamonds_amount = max_total_diamonds_amount - await DiamondOwner.count_for_user(session, user_id)
+
+    diamond_ids: List[int] = []
+
+    async def add_diamonds(diamonds: List[Dict[str, Any]]) -> None:
+        diamond_ids.extend(await add_diamonds_batch(session, diamonds))
+
+    await read_uploaded_diamonds(session, reader, max_diamonds_per_load, max_new_diamonds_amount, _, add_diamonds)
+
+    logger.info("Adding diamond owners to the database.")
+    await DiamondOwner.make_user(session, user_id, diamond_ids, upload_datetime)
+    search_results_cache.bump_inventory_version()
+    logger.success("Diamonds were added to the database.")
+
+    return diamond_ids
+
+
+async def sync_uploaded_diamonds(session: AsyncSession, reader: UploadedRowsReader,
+                                 user_id: int) -> InventorySyncResult:
+    """
+    Make the file the whole user stock: add the new stones, update the changed prices and remove the missing stones.
+    """
     _ = await get_gettext(session, user_id)
 
-    diamonds_list: List[Dict[str, Any]] = []
     upload_datetime = datetime.now()
+    # The file replaces the stock, so the whole total limit is available for it
+    max_diamonds_per_load, max_total_diamonds_amount = await get_upload_limits(session, user_id, upload_datetime)
+
+    uploaded_diamonds: List[Dict[str, Any]] = []
+
+    async def collect_diamonds(diamonds: List[Dict[str, Any]]) -> None:
+        uploaded_diamonds.extend(diamonds)
+
+    await read_uploaded_diamonds(session, reader, max_diamonds_per_load, max_total_diamonds_amount, _,
+                                 collect_diamonds)
+    # A file with the header only, or a wrong sheet of a workbook, would remove the whole stock
+    if not uploaded_diamonds:
+        raise InvalidCSVFileError([_("full_sync_empty_file_error")])
+
+    logger.info("Synchronizing the stock of user {} with {} uploaded diamonds.", user_id, len(uploaded_diamonds))
+    try:
+        sync_result = await sync_user_diamonds(session, user_id, uploaded_diamonds, upload_datetime)
+    except DiamondAddError:
+        await session.rollback()
+        raise
+    search_results_cache.bump_inventory_version()
+    logger.success("Stock was synchronized: {} added, {} updated, {} removed.", len(sync_result.added_ids),
+                   len(sync_result.updated_ids), len(sync_result.removed_ids))
+
+    return sync_result
+
 
+async def get_upload_limits(session: AsyncSession, user_id: int, upload_datetime: datetime) -> tuple[int, int]:
+    """Maximal amounts of the diamonds per load and in total by the active subscriptions of the user."""
     stmt = (
         select(func.max(SubscriptionType.max_diamonds_per_load), func.max(SubscriptionType.total_new_diamonds_per_period))
         .select_from(ActivatedSubscription)
@@ -83,86 +142,122 @@ async def process_uploaded_diamonds_csv(session: AsyncSession, csv_file: io.Text
         raise NoActiveSubscriptionFoundError("No active subscription found.")
 
     max_diamonds_per_load, max_total_diamonds_amount = result[0]
+    return max_diamonds_per_load, max_total_diamonds_amount
+
+
+async def read_uploaded_diamonds(session: AsyncSession, reader: UploadedRowsReader, max_diamonds_per_load: int,
+                                 max_new_diamonds_amount: int, gettext: Callable[[str], str],
+                                 add_diamonds: Callable[[List[Dict[str, Any]]], Awaitable[None]]) -> None:
+    """Validate and convert the file rows, the converted diamonds are passed to add_diamonds by batches."""
+    _ = gettext
 
-    csv_file.seek(0)
+    logger.info("Processing the uploaded file.")
+    errors: List[str] = []
     try:
-        rows_amount = sum(1 for _ in csv_file)
+        await reader.open()
+        if header_errors := csv_file_validator.check_header(reader, _, True):
+            raise InvalidCSVFileError(header_errors)
+
+        # Rows are validated, converted and written in a single pass, the whole upload is one transaction.
+        # After the first invalid row nothing is written, the rest of the file is only validated to report the errors.
+        first_row_number = 1
+        while len(errors) < CSV_MAX_ERRORS and (rows_batch := await reader.read_rows(DIAMONDS_INSERT_BATCH_SIZE)):
+            last_row_number = first_row_number + len(rows_batch) - 1
+            if last_row_number > max_diamonds_per_load:
+                raise DiamondsPerLoadLimitExceededError
+            if last_row_number > max_new_diamonds_amount:
+                raise TotalDiamondsLimitExceededError("Total diamonds limit exceeded.")
+
+            await process_rows_batch(rows_batch, first_row_number, errors, _, add_diamonds)
+            first_row_number = last_row_number + 1
+
+        if errors:
+            logger.debug("Validation failed with {} errors: {}", len(errors), errors)
+            raise InvalidCSVFileError(errors)
     except UnicodeDecodeError:
+        await session.rollback()
         raise InvalidCSVFileError([_("File is not a CSV file.")])
-    logger.debug("CSV file rows amount: {}", rows_amount)
-
-    if rows_amount > max_diamonds_per_load:
-        raise DiamondsPerLoadLimitExceededError
-
-    if max_total_diamonds_amount < await DiamondOwner.count_for_user(session, user_id) + rows_amount:
-        raise TotalDiamondsLimitExceededError("Total diamonds limit exceeded.")
-
-    logger.info("Validating the CSV file.")
-    csv_file.seek(0)
-    errors = csv_file_validator.validate(csv_file, _, True)
-    logger.debug("Validation finished. Errors: {}", errors)
-
-    if errors:
-        raise InvalidCSVFileError(errors)
-    logger.success("CSV file is valid.")
-
-    logger.info("Starting to process the CSV file.")
-    csv_file.seek(0)
-    reader = csv.DictReader(csv_file, delimiter=",")
-
-    for row_number, row in enumerate(reader, start=1):
-        shape_value = shape_aliases.get(row['Shape'])
-        color_value = color_aliases.get(row['Color'])
-        clarity_value = clarity_aliases.get(row['Clarity'])
-        cut_value = quality_aliases.get(row['Cut'])
-        polish_value = quality_aliases.get(row['Polish'])
-        symmetry_value = quality_aliases.get(row['Symm'])
-        fluorescence_value = fluorescence_aliases.get(row['Fluo'])
-        culet_value = culet_aliases.get(row['Culet'])
-        length, other = row['Measurements'].split('-')
-        width, depth = other.split('x')
-        length, width, depth = float(length), float(width), float(depth)
-
-        diamond = {
-            'stock': row['Stock#'],
-            'shape': shape_value,
-            'weight': float(row['Weight']),
-            'color': color_value,
-            'clarity': clarity_value,
-            'lab': row['Lab'],
-            'certificate_number': int(row['CertNumber']),
-            'length': length,
-            'width': width,
-            'depth': depth,
-            'ratio': float(row['Ratio']),
-            'cut': cut_value,
-            'polish': polish_value,
-            'symmetry': symmetry_value,
-            'fluorescence': fluorescence_value,
-            'table': float(row['Table']),
-            'depth_percentage': float(row['Depth']),
-            'gridle': row['Girdle'],
-            'culet': culet_value,
-            'certificate_comment': row['CertComments'] or None,
-            'rapnet': float(row['Rap%']) if row['Rap%'] else None,
-            'price_per_carat': float(row['Price/Crt']) if row['Price/Crt'] else None,
-            'picture': row['Pic'] if row['Pic'] else None,
-        }
-
-        logger.debug("Diamond created: {}", diamond)
-
-        diamonds_list.append(diamond)
-
+    except csv.Error:
+        await session.rollback()
+        raise InvalidCSVFileError([_("Invalid csv file format.")])
+    except InvalidXLSXFileError:
+        await session.rollback()
+        raise InvalidCSVFileError([_("File is not an XLSX file.")])
+    except (InvalidCSVFileError, DiamondsPerLoadLimitExceededError, TotalDiamondsLimitExceededError,
+            DiamondAddError):
+        await session.rollback()
+        raise
+    finally:
+        reader.close()
     logger.success("File was processed and validated.")
 
-    logger.info("Adding diamonds to the database.")
+
+async def process_rows_batch(rows: List[Dict[str, str]], first_row_number: int, errors: List[str],
+                             gettext: Callable[[str], str],
+                             add_diamonds: Callable[[List[Dict[str, Any]]], Awaitable[None]]) -> None:
+    """Validate the rows and add them, unless the file already has errors. The new errors are appended to errors."""
+    errors += csv_file_validator.validate_rows(rows, first_row_number, gettext, CSV_MAX_ERRORS - len(errors))
+    if not errors:
+        await add_diamonds([convert_row_to_diamond(row) for row in rows])
+
+
+def get_upload_error_message(exception: Exception, gettext: Callable[[str], str]) -> str:
+    _ = gettext
+    if isinstance(exception, InvalidCSVFileError):
+        return _("Unable to process csv file.\n{errors}").format(errors="\n".join(exception.errors))
+    elif isinstance(exception, TotalDiamondsLimitExceededError):
+        return _("total_diamonds_limit_exceeded_error")
+    elif isinstance(exception, DiamondsPerLoadLimitExceededError):
+        return _("diamonds_per_load_limit_exceeded_error").format("1000")
+    elif isinstance(exception, NoActiveSubscriptionFoundError):
+        return _("no_active_subscription_found_error")
+    return _("An unknown error occurred")
+
+
+async def add_diamonds_batch(session: AsyncSession, diamonds: List[Dict[str, Any]]) -> List[int]:
+    logger.debug("Adding a batch of {} diamonds to the database.", len(diamonds))
     try:
-        diamond_ids = await Diamond.add_diamonds(session, diamonds_list)
+        return await Diamond.add_diamonds(session, diamonds, commit=False)
     except DiamondAddError as e:
         logger.exception("An error occurred while adding diamonds to the database: {}", e)
         raise
-    logger.info("Adding diamond owners to the database.")
-    await DiamondOwner.make_user(session, user_id, diamond_ids, upload_datetime)
-    logger.success("Diamonds were added to the database.")
 
-    return await find_pairs_for_diamonds(session, diamond_ids)
+
+def convert_row_to_diamond(row: Dict[str, str]) -> Dict[str, Any]:
+    shape_value = shape_aliases.get(row['Shape'])
+    color_value = color_aliases.get(row['Color'])
+    clarity_value = clarity_aliases.get(row['Clarity'])
+    cut_value = quality_aliases.get(row['Cut'])
+    polish_value = quality_aliases.get(row['Polish'])
+    symmetry_value = quality_aliases.get(row['Symm'])
+    fluorescence_value = fluorescence_aliases.get(row['Fluo'])
+    culet_value = culet_aliases.get(row['Culet'])
+    length, other = row['Measurements'].split('-')
+    width, depth = other.split('x')
+    length, width, depth = float(length), float(width), float(depth)
+
+    return {
+        'stock': row['Stock#'],
+        'shape': shape_value,
+        'weight': float(row['Weight']),
+        'color': color_value,
+        'clarity': clarity_value,
+        'lab': row['Lab'],
+        'certificate_number': int(row['CertNumber']),
+        'length': length,
+        'width': width,
+        'depth': depth,
+        'ratio': float(row['Ratio']),
+        'cut': cut_value,
+        'polish': polish_value,
+        'symmetry': symmetry_value,
+        'fluorescence': fluorescence_value,
+        'table': float(row['Table']),
+        'depth_percentage': float(row['Depth']),
+        'gridle': row['Girdle'],
+        'culet': culet_value,
+        'certificate_comment': row['CertComments'] or None,
+        'rapnet': float(row['Rap%']) if row['Rap%'] else None,
+        'price_per_carat': float(row['Price/Crt']) if row['Price/Crt'] else None,
+        'picture': row['Pic'] if row['Pic'] else None,
+    }
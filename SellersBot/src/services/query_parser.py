@@ -0,0 +1,176 @@
+import re
+from typing import Any, Iterator, Optional
+
+from ..database.models.enums import Shape, shape_aliases, color_aliases, clarity_aliases
+from ..database.models.processing_types import ExtractedDiamond, ValueRange
+
+# Full shape names, some of them are several words, and the names of the trade not in shape_aliases
+shape_names: dict[str, Shape] = {shape.value: shape for shape in Shape} | {
+    "round": Shape.ROUND_BRILLIANT,
+    "half moon": Shape.HALF_MOON,
+}
+
+# Words which do not change the requested diamonds
+FILLER_WORDS = {"need", "wtb", "looking", "for", "pls", "please", "ct", "cts", "carat", "carats"}
+# Words between the values of the same criterion, like "F/G" or "VS1 or VS2"
+SEPARATOR_WORDS = {"and", "or"}
+# Words and signs which negate or qualify the criteria around them, like "no round" or "G or better"
+QUALIFIER_TOKENS = {"no", "not", "non", "except", "excluding", "without", "but", "better", "up", "above", "over",
+                    "under", "below", "less", "more", "min", "max", "if", "+", "<", ">", "!"}
+
+CARAT_PATTERN = r"\d+(?:\.\d+)?"
+WORD_PATTERN = r"[a-z]+\d?"
+TOKEN_PATTERN = re.compile(rf"""
+    (?P<shape_name>{"|".join(sorted(map(re.escape, shape_names), key=len, reverse=True))})\b
+    |(?P<carat>{CARAT_PATTERN})(?:\s*(?:-|to)\s*(?P<carat_to>{CARAT_PATTERN})|(?P<carat_plus>\+))?
+        (?:\s*(?:ct|cts|carat|carats)\b)?
+    |(?P<word>{WORD_PATTERN})(?:\s*-\s*(?P<word_to>{WORD_PATTERN}))?\b
+    |(?P<separator>[,/&])
+    |(?P<other>\S)
+""", re.VERBOSE)
+# Diamonds of a list are written on separate lines or separated by semicolons
+ITEMS_SEPARATOR = re.compile(r"[\n;]+")
+# Bullets and numbers of the list items, "1." is not one of them since it is a carat
+LIST_MARKER = re.compile(r"^\s*(?:\d+\)|[-*•])\s+")
+
+CRITERIA = ("shape", "carat", "color", "clarity")
+AMBIGUOUS_KIND = "color or clarity"
+SEPARATOR = ("separator", None)
+
+type Criterion = tuple[str, Any]
+
+
+class UnparsedQuery(Exception):
+    pass
+
+
+def get_word_criterion(word: str) -> Optional[Criterion]:
+    """
+    The criterion of a word, None for a filler word.
+
+    "I" is both a color and a clarity, its kind is AMBIGUOUS_KIND and its value is the alias until it is resolved.
+    """
+    if word in FILLER_WORDS:
+        return None
+    alias = word.upper()
+    if alias in shape_aliases:
+        return "shape", shape_aliases[alias]
+    if alias in color_aliases and alias in clarity_aliases:
+        return AMBIGUOUS_KIND, alias
+    if alias in color_aliases:
+        return "color", color_aliases[alias]
+    if alias in clarity_aliases:
+        return "clarity", clarity_aliases[alias]
+    raise UnparsedQuery(f"Unknown word: {word}")
+
+
+def resolve_criterion(kind: str, value: Any) -> Any:
+    if kind == "color" and isinstance(value, str):
+        return color_aliases[value]
+    if kind == "clarity" and isinstance(value, str):
+        return clarity_aliases[value]
+    return value
+
+
+def get_words_range_criterion(from_word: str, to_word: str) -> Criterion:
+    """A range of colors or clarities like "F-H", an ambiguous end takes the kind of the other one."""
+    from_criterion, to_criterion = get_word_criterion(from_word), get_word_criterion(to_word)
+    if from_criterion is None or to_criterion is None:
+        raise UnparsedQuery(f"Invalid range: {from_word}-{to_word}")
+    kinds = {from_criterion[0], to_criterion[0]} - {AMBIGUOUS_KIND}
+    if len(kinds) != 1 or kinds & {"shape"}:
+        raise UnparsedQuery(f"Invalid range: {from_word}-{to_word}")
+    kind = kinds.pop()
+    return kind, ValueRange(resolve_criterion(kind, from_criterion[1]), resolve_criterion(kind, to_criterion[1]))
+
+
+def get_token_criterion(match: re.Match) -> Optional[Criterion]:
+    """The criterion of a token, SEPARATOR between the values of a criterion and None for a filler word."""
+    if match["shape_name"]:
+        return "shape", shape_names[match["shape_name"]]
+    if match["carat"]:
+        carat = float(match["carat"])
+        if match["carat_to"]:
+            return "carat", ValueRange(carat, float(match["carat_to"]))
+        if match["carat_plus"]:
+            return "carat", ValueRange(carat, None)
+        return "carat", carat
+    if match["word"] in SEPARATOR_WORDS or match["separator"]:
+        return SEPARATOR
+    if match["word_to"]:
+        return get_words_range_criterion(match["word"], match["word_to"])
+    if match["word"]:
+        return get_word_criterion(match["word"])
+    raise UnparsedQuery(f"Unknown character: {match.group()}")
+
+
+def get_criteria(item: str, strict: bool) -> Iterator[Criterion]:
+    """
+    The criteria of an item one by one, the tokens which are not understood are skipped unless strict.
+
+    A qualifier is never skipped, the criteria without it would be a different request.
+    """
+    for match in TOKEN_PATTERN.finditer(item):
+        try:
+            criterion = get_token_criterion(match)
+        except UnparsedQuery:
+            if strict or (match["word"] or match["other"]) in QUALIFIER_TOKENS:
+                raise
+            continue
+        if criterion is not None:
+            yield criterion
+
+
+def parse_item(item: str, strict: bool) -> list[dict[str, Any]]:
+    """
+    Diamonds of a list item, like "RB 1.01 G VS2" or "oval 2-2.5ct F-G VVS, RB 1ct F/G VS1".
+
+    A criterion given again starts the next diamond, unless it follows a separator right after a value of the same
+    criterion, then the values are a list. "I" is a color listed after a color or given before the color, otherwise
+    it is a clarity.
+    """
+    diamonds: list[dict[str, Any]] = []
+    diamond: dict[str, Any] = {}
+    last_kind: str | None = None
+    after_separator = False
+    for criterion in get_criteria(item, strict):
+        if criterion == SEPARATOR:
+            after_separator = True
+            continue
+        kind, value = criterion
+        if kind == AMBIGUOUS_KIND:
+            is_listed_color = after_separator and last_kind == "color"
+            kind = "color" if is_listed_color or "color" not in diamond else "clarity"
+            value = resolve_criterion(kind, value)
+        if kind in diamond and after_separator and kind == last_kind:
+            values = diamond[kind] if isinstance(diamond[kind], list) else [diamond[kind]]
+            diamond[kind] = values + [value]
+        elif kind in diamond:
+            diamonds.append(diamond)
+            diamond = {kind: value}
+        else:
+            diamond[kind] = value
+        last_kind, after_separator = kind, False
+    if diamond:
+        diamonds.append(diamond)
+    return diamonds
+
+
+def parse_diamonds_query(message: str, strict: bool = True) -> Optional[list[ExtractedDiamond]]:
+    """
+    Diamonds of a message written in the common trade formats, without the AI model.
+
+    None if any word of the message is not understood or any diamond misses a criterion, then the message is left to
+    the AI model. Not strict, the words which are not understood are skipped and only the complete diamonds are
+    returned, None if there are none or a negation or qualifier like "no" or "better" is not understood.
+    """
+    diamonds: list[dict[str, Any]] = []
+    try:
+        for item in ITEMS_SEPARATOR.split(message.lower()):
+            diamonds += parse_item(LIST_MARKER.sub("", item), strict)
+    except UnparsedQuery:
+        return None
+    complete_diamonds = [diamond for diamond in diamonds if all(criterion in diamond for criterion in CRITERIA)]
+    if not complete_diamonds or (strict and len(complete_diamonds) < len(diamonds)):
+        return None
+    return [ExtractedDiamond(**diamond) for diamond in complete_diamonds]
@@ -18,11 +18,13 @@ from ..database.models import (
 )
 from ..database.models.processing_types import ExtractedDiamond as ExtractedDiamondProcessingType
 from ..database.models.processing_types import ValueRange
+from .unmatched_requests import UnmatchedRequest, unmatched_requests_holder
 
 
 async def save_extracted_diamonds_as_unmatched(
-        session: AsyncSession, diamonds: List[ExtractedDiamondProcessingType], queried_user_id: int) -> None:
-    """Save extracted diamonds as unmatched."""
+        session: AsyncSession, diamonds: List[ExtractedDiamondProcessingType], queried_user_id: int,
+        free_notification: bool = False) -> None:
+    """Save extracted diamonds as unmatched, they are matched against the diamonds uploaded later."""
 
     saving_time = datetime.now()
 
@@ -36,6 +38,7 @@ async def save_extracted_diamonds_as_unmatched(
     save_diamond_shape = partial(save_diamond_attribute, single_value_model=ExtractedDiamondShape,
                                  value_range_model=ExtractedDiamondValueRangeShape)
 
+    unmatched_requests = []
     for diamond in diamonds:
         # Create and save the ExtractedDiamondORM instance
         extracted_diamond = ExtractedDiamondORM(extraction_date=saving_time)
@@ -45,9 +48,12 @@ async def save_extracted_diamonds_as_unmatched(
         # Create an UnmatchedDiamond entry
         unmatched_diamond = UnmatchedDiamond(
             extracted_diamond_id=extracted_diamond.id,
-            queried_user_id=queried_user_id
+            queried_user_id=queried_user_id,
+            free_notification=free_notification
         )
         session.add(unmatched_diamond)
+        unmatched_requests.append(UnmatchedRequest(extracted_diamond.id, queried_user_id, free_notification,
+                                                   saving_time, diamond))
 
         # Save diamond attributes (weight, color, clarity, shape)
         await save_diamond_weight(session, extracted_diamond.id, diamond.carat)
@@ -56,6 +62,7 @@ async def save_extracted_diamonds_as_unmatched(
         await save_diamond_shape(session, extracted_diamond.id, diamond.shape)
 
     await session.commit()
+    unmatched_requests_holder.add(unmatched_requests)
 
 
 class SingleValueModel[T](Protocol):
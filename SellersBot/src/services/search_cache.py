@@ -0,0 +1,72 @@
+from collections import OrderedDict
+from typing import Any, NamedTuple
+
+from loguru import logger
+
+from ..core.config import SEARCH_CACHE_SIZE
+from ..database.models.processing_types import ExtractedDiamond
+
+type SearchKey = tuple[tuple[Any, ...], ...]
+
+
+class CachedSearch(NamedTuple):
+    inventory_version: int
+    similar_diamonds_ids: list[int]
+
+
+def get_canonical_criterion(value: Any) -> Any:
+    # Items of a criteria list are alternatives, so their order and repetitions do not change the result
+    if isinstance(value, list):
+        return tuple(sorted(set(value), key=repr))
+    return value
+
+
+def get_search_key(extracted_diamonds: list[ExtractedDiamond]) -> SearchKey:
+    """Canonical form of the criteria, the found diamonds do not depend on the order of the stones."""
+    stones = {tuple(get_canonical_criterion(value) for value in diamond) for diamond in extracted_diamonds}
+    return tuple(sorted(stones, key=repr))
+
+
+class SearchResultsCache:
+    """
+    LRU cache of the ids of the diamonds similar to the search criteria.
+
+    Every entry is tagged with the inventory version it was searched at. Any change of the owned diamonds bumps the
+    version, so the entries of the previous versions are never returned. Only the ids are cached, the rows are loaded by
+    every search, so the prices updated without a change of the owners are never stale.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.inventory_version = 0
+        self.entries: OrderedDict[SearchKey, CachedSearch] = OrderedDict()
+
+    @property
+    def is_enabled(self) -> bool:
+        return self.max_size > 0
+
+    def bump_inventory_version(self) -> None:
+        self.inventory_version += 1
+
+    def get(self, key: SearchKey) -> list[int] | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.inventory_version != self.inventory_version:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        logger.debug("Search results were found in the cache")
+        return entry.similar_diamonds_ids
+
+    def put(self, key: SearchKey, inventory_version: int, similar_diamonds_ids: list[int]) -> None:
+        """Store the results searched at the given inventory version, if it was not bumped during the search."""
+        if not self.is_enabled or inventory_version != self.inventory_version:
+            return
+        self.entries[key] = CachedSearch(inventory_version, similar_diamonds_ids)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+search_results_cache = SearchResultsCache(SEARCH_CACHE_SIZE)
@@ -0,0 +1,24 @@
+from loguru import logger
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..core.config import SIMILAR_DIAMONDS_SEARCH_ENGINE
+from ..database.models import Diamond
+from ..database.models.processing_types import ExtractedDiamond
+from .inventory_index import inventory_index_holder
+from .similar_diamonds_batcher import similar_diamonds_batcher
+
+
+async def find_similar_diamonds_ids(session: AsyncSession, extracted_diamonds: list[ExtractedDiamond]) -> list[int]:
+    match SIMILAR_DIAMONDS_SEARCH_ENGINE:
+        case "memory" if inventory_index_holder.is_ready:
+            return await inventory_index_holder.find_similar_diamonds_ids(session, extracted_diamonds)
+        case "memory":
+            logger.warning("Inventory index is not ready, searching similar diamonds in the database")
+            return await Diamond.find_similar_diamonds_ids(session, extracted_diamonds)
+        case "unnest":
+            matches = await Diamond.find_similar_diamonds_by_stone(session, extracted_diamonds)
+            return list({diamond_id for _, diamond_id in matches})
+        case "batched":
+            return await similar_diamonds_batcher.find_similar_diamonds_ids(extracted_diamonds)
+        case _:
+            return await Diamond.find_similar_diamonds_ids(session, extracted_diamonds)
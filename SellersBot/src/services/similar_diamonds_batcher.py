@@ -0,0 +1,87 @@
+import asyncio
+from typing import NamedTuple
+
+from loguru import logger
+
+from ..core.config import SIMILAR_DIAMONDS_BATCH_MAX_SIZE, SIMILAR_DIAMONDS_BATCH_MAX_WAIT
+from ..database.loader import sessionmaker
+from ..database.models import Diamond
+from ..database.models.processing_types import ExtractedDiamond
+
+
+class PendingSearch(NamedTuple):
+    extracted_diamonds: list[ExtractedDiamond]
+    result: asyncio.Future[list[int]]
+
+
+class SimilarDiamondsBatcher:
+    """
+    Combines the similar diamonds searches arriving together into a single Diamond.find_similar_diamonds_by_stone.
+
+    A batch is sent when it reaches max_batch_size requested stones or max_wait seconds after its first search,
+    whatever comes first. The matches are tagged by the requested stone, so they are split back by the stone numbers
+    of every search.
+    """
+
+    def __init__(self, max_batch_size: int, max_wait: float):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending_searches: list[PendingSearch] = []
+        self.pending_stones_count = 0
+        self.flush_task: asyncio.Task | None = None
+        self.running_batches: set[asyncio.Task] = set()
+
+    async def find_similar_diamonds_ids(self, extracted_diamonds: list[ExtractedDiamond]) -> list[int]:
+        if len(extracted_diamonds) == 0:
+            return []
+        result = asyncio.get_running_loop().create_future()
+        self.pending_searches.append(PendingSearch(extracted_diamonds, result))
+        self.pending_stones_count += len(extracted_diamonds)
+
+        if self.pending_stones_count >= self.max_batch_size:
+            self.send_batch()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_after_wait())
+        return await result
+
+    async def flush_after_wait(self) -> None:
+        await asyncio.sleep(self.max_wait)
+        self.flush_task = None
+        self.send_batch()
+
+    def send_batch(self) -> None:
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        if not self.pending_searches:
+            return
+        searches, self.pending_searches, self.pending_stones_count = self.pending_searches, [], 0
+        task = asyncio.create_task(self.run_batch(searches))
+        self.running_batches.add(task)
+        task.add_done_callback(self.running_batches.discard)
+
+    @staticmethod
+    async def run_batch(searches: list[PendingSearch]) -> None:
+        extracted_diamonds = [diamond for search in searches for diamond in search.extracted_diamonds]
+        logger.debug("Searching similar diamonds for a batch of {} searches with {} stones", len(searches),
+                     len(extracted_diamonds))
+        try:
+            async with sessionmaker() as session:
+                matches = await Diamond.find_similar_diamonds_by_stone(session, extracted_diamonds)
+        except Exception as e:
+            for search in searches:
+                if not search.result.done():
+                    search.result.set_exception(e)
+            return
+
+        search_numbers = [number for number, search in enumerate(searches) for _ in search.extracted_diamonds]
+        similar_diamonds_ids: list[set[int]] = [set() for _ in searches]
+        for stone, diamond_id in matches:
+            similar_diamonds_ids[search_numbers[stone]].add(diamond_id)
+        for search, diamonds_ids in zip(searches, similar_diamonds_ids):
+            # The caller may be cancelled while waiting for the batch
+            if not search.result.done():
+                search.result.set_result(list(diamonds_ids))
+
+
+similar_diamonds_batcher = SimilarDiamondsBatcher(SIMILAR_DIAMONDS_BATCH_MAX_SIZE, SIMILAR_DIAMONDS_BATCH_MAX_WAIT)
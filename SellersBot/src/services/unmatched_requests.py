@@ -0,0 +1,234 @@
+import asyncio
+from bisect import bisect_right, insort
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, NamedTuple
+
+from loguru import logger
+from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..core.config import UNMATCHED_REQUESTS_MAX_AGE_DAYS
+from ..database.loader import sessionmaker
+from ..database.models import (
+    Diamond,
+    ExtractedDiamond as ExtractedDiamondORM,
+    UnmatchedDiamond,
+    ExtractedDiamondWeight,
+    ExtractedDiamondValueRangeWeight,
+    ExtractedDiamondColor,
+    ExtractedDiamondValueRangeColor,
+    ExtractedDiamondClarity,
+    ExtractedDiamondValueRangeClarity,
+    ExtractedDiamondShape,
+    ExtractedDiamondValueRangeShape
+)
+from ..database.models.enums import Shape
+from ..database.models.processing_types import ExtractedDiamond, ValueRange
+from ..database.models.search_criteria import CriteriaRow, get_criteria_rows
+from .inventory_index import InventoryRow, load_inventory_rows
+from .notification import notify_diamonds_owner
+
+
+class UnmatchedRequest(NamedTuple):
+    extracted_diamond_id: int
+    queried_user_id: int
+    free_notification: bool
+    extraction_date: datetime
+    diamond: ExtractedDiamond
+
+
+def is_row_matched(row: CriteriaRow, diamond: InventoryRow) -> bool:
+    return (row.min_carat <= diamond.weight <= row.max_carat
+            and row.min_color <= diamond.color_index <= row.max_color
+            and (row.color_group is None or row.color_group == diamond.color_group)
+            and row.min_clarity <= diamond.clarity_index <= row.max_clarity
+            and (row.clarity_group is None or row.clarity_group == diamond.clarity_group))
+
+
+class UnmatchedRequestsIndex:
+    """
+    Standing queries of the saved unmatched requests.
+
+    Every request is flattened into criteria rows like the set-based similar diamonds search. The rows are bucketed by
+    shape and sorted by the minimal carat, so a new diamond is only compared with the rows of its shape that start below
+    its weight.
+    """
+
+    def __init__(self):
+        self.requests: dict[int, UnmatchedRequest] = {}
+        # Rows are (min_carat, extracted_diamond_id, row), the None bucket holds the rows of any shape
+        self.shapes: defaultdict[Shape | None, list[tuple[float, int, CriteriaRow]]] = defaultdict(list)
+
+    def add(self, requests: list[UnmatchedRequest]) -> None:
+        for request in requests:
+            self.requests[request.extracted_diamond_id] = request
+            for row in get_criteria_rows([request.diamond]):
+                insort(self.shapes[row.shape], (row.min_carat, request.extracted_diamond_id, row),
+                       key=lambda entry: entry[0])
+
+    def remove(self, extracted_diamonds_ids: set[int]) -> None:
+        for extracted_diamond_id in extracted_diamonds_ids:
+            self.requests.pop(extracted_diamond_id, None)
+        for shape, rows in self.shapes.items():
+            self.shapes[shape] = [entry for entry in rows if entry[1] not in extracted_diamonds_ids]
+
+    def age_out(self, oldest_extraction_date: datetime) -> None:
+        expired_ids = {extracted_diamond_id for extracted_diamond_id, request in self.requests.items()
+                       if request.extraction_date < oldest_extraction_date}
+        if expired_ids:
+            self.remove(expired_ids)
+            logger.info("{} unmatched requests were aged out", len(expired_ids))
+
+    def match(self, diamonds: list[InventoryRow]) -> dict[int, set[int]]:
+        """Ids of the given diamonds matching every matched request, by the request extracted diamond id."""
+        matches: defaultdict[int, set[int]] = defaultdict(set)
+        for diamond in diamonds:
+            for shape in (diamond.shape, None):
+                rows = self.shapes.get(shape, [])
+                started_rows_amount = bisect_right(rows, diamond.weight, key=lambda entry: entry[0])
+                for _, extracted_diamond_id, row in rows[:started_rows_amount]:
+                    if is_row_matched(row, diamond):
+                        matches[extracted_diamond_id].add(diamond.diamond_id)
+        return dict(matches)
+
+
+def get_criterion(items: list[Any]) -> Any:
+    if not items:
+        return None
+    if len(items) == 1:
+        return items[0]
+    return items
+
+
+async def load_unmatched_requests(session: AsyncSession, oldest_extraction_date: datetime) -> list[UnmatchedRequest]:
+    requests = (
+        select(UnmatchedDiamond.extracted_diamond_id, UnmatchedDiamond.queried_user_id,
+               UnmatchedDiamond.free_notification, ExtractedDiamondORM.extraction_date)
+        .join(ExtractedDiamondORM, ExtractedDiamondORM.id == UnmatchedDiamond.extracted_diamond_id)
+        .where(ExtractedDiamondORM.extraction_date >= oldest_extraction_date)
+    )
+    requests_rows = (await session.execute(requests)).all()
+    requests_ids = select(requests.subquery().c.extracted_diamond_id)
+
+    attributes: dict[str, defaultdict[int, list[Any]]] = {}
+    for attribute, single_value_model, value_range_model in (
+            ("carat", ExtractedDiamondWeight, ExtractedDiamondValueRangeWeight),
+            ("color", ExtractedDiamondColor, ExtractedDiamondValueRangeColor),
+            ("clarity", ExtractedDiamondClarity, ExtractedDiamondValueRangeClarity),
+            ("shape", ExtractedDiamondShape, ExtractedDiamondValueRangeShape)):
+        items: defaultdict[int, list[Any]] = defaultdict(list)
+        single_values = await session.execute(
+            select(single_value_model.extracted_diamond_id, single_value_model.value)
+            .where(single_value_model.extracted_diamond_id.in_(requests_ids))
+        )
+        for extracted_diamond_id, value in single_values:
+            items[extracted_diamond_id].append(value)
+        value_ranges = await session.execute(
+            select(value_range_model.extracted_diamond_id, value_range_model.from_value, value_range_model.to_value)
+            .where(value_range_model.extracted_diamond_id.in_(requests_ids))
+        )
+        for extracted_diamond_id, from_value, to_value in value_ranges:
+            items[extracted_diamond_id].append(ValueRange(from_value, to_value))
+        attributes[attribute] = items
+
+    return [
+        UnmatchedRequest(extracted_diamond_id, queried_user_id, free_notification, extraction_date, ExtractedDiamond(
+            color=get_criterion(attributes["color"][extracted_diamond_id]),
+            clarity=get_criterion(attributes["clarity"][extracted_diamond_id]),
+            carat=get_criterion(attributes["carat"][extracted_diamond_id]),
+            shape=get_criterion(attributes["shape"][extracted_diamond_id]),
+        ))
+        for extracted_diamond_id, queried_user_id, free_notification, extraction_date in requests_rows
+    ]
+
+
+def get_oldest_extraction_date() -> datetime:
+    return datetime.now() - timedelta(days=UNMATCHED_REQUESTS_MAX_AGE_DAYS)
+
+
+class UnmatchedRequestsHolder:
+    """
+    Loads the unmatched requests once and matches the uploaded diamonds against them.
+
+    Requests older than UNMATCHED_REQUESTS_MAX_AGE_DAYS are aged out, the requests whose client was sent to the seller
+    are deleted, so every request is notified once.
+    """
+
+    def __init__(self):
+        self.index: UnmatchedRequestsIndex | None = None
+        self.lock = asyncio.Lock()
+
+    async def ensure_loaded(self, session: AsyncSession) -> UnmatchedRequestsIndex:
+        if self.index is None:
+            index = UnmatchedRequestsIndex()
+            index.add(await load_unmatched_requests(session, get_oldest_extraction_date()))
+            self.index = index
+            logger.success("Unmatched requests index was loaded with {} requests", len(index.requests))
+        return self.index
+
+    def add(self, requests: list[UnmatchedRequest]) -> None:
+        # Not loaded index reads the saved requests from the database anyway
+        if self.index is not None:
+            self.index.add(requests)
+
+    async def match_uploaded_diamonds(self, session: AsyncSession, seller_id: int, diamonds_ids: list[int]) -> int:
+        """Notify the seller about the clients requested the uploaded diamonds, returns the number of clients."""
+        async with self.lock:
+            index = await self.ensure_loaded(session)
+            index.age_out(get_oldest_extraction_date())
+            matches = index.match(await load_inventory_rows(session, set(diamonds_ids)))
+            if not matches:
+                return 0
+
+            requests_by_clients: defaultdict[tuple[int, bool], list[UnmatchedRequest]] = defaultdict(list)
+            for extracted_diamond_id in matches:
+                request = index.requests[extracted_diamond_id]
+                requests_by_clients[(request.queried_user_id, request.free_notification)].append(request)
+
+            matched_diamonds_ids = set().union(*matches.values())
+            diamonds = (await session.execute(select(Diamond).where(Diamond.id.in_(matched_diamonds_ids)))).scalars()
+            diamonds_by_ids = {diamond.id: diamond for diamond in diamonds}
+
+            notified_requests_ids = set()
+            for (client_id, free_notification), requests in requests_by_clients.items():
+                client_diamonds_ids = set().union(*(matches[request.extracted_diamond_id] for request in requests))
+                similar_diamonds = [diamonds_by_ids[diamond_id] for diamond_id in sorted(client_diamonds_ids)]
+                notified_sellers_amount = await notify_diamonds_owner(
+                    session, client_id, {seller_id: similar_diamonds}, [request.diamond for request in requests],
+                    free_notification
+                )
+                if notified_sellers_amount > 0:
+                    notified_requests_ids.update(request.extracted_diamond_id for request in requests)
+
+            if notified_requests_ids:
+                await session.execute(
+                    delete(UnmatchedDiamond).where(UnmatchedDiamond.extracted_diamond_id.in_(notified_requests_ids))
+                )
+                await session.commit()
+                index.remove(notified_requests_ids)
+            logger.info("Seller {} was notified about {} clients of the uploaded diamonds", seller_id,
+                        len(requests_by_clients))
+            return len(requests_by_clients)
+
+
+unmatched_requests_holder = UnmatchedRequestsHolder()
+
+# Keeps references to the running matchings, otherwise the tasks may be garbage collected before they finish
+unmatched_requests_matching_tasks: set[asyncio.Task] = set()
+
+
+def schedule_unmatched_requests_matching(seller_id: int, diamonds_ids: list[int]) -> None:
+    """Match the uploaded diamonds against the unmatched requests in the background."""
+    task = asyncio.create_task(match_unmatched_requests(seller_id, diamonds_ids))
+    unmatched_requests_matching_tasks.add(task)
+    task.add_done_callback(unmatched_requests_matching_tasks.discard)
+
+
+async def match_unmatched_requests(seller_id: int, diamonds_ids: list[int]) -> None:
+    async with sessionmaker() as session:
+        try:
+            await unmatched_requests_holder.match_uploaded_diamonds(session, seller_id, diamonds_ids)
+        except Exception:
+            logger.exception("Failed to match the diamonds uploaded by user {} against the unmatched requests",
+                             seller_id)
@@ -0,0 +1,282 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable
+
+from aiogram.exceptions import TelegramBadRequest
+from loguru import logger
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..core import bot
+from ..core.config import UPLOAD_JOBS_DIR, UPLOAD_JOBS_WORKERS, UPLOAD_PROGRESS_UPDATE_INTERVAL
+from ..database.loader import engine, sessionmaker
+from ..database.models import Diamond, DiamondOwner, DiamondAddError, UploadJob
+from ..database.models.enums import UploadJobStatus
+from .pairs_delivery import schedule_pairs_delivery
+from .process_uploaded_diamonds_csv import (InvalidCSVFileError, TotalDiamondsLimitExceededError,
+                                            DiamondsPerLoadLimitExceededError, NoActiveSubscriptionFoundError,
+                                            get_upload_limits, read_uploaded_diamonds, sync_uploaded_diamonds,
+                                            get_upload_error_message)
+from .search_cache import search_results_cache
+from .unmatched_requests import schedule_unmatched_requests_matching
+from .uploaded_rows import UploadedRowsReader, CSVRowsReader, XLSXRowsReader
+from .users import get_gettext
+
+# First key of the advisory locks of the upload jobs, the second one is the job id
+UPLOAD_JOBS_LOCK_KEY = 20
+
+
+class UploadProgress:
+    """The progress message of an upload job, edited at most every UPLOAD_PROGRESS_UPDATE_INTERVAL seconds."""
+
+    def __init__(self, user_id: int, message_id: int | None):
+        self.user_id = user_id
+        self.message_id = message_id
+        self.last_update_time = 0.0
+
+    async def show(self, text: str, force: bool = True) -> None:
+        if self.message_id is None:
+            return
+        if not force and time.monotonic() - self.last_update_time < UPLOAD_PROGRESS_UPDATE_INTERVAL:
+            return
+        self.last_update_time = time.monotonic()
+        try:
+            await bot.edit_message_text(text, chat_id=self.user_id, message_id=self.message_id)
+        except TelegramBadRequest as e:
+            # The same progress is shown again after a restart
+            if "message is not modified" not in e.message:
+                logger.exception("Failed to update the progress of the upload for user {}", self.user_id)
+
+
+def get_upload_job_path(upload_job_id: int, file_type: str) -> Path:
+    return UPLOAD_JOBS_DIR / f"{upload_job_id}.{file_type}"
+
+
+def get_download_path(path: Path) -> Path:
+    """The file is downloaded there and renamed when complete, so an interrupted download is never read."""
+    return path.with_name(f"{path.name}.part")
+
+
+def open_upload_job_reader(path: Path, file_type: str) -> UploadedRowsReader:
+    if file_type == "xlsx":
+        return XLSXRowsReader(open(path, "rb"))
+    return CSVRowsReader(open(path, encoding="utf-8", newline=""))
+
+
+async def process_upload_job_rows(session: AsyncSession, upload_job: UploadJob, path: Path, progress: UploadProgress,
+                                  gettext: Callable[[str], str]) -> list[int]:
+    """
+    Add the diamonds of a regular upload, chunk by chunk, and return their ids.
+
+    The whole file is validated first, so nothing is added from an invalid file. Then every chunk is committed with
+    the number of the processed rows, a resumed job skips the rows added before the restart.
+    """
+    _ = gettext
+    user_id, upload_date, skipped_rows_amount = upload_job.user_id, upload_job.upload_date, upload_job.processed_rows
+
+    max_diamonds_per_load, max_total_diamonds_amount = await get_upload_limits(session, user_id, upload_date)
+    # The stones newly owned by the chunks added before the restart are already counted as owned, the rows which only
+    # updated the stones owned before the upload are not
+    max_new_diamonds_amount = (max_total_diamonds_amount - await DiamondOwner.count_for_user(session, user_id)
+                               + await DiamondOwner.count_for_user_uploaded_at(session, user_id, upload_date))
+
+    await progress.show(_("upload_job_validating_progress"))
+    total_rows_amount = 0
+
+    async def count_rows(diamonds: list[dict[str, Any]]) -> None:
+        nonlocal total_rows_amount
+        total_rows_amount += len(diamonds)
+
+    await read_uploaded_diamonds(session, open_upload_job_reader(path, upload_job.file_type), max_diamonds_per_load,
+                                 max_new_diamonds_amount, _, count_rows)
+    await UploadJob.update_progress(session, upload_job.id, total_rows=total_rows_amount)
+    await session.commit()
+
+    diamonds_ids: list[int] = []
+    read_rows_amount = 0
+
+    async def add_chunk(diamonds: list[dict[str, Any]]) -> None:
+        nonlocal read_rows_amount
+        read_rows_amount += len(diamonds)
+        # The chunks are the same in every read of the file
+        if read_rows_amount <= skipped_rows_amount:
+            return
+        chunk_ids = await Diamond.add_diamonds(session, diamonds, commit=False)
+        await UploadJob.update_progress(session, upload_job.id, processed_rows=read_rows_amount)
+        # Commits the chunk together with its progress
+        await DiamondOwner.make_user(session, user_id, chunk_ids, upload_date)
+        diamonds_ids.extend(chunk_ids)
+        await progress.show(_("upload_job_adding_progress").format(processed=read_rows_amount,
+                                                                    total=total_rows_amount), force=False)
+
+    await read_uploaded_diamonds(session, open_upload_job_reader(path, upload_job.file_type), max_diamonds_per_load,
+                                 max_new_diamonds_amount, _, add_chunk)
+    search_results_cache.bump_inventory_version()
+
+    if skipped_rows_amount > 0:
+        # The ids of the chunks added before the restart are found by the upload date of their owner
+        diamonds_ids = sorted(set(diamonds_ids).union(await DiamondOwner.get_diamonds_ids_uploaded_at(
+            session, user_id, upload_date)))
+    return diamonds_ids
+
+
+@asynccontextmanager
+async def claim_upload_job(upload_job_id: int) -> AsyncIterator[bool]:
+    """
+    Whether the job was claimed, the claim is held until the end of the block.
+
+    The claim is a session advisory lock of a dedicated connection. A job run by another replica is skipped, and the
+    lock of a crashed replica is released with its connection, so its jobs are resumed by the next start.
+    """
+    async with engine.connect() as connection:
+        is_claimed = (await connection.execute(
+            select(func.pg_try_advisory_lock(UPLOAD_JOBS_LOCK_KEY, upload_job_id)))).scalar_one()
+        await connection.commit()
+        try:
+            yield is_claimed
+        finally:
+            if is_claimed:
+                await connection.execute(select(func.pg_advisory_unlock(UPLOAD_JOBS_LOCK_KEY, upload_job_id)))
+                await connection.commit()
+
+
+async def run_upload_job(upload_job_id: int) -> None:
+    async with claim_upload_job(upload_job_id) as is_claimed:
+        if not is_claimed:
+            logger.info("Upload job {} is run by another worker", upload_job_id)
+            return
+        await run_claimed_upload_job(upload_job_id)
+
+
+async def run_claimed_upload_job(upload_job_id: int) -> None:
+    async with sessionmaker() as session:
+        # Read after the claim, the job may have been finished by the worker which released it
+        upload_job = await session.get(UploadJob, upload_job_id)
+        if upload_job is None or upload_job.status not in (UploadJobStatus.PENDING, UploadJobStatus.RUNNING):
+            return
+        user_id, file_type = upload_job.user_id, upload_job.file_type
+        _ = await get_gettext(session, user_id)
+        progress = UploadProgress(user_id, upload_job.progress_message_id)
+        logger.info("Running upload job {} of user {}, {} rows were processed before", upload_job_id, user_id,
+                    upload_job.processed_rows)
+
+        await UploadJob.update_progress(session, upload_job_id, status=UploadJobStatus.RUNNING)
+        await session.commit()
+
+        path = get_upload_job_path(upload_job_id, file_type)
+        try:
+            if not path.exists():
+                await progress.show(_("upload_job_downloading_progress"))
+                UPLOAD_JOBS_DIR.mkdir(parents=True, exist_ok=True)
+                # Streamed to the disk chunk by chunk
+                download_path = get_download_path(path)
+                await bot.download(upload_job.file_id, destination=download_path, timeout=300)
+                download_path.replace(path)
+
+            if upload_job.full_sync:
+                await progress.show(_("upload_job_synchronizing_progress"))
+                sync_result = await sync_uploaded_diamonds(session, open_upload_job_reader(path, file_type), user_id)
+                result_message = _("csv_file_synced_searching_pairs").format(added=len(sync_result.added_ids),
+                                                                             updated=len(sync_result.updated_ids),
+                                                                             removed=len(sync_result.removed_ids))
+                diamonds_ids = sync_result.added_ids
+            else:
+                diamonds_ids = await process_upload_job_rows(session, upload_job, path, progress, _)
+                result_message = _("csv_file_processed_searching_pairs").format(len(diamonds_ids))
+        except (InvalidCSVFileError, TotalDiamondsLimitExceededError, DiamondsPerLoadLimitExceededError,
+                NoActiveSubscriptionFoundError, DiamondAddError) as e:
+            error_message = get_upload_error_message(e, _)
+        except Exception:
+            logger.exception("Upload job {} of user {} failed", upload_job_id, user_id)
+            error_message = _("upload_job_failed_error")
+        else:
+            error_message = None
+
+        if error_message is None:
+            await finish_upload_job(session, upload_job_id, path, UploadJobStatus.DONE)
+            await progress.show(result_message)
+            logger.success("Upload job {} of user {} is done", upload_job_id, user_id)
+        else:
+            await session.rollback()
+            diamonds_ids = await get_added_diamonds_ids(session, upload_job)
+            await finish_upload_job(session, upload_job_id, path, UploadJobStatus.FAILED)
+            if not diamonds_ids:
+                await progress.show(error_message)
+                return
+            # The chunks committed before the failure stay in the stock, their pairs are delivered as usual
+            search_results_cache.bump_inventory_version()
+            logger.warning("Upload job {} of user {} failed after adding {} diamonds", upload_job_id, user_id,
+                           len(diamonds_ids))
+            await progress.show(_("upload_job_partially_failed_error").format(error=error_message,
+                                                                            added=len(diamonds_ids)))
+
+    schedule_pairs_delivery(user_id, diamonds_ids)
+    schedule_unmatched_requests_matching(user_id, diamonds_ids)
+
+
+async def get_added_diamonds_ids(session: AsyncSession, upload_job: UploadJob) -> list[int]:
+    """Ids of the diamonds committed by a failed job, a full sync is a single transaction and commits nothing."""
+    if upload_job.full_sync:
+        return []
+    return await DiamondOwner.get_diamonds_ids_uploaded_at(session, upload_job.user_id, upload_job.upload_date)
+
+
+async def finish_upload_job(session: AsyncSession, upload_job_id: int, path: Path, status: UploadJobStatus) -> None:
+    await UploadJob.update_progress(session, upload_job_id, status=status)
+    await session.commit()
+    path.unlink(missing_ok=True)
+    get_download_path(path).unlink(missing_ok=True)
+
+
+class UploadJobsRunner:
+    """Runs the upload jobs in the background by a bounded pool of workers, one job per worker at a time."""
+
+    def __init__(self, workers_amount: int):
+        self.workers_amount = workers_amount
+        self.queue: asyncio.Queue[int] = asyncio.Queue()
+        self.workers: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        self.workers = [asyncio.create_task(self.work()) for _ in range(self.workers_amount)]
+
+    async def stop(self) -> None:
+        # The interrupted jobs stay running in the database and are resumed on the next start
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def enqueue(self, upload_job_id: int) -> None:
+        self.queue.put_nowait(upload_job_id)
+        logger.info("Upload job {} was enqueued, {} jobs are waiting", upload_job_id, self.queue.qsize())
+
+    async def work(self) -> None:
+        while True:
+            upload_job_id = await self.queue.get()
+            try:
+                await run_upload_job(upload_job_id)
+            except Exception:
+                logger.exception("Failed to run upload job {}", upload_job_id)
+            finally:
+                self.queue.task_done()
+
+
+upload_jobs_runner = UploadJobsRunner(UPLOAD_JOBS_WORKERS)
+
+
+async def schedule_upload_job(session: AsyncSession, user_id: int, file_id: str, file_type: str, full_sync: bool,
+                              progress_message_id: int | None) -> None:
+    upload_job = await UploadJob.create(session, user_id, file_id, file_type, full_sync, progress_message_id)
+    upload_jobs_runner.enqueue(upload_job.id)
+
+
+async def resume_upload_jobs() -> None:
+    """Enqueue the unfinished jobs, the ones run by the other replicas are skipped by their claim."""
+    async with sessionmaker() as session:
+        upload_jobs_ids = await UploadJob.get_unfinished_ids(session)
+    if upload_jobs_ids:
+        logger.info("Resuming {} unfinished upload jobs", len(upload_jobs_ids))
+    for upload_job_id in upload_jobs_ids:
+        upload_jobs_runner.enqueue(upload_job_id)
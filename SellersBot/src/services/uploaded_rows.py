@@ -0,0 +1,123 @@
+import asyncio
+import csv
+import io
+from abc import ABC, abstractmethod
+from datetime import date, datetime, time
+from itertools import islice
+from typing import Any, BinaryIO, Iterator
+
+from openpyxl import load_workbook
+from openpyxl.workbook import Workbook
+
+
+class InvalidXLSXFileError(Exception):
+    pass
+
+
+class UploadedRowsReader(ABC):
+    """Rows of an uploaded stock file as the texts by the header columns, like csv.DictReader."""
+
+    fieldnames: list[str] | None = None
+
+    @abstractmethod
+    async def open(self) -> None:
+        """Read the header into fieldnames."""
+        ...
+
+    @abstractmethod
+    async def read_rows(self, amount: int) -> list[dict[str, str | None]]:
+        """The next rows, at most amount of them, an empty list at the end of the file."""
+        ...
+
+    @abstractmethod
+    def close(self) -> None:
+        """Close the file, the rows are not read anymore."""
+        ...
+
+
+class CSVRowsReader(UploadedRowsReader):
+    def __init__(self, csv_file: io.TextIOWrapper):
+        csv_file.seek(0)
+        self.csv_file = csv_file
+        self.reader = csv.DictReader(csv_file, delimiter=",")
+
+    async def open(self) -> None:
+        self.fieldnames = self.reader.fieldnames
+
+    async def read_rows(self, amount: int) -> list[dict[str, str | None]]:
+        return list(islice(self.reader, amount))
+
+    def close(self) -> None:
+        self.csv_file.close()
+
+
+def get_cell_text(value: Any) -> str:
+    """The cell value as it would be written to a CSV file."""
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    # Integer numbers are stored as floats, the certificate number must stay an integer
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    return str(value)
+
+
+class XLSXRowsReader(UploadedRowsReader):
+    """
+    Rows of the active worksheet of an XLSX file.
+
+    The workbook is opened in the read-only mode and parsed by openpyxl in a worker thread, batch by batch, so the event
+    loop is not blocked and only the requested rows are in memory. Empty rows are skipped, like csv.DictReader does.
+    """
+
+    def __init__(self, xlsx_file: BinaryIO):
+        self.xlsx_file = xlsx_file
+        self.workbook: Workbook | None = None
+        self.rows: Iterator[tuple[Any, ...]] | None = None
+
+    def open_workbook(self) -> None:
+        self.xlsx_file.seek(0)
+        try:
+            self.workbook = load_workbook(self.xlsx_file, read_only=True, data_only=True)
+            self.rows = self.workbook.active.iter_rows(values_only=True)
+            header = next(self.rows, None)
+        except Exception as e:
+            raise InvalidXLSXFileError from e
+        if header is not None:
+            # Formatted but empty cells after the header are read as None
+            fieldnames = [get_cell_text(value) for value in header]
+            while fieldnames and fieldnames[-1] == "":
+                fieldnames.pop()
+            self.fieldnames = fieldnames
+
+    async def open(self) -> None:
+        await asyncio.to_thread(self.open_workbook)
+
+    def read_rows_batch(self, amount: int) -> list[dict[str, str | None]]:
+        if self.fieldnames is None:
+            return []
+        rows = []
+        try:
+            for values in self.rows:
+                if all(value is None for value in values):
+                    continue
+                texts = [get_cell_text(value) for value in values[:len(self.fieldnames)]]
+                texts += [""] * (len(self.fieldnames) - len(texts))
+                rows.append(dict(zip(self.fieldnames, texts)))
+                if len(rows) >= amount:
+                    break
+        except Exception as e:
+            raise InvalidXLSXFileError from e
+        return rows
+
+    async def read_rows(self, amount: int) -> list[dict[str, str | None]]:
+        return await asyncio.to_thread(self.read_rows_batch, amount)
+
+    def close(self) -> None:
+        # The read-only workbook keeps the file open until it is closed
+        if self.workbook is not None:
+            self.workbook.close()
+        self.xlsx_file.close()